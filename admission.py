@@ -0,0 +1,182 @@
+import time
+import itertools
+import threading
+from typing import Callable
+
+from .setup import P
+from .proxies import POOL
+
+
+logger = P.logger
+settings = P.ModelSetting
+
+# 숫자가 작을수록 우선
+PRIORITIES = {
+    'recent': 0,
+    'program': 1,
+    'basic': 2,
+}
+WEIGHTS = {
+    'recent': 3,
+    'program': 2,
+    'basic': 1,
+}
+# 설정을 다시 읽는 간격
+LIMITS_TTL = 5
+
+
+class AdmissionController:
+    '''모든 모듈의 동시 다운로드 수를 관리'''
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.sequence = itertools.count()
+        # key: module
+        self.holders = {}
+        # (seq, module, key)
+        self.waiters = []
+        self.limits = None
+        self.limits_at = 0.0
+
+    def refresh_limits(self) -> dict:
+        '''설정은 잠금 밖에서 읽고 잠시 캐시, 대기중인 스레드는 마지막 값을 씀'''
+        if self.limits and time.monotonic() - self.limits_at < LIMITS_TTL:
+            return self.limits
+        try:
+            global_limit = max(settings.get_int('basic_global_max_count'), 1)
+        except Exception:
+            global_limit = 6
+        # 프록시별 동시 다운로드 수의 합
+        if capacity := POOL.capacity:
+            global_limit = min(global_limit, capacity)
+        modules, reserved = {}, {}
+        for module in PRIORITIES:
+            try:
+                limit = settings.get_int(f'{module}_ffmpeg_max_count')
+            except Exception:
+                limit = 0
+            modules[module] = min(limit, global_limit) if limit and limit > 0 else global_limit
+            try:
+                reserved[module] = max(settings.get_int(f'basic_reserved_{module}'), 0)
+            except Exception:
+                reserved[module] = 0
+        self.limits = {'global': global_limit, 'modules': modules, 'reserved': reserved}
+        self.limits_at = time.monotonic()
+        return self.limits
+
+    @property
+    def global_limit(self) -> int:
+        return (self.limits or self.refresh_limits())['global']
+
+    def module_limit(self, module: str) -> int:
+        return (self.limits or self.refresh_limits())['modules'].get(module, self.global_limit)
+
+    def reserved(self, module: str) -> int:
+        return (self.limits or self.refresh_limits())['reserved'].get(module, 0)
+
+    def count(self, module: str = None) -> int:
+        if module is None:
+            return len(self.holders)
+        return sum(1 for owner in self.holders.values() if owner == module)
+
+    def holds(self, key: str) -> bool:
+        with self.condition:
+            return key in self.holders
+
+    def available(self, module: str) -> int:
+        '''바로 시작할 수 있는 다운로드 수'''
+        self.refresh_limits()
+        with self.condition:
+            return max(min(self.module_limit(module) - self.count(module), self.global_limit - self.count()), 0)
+
+    def is_admissible(self, module: str) -> bool:
+        total = self.count()
+        if total >= self.global_limit:
+            return False
+        active = self.count(module)
+        if active >= self.module_limit(module):
+            return False
+        if active < self.reserved(module):
+            return True
+        # 다른 모듈의 보장 몫은 남겨 둠
+        unmet = sum(
+            max(self.reserved(other) - self.count(other), 0)
+            for other in PRIORITIES if other != module
+        )
+        return self.global_limit - total - unmet > 0
+
+    def pick(self) -> tuple | None:
+        heads = {}
+        for waiter in self.waiters:
+            heads.setdefault(waiter[1], waiter)
+        candidates = [waiter for module, waiter in heads.items() if self.is_admissible(module)]
+        if not candidates:
+            return None
+
+        def fairness(waiter: tuple) -> tuple:
+            seq, module, _ = waiter
+            active = self.count(module)
+            return (
+                active >= self.reserved(module),
+                active / WEIGHTS.get(module, 1),
+                PRIORITIES.get(module, len(PRIORITIES)),
+                seq,
+            )
+
+        return min(candidates, key=fairness)
+
+    def acquire(self, module: str, key: str, timeout: float = None, cancelled: Callable[[], bool] = None) -> bool:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        waiter = (next(self.sequence), module, key)
+        self.refresh_limits()
+        with self.condition:
+            if key in self.holders:
+                return True
+            self.waiters.append(waiter)
+            try:
+                while True:
+                    if self.pick() == waiter:
+                        self.holders[key] = module
+                        logger.debug(f'Admitted: {key} ({self.count(module)}/{self.module_limit(module)}, total={self.count()}/{self.global_limit})')
+                        return True
+                    if cancelled and cancelled():
+                        return False
+                    if deadline is not None and time.monotonic() >= deadline:
+                        return False
+                    self.condition.wait(5)
+                    if time.monotonic() - self.limits_at >= LIMITS_TTL:
+                        # 바뀐 설정은 잠금을 잠시 풀고 읽음
+                        self.condition.release()
+                        try:
+                            self.refresh_limits()
+                        finally:
+                            self.condition.acquire()
+            finally:
+                self.waiters.remove(waiter)
+                self.condition.notify_all()
+
+    def release(self, key: str) -> None:
+        self.refresh_limits()
+        with self.condition:
+            if self.holders.pop(key, None):
+                self.condition.notify_all()
+
+    def status(self) -> dict:
+        self.refresh_limits()
+        with self.condition:
+            return {
+                'global_limit': self.global_limit,
+                'active': self.count(),
+                'modules': {
+                    module: {
+                        'active': self.count(module),
+                        'limit': self.module_limit(module),
+                        'reserved': self.reserved(module),
+                        'waiting': sum(1 for waiter in self.waiters if waiter[1] == module),
+                    }
+                    for module in PRIORITIES
+                },
+            }
+
+
+ADMISSION = AdmissionController()
@@ -0,0 +1,525 @@
+import os
+import json
+import time
+import random
+import shutil
+import datetime
+import tempfile
+import threading
+import subprocess
+import collections
+import http.server
+import urllib.parse
+import multiprocessing
+import concurrent.futures
+from typing import Any, Callable
+
+import psutil
+import requests
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+from support.expand.ffmpeg import SupportFfmpeg
+
+from .setup import F, P
+from .downloader import BINARIES, REDownloader, CachedWVDownloader
+
+
+logger = P.logger
+CHUNK_SIZE = 64 * 1024
+# 영상 인코더, 앞에서부터 시도
+VIDEO_ENCODERS = (('libx264', '-preset', 'ultrafast'), ('mpeg4', '-q:v', '5'))
+ENGINES = ('http', 're', 'wv', 'ffmpeg')
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.mpd': 'application/dash+xml',
+    '.ts': 'video/mp2t',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+}
+# DASH 테스트 파일의 clear key CENC
+CLEAR_KEY = {'kid': '0123456789abcdef0123456789abcdef', 'key': 'fedcba9876543210fedcba9876543210'}
+# 작업 프로세스를 기다리는 시간(초)
+WORKER_TIMEOUT = 60 * 60
+
+
+class Faults:
+    '''세그먼트 요청에만 넣는 오류'''
+
+    def __init__(self, forbidden: float = 0.0, timeout: float = 0.0, truncate: float = 0.0, timeout_second: float = 20.0, seed: int = 0) -> None:
+        self.rates = (('403', forbidden), ('timeout', timeout), ('truncate', truncate))
+        self.timeout_second = timeout_second
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def pick(self) -> str | None:
+        with self.lock:
+            value = self.random.random()
+            for fault, rate in self.rates:
+                if value < rate:
+                    self.counts[fault] += 1
+                    return fault
+                value -= rate
+        return None
+
+
+class StandInCDN:
+    '''
+    미리 만든 HLS/DASH 파일을 지연, 대역폭 제한, 오류를 넣어서 제공
+    측정에 섞이지 않도록 fork한 프로세스에서 실행, 기록은 /_stats, /_reset으로
+    '''
+
+    def __init__(self, root: str, latency_ms: int = 0, bandwidth_kbps: int = 0, faults: Faults = None) -> None:
+        self.root = root
+        self.latency = latency_ms / 1000
+        # 연결마다
+        self.bandwidth = bandwidth_kbps * 1024 / 8
+        self.faults = faults or Faults()
+        self.lock = threading.Lock()
+        # job: {'first': 첫 요청 시각(time.monotonic), 'bytes': 보낸 양, 'requests': 요청 수}
+        self.jobs = collections.defaultdict(lambda: {'first': None, 'bytes': 0, 'requests': 0})
+        self.server = None
+        self.process = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'StandInCDN':
+        cdn = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                cdn.handle(self)
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.process = multiprocessing.get_context('fork').Process(target=self.server.serve_forever, name=f'{P.package_name}_cdn', daemon=True)
+        self.process.start()
+        # 요청은 자식 프로세스만 받음
+        self.server.socket.close()
+        return self
+
+    def stop(self) -> None:
+        if self.process:
+            self.process.terminate()
+            self.process.join()
+
+    def reset(self) -> None:
+        requests.get(f'{self.base_url}/_reset', timeout=10).raise_for_status()
+
+    def stats(self) -> dict:
+        '''{'jobs': {job: 기록}, 'faults': {오류: 횟수}}'''
+        response = requests.get(f'{self.base_url}/_stats', timeout=10)
+        response.raise_for_status()
+        return response.json()
+
+    def control(self, handler: http.server.BaseHTTPRequestHandler, path: str) -> None:
+        with self.lock:
+            if path == '/_reset':
+                self.jobs.clear()
+            data = json.dumps({'jobs': self.jobs, 'faults': self.faults.counts}).encode()
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def handle(self, handler: http.server.BaseHTTPRequestHandler) -> None:
+        path = urllib.parse.urlparse(handler.path).path
+        if path in ('/_stats', '/_reset'):
+            self.control(handler, path)
+            return
+        # /{job}/{hls|dash}/{file}
+        parts = path.strip('/').split('/', 1)
+        job, rel = (parts + [''])[:2]
+        path = os.path.realpath(os.path.join(self.root, rel))
+        with self.lock:
+            stat = self.jobs[job]
+            stat['requests'] += 1
+            if stat['first'] is None:
+                stat['first'] = time.monotonic()
+        if self.latency:
+            time.sleep(self.latency)
+        if not path.startswith(os.path.realpath(self.root) + os.sep) or not os.path.isfile(path):
+            handler.send_error(404)
+            return
+        ext = os.path.splitext(path)[1]
+        fault = self.faults.pick() if ext in ('.ts', '.m4s') else None
+        if fault == '403':
+            handler.send_error(403)
+            return
+        if fault == 'timeout':
+            time.sleep(self.faults.timeout_second)
+            handler.close_connection = True
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        handler.send_response(200)
+        handler.send_header('Content-Type', CONTENT_TYPES.get(ext, 'application/octet-stream'))
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        if fault == 'truncate':
+            data = data[:len(data) // 2]
+            handler.close_connection = True
+        try:
+            for offset in range(0, len(data), CHUNK_SIZE):
+                chunk = data[offset:offset + CHUNK_SIZE]
+                handler.wfile.write(chunk)
+                with self.lock:
+                    stat['bytes'] += len(chunk)
+                if self.bandwidth:
+                    time.sleep(len(chunk) / self.bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def make_media(root: str, duration: int = 60, bitrate: str = '4M', size: str = '1280x720', key: dict = CLEAR_KEY) -> None:
+    '''ffmpeg 테스트 소스로 HLS, DASH(key로 CENC 암호화) 파일 생성'''
+    ffmpeg = BINARIES['ffmpeg'][0] or shutil.which('ffmpeg')
+    if not ffmpeg:
+        raise Exception('ffmpeg 실행 파일이 없습니다.')
+    source = [
+        str(ffmpeg), '-y', '-hide_banner', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate=30',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', str(duration),
+    ]
+    outputs = {
+        'hls': ['-f', 'hls', '-hls_time', '4', '-hls_playlist_type', 'vod', '-hls_segment_filename', 'seg%04d.ts', 'index.m3u8'],
+        'dash': [
+            '-f', 'dash', '-seg_duration', '4', '-use_template', '1', '-use_timeline', '0',
+            '-format_options', f"encryption_scheme=cenc-aes-ctr:encryption_kid={key['kid']}:encryption_key={key['key']}",
+            'manifest.mpd',
+        ],
+    }
+    for protocol, output in outputs.items():
+        directory = os.path.join(root, protocol)
+        os.makedirs(directory, exist_ok=True)
+        for encoder in VIDEO_ENCODERS:
+            command = source + ['-c:v', encoder[0], *encoder[1:], '-b:v', bitrate, '-g', '120', '-c:a', 'aac', '-b:a', '128k'] + output
+            result = subprocess.run(command, cwd=directory, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+            if result.returncode == 0:
+                break
+            logger.debug(f'Encoder {encoder[0]} failed: {result.stderr.strip()}')
+        else:
+            raise Exception(f'{protocol} 테스트 파일을 만들지 못 했습니다.')
+
+
+class ResourceMeter:
+    '''
+    작업 프로세스와 그 자식 프로세스의 CPU 시간, 최대 메모리
+    작업 프로세스는 fork로 부모와 공유하는 페이지가 있어서 USS로 셈
+    '''
+
+    def __init__(self, interval: float = 0.2) -> None:
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak_rss = 0
+        self.event = threading.Event()
+        self.thread = None
+
+    def cpu_seconds(self) -> float:
+        own = self.process.cpu_times()
+        if resource is None:
+            return own.user + own.system + own.children_user + own.children_system
+        # 종료된 자식 프로세스
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return own.user + own.system + children.ru_utime + children.ru_stime
+
+    def sample(self) -> None:
+        try:
+            rss = self.process.memory_full_info().uss
+        except (psutil.Error, AttributeError):
+            rss = self.process.memory_info().rss
+        for process in self.process.children(recursive=True):
+            try:
+                rss += process.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def run(self) -> None:
+        while not self.event.wait(self.interval):
+            self.sample()
+
+    def __enter__(self) -> 'ResourceMeter':
+        self.started_cpu = self.cpu_seconds()
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.event.set()
+        self.thread.join()
+        self.cpu = self.cpu_seconds() - self.started_cpu
+
+
+def worker_main(sender: Any, target: Callable[[], dict]) -> None:
+    try:
+        sender.send((True, target()))
+    except Exception as e:
+        sender.send((False, str(e)))
+    finally:
+        sender.close()
+
+
+def run_in_worker(target: Callable[[], dict], name: str, timeout: int = WORKER_TIMEOUT) -> dict:
+    '''fork한 작업 프로세스에서 실행, 플러그인의 다른 스레드는 측정에 섞이지 않음'''
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=worker_main, args=(sender, target), name=name, daemon=True)
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(timeout):
+            raise Exception(f'{timeout}초 안에 끝나지 않았습니다.')
+        ok, result = receiver.recv()
+    except EOFError:
+        raise Exception(f'작업 프로세스가 비정상 종료했습니다: {process.exitcode}')
+    finally:
+        receiver.close()
+        if process.is_alive():
+            process.kill()
+        process.join()
+    if not ok:
+        raise Exception(result)
+    return result
+
+
+def run_http(url: str, protocol: str, output: str, workers: int = 4) -> bool:
+    '''기준값: 세그먼트를 직접 받아서 이어 붙임 (HLS만)'''
+    if protocol != 'hls':
+        return False
+    session = requests.Session()
+    playlist = session.get(url, timeout=30)
+    playlist.raise_for_status()
+    segments = [urllib.parse.urljoin(url, line.strip()) for line in playlist.text.splitlines() if line.strip() and not line.startswith('#')]
+
+    def fetch(segment: str) -> bytes:
+        for _ in range(3):
+            try:
+                response = session.get(segment, timeout=10)
+                response.raise_for_status()
+                if len(response.content) == int(response.headers.get('Content-Length') or len(response.content)):
+                    return response.content
+            except Exception:
+                pass
+        raise Exception(f'Segment failed: {segment}')
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor, open(output, 'wb') as f:
+        for data in executor.map(fetch, segments):
+            f.write(data)
+    return True
+
+
+def with_keys(downloader_cls: type, keys: list[dict]) -> type:
+    '''라이센스 요청 없이 알고 있는 키로 복호화(--key)'''
+
+    class KeyedDownloader(downloader_cls):
+
+        def prepare(self) -> None:
+            '''override'''
+            self.key = keys
+
+    return KeyedDownloader
+
+
+def run_wv_tool(downloader_cls: type, url: str, protocol: str, output: str, job: str) -> bool:
+    if downloader_cls is CachedWVDownloader and protocol != 'dash':
+        return False
+    downloader_cls = with_keys(downloader_cls, [CLEAR_KEY])
+    params = {
+        'callback_id': f'{P.package_name}_bench_{job}',
+        'logger': logger,
+        'mpd_url': url,
+        'code': f'bench_{job}',
+        'output_filename': os.path.basename(output),
+        'license_headers': None,
+        'license_url': None,
+        'mpd_headers': {},
+        'clean': True,
+        'folder_tmp': os.path.join(os.path.dirname(output), 'tmp'),
+        'folder_output': os.path.dirname(output),
+        'proxies': None,
+    }
+    if protocol == 'hls':
+        params['streaming_protocol'] = 'hls'
+    downloader = downloader_cls(params, callback_function=lambda *args, **kwargs: None)
+    return bool(downloader.download()) and os.path.exists(output)
+
+
+def run_ffmpeg(url: str, protocol: str, output: str, job: str) -> bool:
+    # DASH는 암호화되어 있음
+    if protocol != 'hls':
+        return False
+    downloader = SupportFfmpeg(url, os.path.basename(output), save_path=os.path.dirname(output), callback_id=f'{P.package_name}_bench_{job}')
+    downloader.start_and_wait()
+    return downloader.status == SupportFfmpeg.Status.COMPLETED
+
+
+def get_runner(engine: str) -> Callable[[str, str, str, str], bool]:
+    match engine:
+        case 'http':
+            return lambda url, protocol, output, job: run_http(url, protocol, output)
+        case 're':
+            return lambda url, protocol, output, job: run_wv_tool(REDownloader, url, protocol, output, job)
+        case 'wv':
+            return lambda url, protocol, output, job: run_wv_tool(CachedWVDownloader, url, protocol, output, job)
+        case 'ffmpeg':
+            return run_ffmpeg
+    raise Exception(f'Unknown engine: {engine}')
+
+
+def run_jobs(runner: Callable[[str, str, str, str], bool], jobs: dict, protocol: str) -> dict:
+    '''작업 프로세스: 동시에 받으면서 이 프로세스와 자식 프로세스의 사용량을 잼'''
+    results = {}
+    started_at = {}
+
+    def job(name: str, url: str, output: str) -> None:
+        started_at[name] = time.monotonic()
+        try:
+            results[name] = runner(url, protocol, output, name)
+        except Exception as e:
+            logger.debug(f'Benchmark job failed: {name} {e}')
+            results[name] = False
+
+    with ResourceMeter() as meter:
+        started = time.monotonic()
+        threads = [threading.Thread(target=job, args=(name, url, output), daemon=True) for name, (url, output) in jobs.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.monotonic() - started
+    return {'results': results, 'started_at': started_at, 'wall': wall, 'cpu': meter.cpu, 'peak_rss': meter.peak_rss}
+
+
+def bench_engine(cdn: StandInCDN, engine: str, protocol: str, concurrency: int, work_dir: str) -> dict:
+    runner = get_runner(engine)
+    manifest = 'hls/index.m3u8' if protocol == 'hls' else 'dash/manifest.mpd'
+    output_dir = os.path.join(work_dir, f'{engine}_{protocol}_{concurrency}')
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = {}
+    for index in range(concurrency):
+        name = f'{engine}-{protocol}-{concurrency}-{index}'
+        jobs[name] = (f'{cdn.base_url}/{name}/{manifest}', os.path.join(output_dir, f'{name}.mp4'))
+    cdn.reset()
+    faults_before = collections.Counter(cdn.stats()['faults'])
+    try:
+        measured = run_in_worker(lambda: run_jobs(runner, jobs, protocol), f'{P.package_name}_bench_{engine}')
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    stats = cdn.stats()
+    served = sum(stat['bytes'] for stat in stats['jobs'].values())
+    started_at = measured['started_at']
+    ttfbs = [(stats['jobs'][name]['first'] - started_at[name]) * 1000 for name in started_at if (stats['jobs'].get(name) or {}).get('first')]
+    wall = measured['wall']
+    return {
+        'engine': engine,
+        'protocol': protocol,
+        'concurrency': concurrency,
+        'ok': sum(1 for result in measured['results'].values() if result),
+        'failed': sum(1 for result in measured['results'].values() if not result),
+        'wall_second': round(wall, 2),
+        'served_mb': round(served / 1024 / 1024, 2),
+        'throughput_mbps': round(served * 8 / 1000 / 1000 / wall, 2) if wall else 0,
+        'ttfb_ms': round(sum(ttfbs) / len(ttfbs), 1) if ttfbs else None,
+        'requests': sum(stat['requests'] for stat in stats['jobs'].values()),
+        'cpu_second': round(measured['cpu'], 2),
+        'peak_rss_mb': round(measured['peak_rss'] / 1024 / 1024, 1),
+        'faults': dict(collections.Counter(stats['faults']) - faults_before),
+    }
+
+
+class CDNBenchmark:
+    '''다운로드 엔진별, 동시 실행 수별 처리량 측정'''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last_report = None
+
+    @property
+    def report_dir(self) -> str:
+        return os.path.join(F.config['path_data'], P.package_name, 'benchmark')
+
+    @property
+    def running(self) -> bool:
+        return bool(self.thread and self.thread.is_alive())
+
+    def start(self, options: dict) -> None:
+        with self.lock:
+            if self.running:
+                raise Exception('이미 실행 중입니다.')
+            self.thread = threading.Thread(target=self.run, args=(options,), name=f'{P.package_name}_cdn_bench', daemon=True)
+            self.thread.start()
+
+    def run(self, options: dict) -> dict | None:
+        '''
+        options:
+            engines, protocols, concurrency: list
+            duration: 테스트 영상 길이(초)
+            latency_ms, bandwidth_kbps: 0이면 제한 없음
+            forbidden, timeout, truncate: 세그먼트 요청별 오류 확률
+        '''
+        engines = options.get('engines') or list(ENGINES)
+        protocols = options.get('protocols') or ['hls', 'dash']
+        levels = options.get('concurrency') or [1, 2, 4]
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            logger.error('CDN benchmark needs fork to run the CDN and the engines in separate processes')
+            return None
+        work_dir = tempfile.mkdtemp(prefix=f'{P.package_name}_bench_')
+        faults = Faults(
+            forbidden=float(options.get('forbidden') or 0),
+            timeout=float(options.get('timeout') or 0),
+            truncate=float(options.get('truncate') or 0),
+        )
+        cdn = None
+        try:
+            media_dir = os.path.join(work_dir, 'media')
+            make_media(media_dir, duration=int(options.get('duration') or 60))
+            cdn = StandInCDN(media_dir, int(options.get('latency_ms') or 0), int(options.get('bandwidth_kbps') or 0), faults).start()
+            results = []
+            for engine in engines:
+                for protocol in protocols:
+                    for concurrency in levels:
+                        result = bench_engine(cdn, engine, protocol, int(concurrency), work_dir)
+                        if not result['ok'] and not result['requests']:
+                            # 지원하지 않는 조합
+                            continue
+                        logger.info(f'CDN benchmark: {json.dumps(result)}')
+                        results.append(result)
+            report = {
+                'created_time': datetime.datetime.now().isoformat(timespec='seconds'),
+                'options': options,
+                'results': results,
+            }
+            os.makedirs(self.report_dir, exist_ok=True)
+            path = os.path.join(self.report_dir, f'cdn-{datetime.datetime.now():%Y%m%d-%H%M%S}.json')
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            logger.info(f'CDN benchmark report: {path}')
+            self.last_report = report
+            return report
+        except Exception:
+            logger.exception('CDN benchmark failed')
+        finally:
+            if cdn:
+                cdn.stop()
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return None
+
+
+CDN_BENCHMARK = CDNBenchmark()
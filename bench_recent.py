@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import random
+import datetime
+import threading
+import statistics
+from typing import Any, Callable
+
+from sqlalchemy import event
+from werkzeug.datastructures import MultiDict
+
+from .setup import F, P
+from .replay import REPLAY, seed_recent_rows
+
+
+logger = P.logger
+CHANNELS = ('KBS 1TV', 'KBS 2TV', 'MBC', 'SBS', 'JTBC', 'tvN', 'MBN', 'TV CHOSUN', 'Mnet', 'ENA', 'EBS 1TV', 'OCN')
+GENRES = ('드라마', '예능', '시사교양', '해외시리즈', '애니메이션', '스포츠', '키즈')
+WORDS = ('나', '혼자', '산다', '런닝맨', '뉴스', '사랑', '비밀', '가족', '여행', '요리', '음악', '쇼', '특집', '스페셜', '시즌')
+
+
+def make_recent(index: int, rng: random.Random) -> dict:
+    '''recent_json 형식의 가짜 데이터'''
+    title = ' '.join(rng.sample(WORDS, rng.randint(1, 3))) + f' {index % 500}'
+    onair = rng.random() < 0.1
+    return {
+        'contentid': f'S01_V{index:010d}',
+        'programid': f'S01_P{index % 500:06d}',
+        'programtitle': title,
+        'episodenumber': str(rng.randint(1, 300)),
+        'episodetitle': f'Quick VOD {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d} 방송' if onair else f'{title} {rng.randint(1, 300)}회',
+        'channelname': rng.choice(CHANNELS),
+        'releasedate': (datetime.date.today() - datetime.timedelta(days=rng.randint(0, 3))).isoformat(),
+        'image': f'image.wavve.com/v1/thumbnails/480_270_20_80/BMS/program_poster/S01/{index}.jpg',
+        'type': 'onair' if onair else 'general',
+    }
+
+
+def make_contents(recent: dict, rng: random.Random) -> dict:
+    return {
+        **recent,
+        'genretext': rng.choice(GENRES),
+        'drms': 'wm' if rng.random() < 0.3 else '',
+        'playtime': str(rng.randint(600, 5400)),
+        'programimage': recent['image'].replace('thumbnails', 'programs'),
+        'qualities': {'list': [{'id': '1080p'}, {'id': '720p'}, {'id': '480p'}]},
+        'targetage': '15',
+        'synopsis': '줄거리 ' * rng.randint(20, 80),
+    }
+
+
+def make_streaming(recent: dict, quality: str) -> dict:
+    return {
+        'quality': quality,
+        'playurl': f'https://vod.cdn.wavve.com/hls/{recent["contentid"]}/{quality}/chunklist.m3u8?authtoken=exp={int(time.time()) + 3600}~acl=%2f*~hmac=0',
+        'play_info': {'headers': {}, 'drm_key_request_properties': None, 'drm_license_uri': None},
+        'drm': None,
+        'subtitles': [],
+    }
+
+
+def timing(samples: list[float]) -> dict:
+    '''초 단위 측정값을 요약'''
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'total_ms': round(sum(samples) * 1000, 2),
+        'mean_us': round(statistics.fmean(samples) * 1000000, 1) if samples else None,
+        'p50_us': round(samples[len(samples) // 2] * 1000000, 1) if samples else None,
+        'p95_us': round(samples[int(len(samples) * 0.95)] * 1000000, 1) if samples else None,
+    }
+
+
+class QueryCounter:
+
+    def __init__(self, engine: Any) -> None:
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.on_query)
+
+    def on_query(self, *args: Any) -> None:
+        self.count += 1
+
+
+def measure(counter: QueryCounter, func: Callable, items: list) -> dict:
+    samples = []
+    queries = counter.count
+    for item in items:
+        started = time.perf_counter()
+        func(item)
+        samples.append(time.perf_counter() - started)
+    result = timing(samples)
+    result['queries'] = counter.count - queries
+    return result
+
+
+class RecentBenchmark:
+    '''최근방송 모듈의 매 스케쥴마다 실행되는 부분을 측정'''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last_report = None
+
+    @property
+    def report_dir(self) -> str:
+        return os.path.join(F.config['path_data'], P.package_name, 'benchmark')
+
+    @property
+    def running(self) -> bool:
+        return bool(self.thread and self.thread.is_alive())
+
+    def start(self, module: object, model: type, pager: object, options: dict) -> None:
+        with self.lock:
+            if self.running:
+                raise Exception('이미 실행 중입니다.')
+            self.thread = threading.Thread(target=self.run, args=(module, model, pager, options), name=f'{P.package_name}_recent_bench', daemon=True)
+            self.thread.start()
+
+    def bench_setters(self, model: type, counter: QueryCounter, recents: list[dict], rng: random.Random) -> dict:
+        vods = []
+        results = {}
+        results['set_info'] = measure(counter, lambda recent: vods.append(model('recent', info=recent)), recents)
+        contents = {vod.contentid: make_contents(recent, rng) for vod, recent in zip(vods, recents)}
+        results['set_contents_json'] = measure(counter, lambda vod: vod.set_contents_json(contents[vod.contentid]), vods)
+        results['set_streaming'] = measure(counter, lambda vod: vod.set_streaming(make_streaming(vod.recent_json, '1080p')), vods)
+        return results
+
+    def bench_pick_out(self, module: object, model: type, counter: QueryCounter, recents: list[dict], list_size: int, rng: random.Random) -> dict:
+        vods = []
+        for recent in recents:
+            vod = model('recent', info=recent, contents=make_contents(recent, rng), streaming=make_streaming(recent, '1080p'))
+            vod.created_time = datetime.datetime.now()
+            vods.append(vod)
+        base = module.pick_out_settings
+        programs = [f'{rng.choice(WORDS)}{rng.choice(WORDS)}{index}' for index in range(list_size)]
+        results = {}
+        for mode in ('blacklist', 'whitelist'):
+            settings = dict(base)
+            settings.update({
+                'download_mode': mode,
+                'quality': '1080p',
+                'except_channel': [f'채널{index}' for index in range(list_size // 10)] + ['OCN'],
+                'except_program': programs,
+                'whitelist_program': programs,
+                'except_program_genres': ['키즈'],
+                'whitelist_program_genres': ['드라마'],
+            })
+            results[mode] = measure(counter, lambda vod: module.pick_out_recent_vod(vod, settings), vods)
+            results[mode]['list_size'] = list_size
+        return results
+
+    def bench_save(self, module: object, counter: QueryCounter, recents: list[dict]) -> dict:
+        results = {}
+        # 처음 저장, 이미 있는 항목 갱신
+        for name in ('insert', 'update'):
+            queries = counter.count
+            started = time.perf_counter()
+            module.save_recent_vods(recents)
+            elapsed = time.perf_counter() - started
+            results[name] = {
+                'n': len(recents),
+                'total_ms': round(elapsed * 1000, 2),
+                'mean_us': round(elapsed / len(recents) * 1000000, 1) if recents else None,
+                'queries': counter.count - queries,
+            }
+        return results
+
+    def bench_paging(self, pager: object, counter: QueryCounter) -> dict:
+        results = {}
+        cases = [('page_1', {'page': '1'}), ('page_2', {'page': '2'}), ('page_10', {'page': '10'}), ('page_100', {'page': '100'})]
+        cases += [('completed', {'page': '1', 'option1': 'completed'}), ('search', {'page': '1', 'keyword': '런닝맨'}), ('search_short', {'page': '1', 'keyword': '나'})]
+        for name, form in cases:
+            req = type('Request', (), {'form': MultiDict(form)})()
+            samples = []
+            queries = counter.count
+            for _ in range(5):
+                started = time.perf_counter()
+                pager.web_list(req)
+                samples.append(time.perf_counter() - started)
+            results[name] = timing(samples)
+            results[name]['queries'] = counter.count - queries
+        return results
+
+    def run(self, module: object, model: type, pager: object, options: dict) -> dict | None:
+        '''
+        options:
+            sizes: 목록 표시를 측정할 테이블 크기
+            items: 단위 작업 반복 수
+            list_size: 블랙/화이트리스트 항목 수
+        '''
+        sizes = [int(size) for size in options.get('sizes') or (1000, 10000, 100000)]
+        items = int(options.get('items') or 1000)
+        list_size = int(options.get('list_size') or 2000)
+        rng = random.Random(0)
+        recents = [make_recent(index, rng) for index in range(items)]
+        report = {
+            'created_time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'options': {'sizes': sizes, 'items': items, 'list_size': list_size},
+        }
+        def bench(engine: Any) -> dict:
+            counter = QueryCounter(engine)
+            results = {}
+            results['setters'] = self.bench_setters(model, counter, recents, rng)
+            results['pick_out'] = self.bench_pick_out(module, model, counter, recents, list_size, rng)
+            results['save_recent_vods'] = self.bench_save(module, counter, recents)
+            results['paging'] = {}
+            seeded = len(recents)
+            for size in sorted(sizes):
+                if size > seeded:
+                    seeded += seed_recent_rows(model, engine, recents, size - seeded)
+                results['paging'][str(size)] = self.bench_paging(pager, counter)
+            return results
+
+        try:
+            report.update(REPLAY.isolated(bench, 'bench'))
+            os.makedirs(self.report_dir, exist_ok=True)
+            path = os.path.join(self.report_dir, f'recent-{datetime.datetime.now():%Y%m%d-%H%M%S}.json')
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            logger.info(f'Recent benchmark report: {path}')
+            self.last_report = report
+            return report
+        except Exception:
+            logger.exception('Recent benchmark failed')
+        return None
+
+
+RECENT_BENCHMARK = RecentBenchmark()
@@ -0,0 +1,209 @@
+import json
+import zlib
+import sqlite3
+import hashlib
+import datetime
+import threading
+import collections
+from typing import Any, Iterable
+
+from sqlalchemy import select, union
+from sqlalchemy.exc import IntegrityError
+
+from plugin.model_base import ModelBase
+
+from .setup import F, P
+
+
+logger = P.logger
+# (model, column)
+REFERENCES = []
+
+
+def dump_json(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+
+
+class ModelWavveBlob(ModelBase):
+    '''압축한 JSON, 내용이 같으면 한 번만 저장'''
+
+    P = P
+    __tablename__ = f'{P.package_name}_blob'
+    __table_args__ = {'mysql_collate': 'utf8_general_ci'}
+    __bind_key__ = P.package_name
+
+    id = F.db.Column(F.db.Integer, primary_key=True)
+    digest = F.db.Column(F.db.String(64), unique=True, nullable=False)
+    data = F.db.Column(F.db.LargeBinary)
+    size = F.db.Column(F.db.Integer)
+    created_time = F.db.Column(F.db.DateTime)
+    used_time = F.db.Column(F.db.DateTime)
+
+    cache = collections.OrderedDict()
+    cache_lock = threading.Lock()
+    cache_size = 256
+
+    def __init__(self, digest: str, raw: bytes) -> None:
+        self.created_time = self.used_time = datetime.datetime.now()
+        self.digest = digest
+        self.data = zlib.compress(raw)
+        self.size = len(raw)
+
+    @classmethod
+    def put(cls, value: Any) -> int | None:
+        if value is None:
+            return None
+        raw = dump_json(value)
+        digest = hashlib.sha256(raw).hexdigest()
+        now = datetime.datetime.now()
+        with F.app.app_context():
+            for _ in range(2):
+                row = F.db.session.query(cls.id, cls.used_time).filter_by(digest=digest).first()
+                if row:
+                    # 정리 대상에서 제외
+                    if row.used_time is None or row.used_time + datetime.timedelta(hours=1) < now:
+                        F.db.session.query(cls).filter_by(id=row.id).update({'used_time': now})
+                        F.db.session.commit()
+                    return row.id
+                blob = cls(digest, raw)
+                try:
+                    F.db.session.add(blob)
+                    F.db.session.commit()
+                    return blob.id
+                except IntegrityError:
+                    # 다른 스레드가 먼저 저장
+                    F.db.session.rollback()
+        return None
+
+    @classmethod
+    def load(cls, blob_id: int | None) -> Any:
+        if not blob_id:
+            return None
+        with cls.cache_lock:
+            if blob_id in cls.cache:
+                cls.cache.move_to_end(blob_id)
+                return json.loads(cls.cache[blob_id])
+        with F.app.app_context():
+            data = F.db.session.query(cls.data).filter_by(id=blob_id).scalar()
+        if data is None:
+            logger.warning(f'Missing blob: {blob_id}')
+            return None
+        raw = zlib.decompress(data)
+        with cls.cache_lock:
+            cls.cache[blob_id] = raw
+            while len(cls.cache) > cls.cache_size:
+                cls.cache.popitem(last=False)
+        return json.loads(raw)
+
+    @classmethod
+    def prune(cls, hours: int = 24) -> int:
+        '''어디에서도 참조하지 않는 blob 삭제'''
+        if not REFERENCES:
+            return 0
+        expired = datetime.datetime.now() - datetime.timedelta(hours=hours)
+        with F.app.app_context():
+            referenced = union(*(
+                select(getattr(model, column)).where(getattr(model, column) != None)
+                for model, column in REFERENCES
+            ))
+            count = F.db.session.query(cls) \
+                .filter(cls.used_time < expired) \
+                .filter(cls.id.notin_(referenced)) \
+                .delete(synchronize_session=False)
+            F.db.session.commit()
+        if count:
+            logger.debug(f'Pruned blobs: {count}')
+        return count
+
+
+class BlobField:
+    '''JSON 값은 ModelWavveBlob에 두고 접근할 때 읽음'''
+
+    def __init__(self, column: str) -> None:
+        self.column = column
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.name = name
+        self.attribute = f'_{name}_value'
+        REFERENCES.append((owner, self.column))
+
+    def __get__(self, instance: Any, owner: type) -> Any:
+        if instance is None:
+            return self
+        blob_id = getattr(instance, self.column)
+        cached = instance.__dict__.get(self.attribute)
+        if cached and cached[0] == blob_id:
+            return cached[1]
+        value = ModelWavveBlob.load(blob_id)
+        instance.__dict__[self.attribute] = (blob_id, value)
+        return value
+
+    def __set__(self, instance: Any, value: Any) -> None:
+        blob_id = ModelWavveBlob.put(value)
+        setattr(instance, self.column, blob_id)
+        instance.__dict__[self.attribute] = (blob_id, value)
+
+
+def migrate_json_columns(cs: sqlite3.Cursor, table: str, columns: tuple[str]) -> None:
+    '''JSON 컬럼을 blob 테이블로 옮기고 삭제'''
+    cs.execute(
+        f'CREATE TABLE IF NOT EXISTS "{ModelWavveBlob.__tablename__}" ('
+        'id INTEGER NOT NULL PRIMARY KEY, digest VARCHAR(64) NOT NULL UNIQUE, data BLOB, '
+        'size INTEGER, created_time DATETIME, used_time DATETIME)'
+    )
+    cols = [row[0] for row in cs.execute(f'SELECT name FROM pragma_table_info("{table}")').fetchall()]
+    now = str(datetime.datetime.now())
+    for column in columns:
+        if column not in cols:
+            continue
+        blob_column = f'{column.removesuffix("_json")}_blob_id'
+        if blob_column not in cols:
+            cs.execute(f'ALTER TABLE "{table}" ADD COLUMN "{blob_column}" INTEGER')
+        last_id = 0
+        count = 0
+        while rows := cs.execute(f'SELECT id, "{column}" FROM "{table}" WHERE id > ? ORDER BY id LIMIT 500', (last_id,)).fetchall():
+            for row_id, text in rows:
+                last_id = row_id
+                try:
+                    value = json.loads(text) if text else None
+                except Exception:
+                    value = None
+                if value is None:
+                    continue
+                raw = dump_json(value)
+                digest = hashlib.sha256(raw).hexdigest()
+                cs.execute(
+                    f'INSERT OR IGNORE INTO "{ModelWavveBlob.__tablename__}" (digest, data, size, created_time, used_time) VALUES (?, ?, ?, ?, ?)',
+                    (digest, zlib.compress(raw), len(raw), now, now)
+                )
+                blob_id = cs.execute(f'SELECT id FROM "{ModelWavveBlob.__tablename__}" WHERE digest = ?', (digest,)).fetchone()[0]
+                cs.execute(f'UPDATE "{table}" SET "{blob_column}" = ? WHERE id = ?', (blob_id, row_id))
+                count += 1
+        cs.execute(f'ALTER TABLE "{table}" DROP COLUMN "{column}"')
+        logger.info(f'Moved {count} rows of {table}.{column} to {ModelWavveBlob.__tablename__}')
+
+
+def add_columns(cs: sqlite3.Cursor, table: str, columns: tuple[str], type_: str = 'VARCHAR') -> None:
+    '''없는 컬럼만 추가'''
+    cols = [row[0] for row in cs.execute(f'SELECT name FROM pragma_table_info("{table}")').fetchall()]
+    for column in columns:
+        if column not in cols:
+            cs.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {type_}')
+
+
+def iter_blob_values(cs: sqlite3.Cursor, table: str, blob_column: str) -> Iterable[tuple[int, Any]]:
+    '''(id, JSON 값), 500개씩 읽음'''
+    last_id = 0
+    while rows := cs.execute(
+        f'SELECT t.id, b.data FROM "{table}" AS t JOIN "{ModelWavveBlob.__tablename__}" AS b ON b.id = t."{blob_column}" '
+        'WHERE t.id > ? ORDER BY t.id LIMIT 500',
+        (last_id,)
+    ).fetchall():
+        for row_id, data in rows:
+            last_id = row_id
+            try:
+                value = json.loads(zlib.decompress(data))
+            except Exception:
+                continue
+            if isinstance(value, dict):
+                yield row_id, value
@@ -0,0 +1,213 @@
+import time
+import threading
+import urllib.parse
+import concurrent.futures
+
+import requests
+
+from .setup import P
+from .metrics import CDN_DEMOTED, CDN_TTFB
+
+
+logger = P.logger
+settings = P.ModelSetting
+# 이전 기록의 가중치
+DECAY = 0.8
+# 비교할 때 쓰는 세그먼트 크기
+REFERENCE_BYTES = 4 * 1024 * 1024
+# 기록이 없을 때 가정하는 값
+DEFAULT_TTFB = 0.5
+DEFAULT_THROUGHPUT = 2 * 1024 * 1024
+# 연속으로 실패하면 잠시 제외
+FAILURE_LIMIT = 3
+# 오류율이 이보다 높으면 잠시 제외
+ERROR_LIMIT = 0.5
+MIN_SAMPLES = 5
+PROBE_INTERVAL = 300
+PROBE_TIMEOUT = 5
+PROBE_BYTES = 64 * 1024
+# 응답 첫 부분으로 확인
+MANIFEST_MARKERS = {
+    '.mpd': b'<MPD',
+    '.m3u8': b'#EXTM3U',
+}
+
+
+class HostStats:
+
+    def __init__(self) -> None:
+        self.throughput = None
+        self.ttfb = None
+        self.error = 0.0
+        self.samples = 0
+        self.failures = 0
+        self.probed = 0.0
+        self.demoted_until = 0.0
+        self.reason = ''
+
+    @property
+    def demoted(self) -> bool:
+        return self.demoted_until > time.monotonic()
+
+    def update(self, attribute: str, value: float) -> None:
+        old = getattr(self, attribute)
+        setattr(self, attribute, value if old is None else old * DECAY + value * (1 - DECAY))
+
+
+class CdnTracker:
+    '''
+    CDN 호스트별 처리량, 첫 응답 시간, 오류율
+    같은 경로를 제공하는 호스트 중 점수가 좋은 곳으로 재생 주소를 바꿈
+    '''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # key: host
+        self.hosts = {}
+        self.groups_source = None
+        # key: host, value: 같은 그룹의 호스트
+        self.groups = {}
+
+    def stats(self, host: str) -> HostStats:
+        if not (stats := self.hosts.get(host)):
+            stats = self.hosts[host] = HostStats()
+        return stats
+
+    @property
+    def cooldown(self) -> int:
+        try:
+            return max(settings.get_int('basic_cdn_cooldown_minute'), 0) * 60
+        except Exception:
+            return 600
+
+    def alternatives(self, host: str) -> list[str]:
+        '''설정: 한 줄에 같은 경로를 제공하는 호스트를 쉼표로 구분'''
+        source = settings.get('basic_cdn_hosts') or ''
+        with self.lock:
+            if source != self.groups_source:
+                self.groups = {}
+                for line in source.splitlines():
+                    group = [item.strip().lower() for item in line.split(',') if item.strip()]
+                    for item in group:
+                        self.groups[item] = group
+                self.groups_source = source
+            return list(self.groups.get(host, (host,)))
+
+    def demote(self, host: str, reason: str) -> None:
+        if not (cooldown := self.cooldown):
+            return
+        with self.lock:
+            stats = self.stats(host)
+            if not stats.demoted:
+                logger.warning(f'Demoting CDN host for {cooldown}s: {host} ({reason})')
+            stats.demoted_until = time.monotonic() + cooldown
+            stats.reason = reason
+
+    def record(self, url: str, success: bool, size: int = 0, elapsed: float = 0.0) -> None:
+        '''끝난 다운로드의 결과'''
+        if not (host := urllib.parse.urlparse(url or '').hostname):
+            return
+        with self.lock:
+            stats = self.stats(host)
+            stats.samples += 1
+            stats.update('error', 0.0 if success else 1.0)
+            if success:
+                stats.failures = 0
+                if size and elapsed > 0:
+                    stats.update('throughput', size / elapsed)
+            else:
+                stats.failures += 1
+            if success:
+                return
+            if stats.failures >= FAILURE_LIMIT:
+                reason = f'{stats.failures} failures in a row'
+            elif stats.samples >= MIN_SAMPLES and stats.error > ERROR_LIMIT:
+                reason = f'error rate {stats.error:.2f}'
+            else:
+                return
+        self.demote(host, reason)
+
+    def cost(self, host: str) -> float:
+        '''기준 크기를 한 번 성공적으로 받는 데 걸릴 것으로 예상되는 시간'''
+        stats = self.hosts.get(host) or HostStats()
+        known = [item.throughput for item in self.hosts.values() if item.throughput]
+        throughput = stats.throughput or (sum(known) / len(known) if known else DEFAULT_THROUGHPUT)
+        ttfb = DEFAULT_TTFB if stats.ttfb is None else stats.ttfb
+        return (ttfb + REFERENCE_BYTES / throughput) / max(1.0 - stats.error, 0.05)
+
+    def probe(self, url: str, headers: dict | None, proxies: dict | None) -> float | None:
+        '''첫 응답 시간, 실패하면 None'''
+        parsed = urllib.parse.urlparse(url)
+        headers = dict(headers or {})
+        if 'Host' in headers:
+            headers['Host'] = parsed.netloc
+        try:
+            started = time.monotonic()
+            with requests.get(url, headers=headers, proxies=proxies, timeout=PROBE_TIMEOUT, stream=True) as response:
+                ttfb = time.monotonic() - started
+                response.raise_for_status()
+                head = next(response.iter_content(PROBE_BYTES), b'')
+            for suffix, marker in MANIFEST_MARKERS.items():
+                # 일부 CDN은 잘못된 XML로 응답함
+                if parsed.path.endswith(suffix) and marker not in head:
+                    raise Exception(f'invalid {suffix} response')
+        except Exception as e:
+            logger.debug(f'Probing CDN host failed: {parsed.hostname}: {e}')
+            self.demote(parsed.hostname, f'probe: {e}')
+            return None
+        with self.lock:
+            stats = self.stats(parsed.hostname)
+            stats.update('ttfb', ttfb)
+            stats.probed = time.monotonic()
+        return ttfb
+
+    def select(self, url: str, headers: dict | None = None, proxies: dict | None = None) -> str:
+        '''점수가 가장 좋은 호스트의 주소'''
+        parsed = urllib.parse.urlparse(url or '')
+        if not parsed.hostname or len(hosts := self.alternatives(parsed.hostname)) < 2:
+            return url
+        urls = {host: parsed._replace(netloc=host if parsed.port is None else f'{host}:{parsed.port}').geturl() for host in hosts}
+        with self.lock:
+            candidates = [host for host in hosts if not self.stats(host).demoted]
+            stale = [host for host in candidates if time.monotonic() - self.stats(host).probed > PROBE_INTERVAL]
+        if stale:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(stale)) as executor:
+                for host in stale:
+                    executor.submit(self.probe, urls[host], headers, proxies)
+        with self.lock:
+            candidates = [host for host in candidates if not self.stats(host).demoted]
+            if not candidates:
+                return url
+            best = min(candidates, key=self.cost)
+        if best != parsed.hostname:
+            logger.debug(f'Selected CDN host: {best} instead of {parsed.hostname}')
+            if isinstance(headers, dict) and 'Host' in headers:
+                headers['Host'] = urllib.parse.urlparse(urls[best]).netloc
+        return urls[best]
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                host: {
+                    'throughput': round(stats.throughput) if stats.throughput else None,
+                    'ttfb': round(stats.ttfb, 3) if stats.ttfb is not None else None,
+                    'error': round(stats.error, 2),
+                    'samples': stats.samples,
+                    'demoted': round(stats.demoted_until - time.monotonic()) if stats.demoted else 0,
+                    'reason': stats.reason if stats.demoted else '',
+                }
+                for host, stats in sorted(self.hosts.items())
+            }
+
+    def collect_demoted(self) -> list[tuple[dict, int]]:
+        with self.lock:
+            return [({'host': host}, int(stats.demoted)) for host, stats in self.hosts.items()]
+
+    def collect_ttfb(self) -> list[tuple[dict, float]]:
+        with self.lock:
+            return [({'host': host}, stats.ttfb) for host, stats in self.hosts.items() if stats.ttfb is not None]
+
+
+CDN = CdnTracker()
+CDN_DEMOTED.collect(CDN.collect_demoted)
+CDN_TTFB.collect(CDN.collect_ttfb)
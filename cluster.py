@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import socket
+import threading
+from typing import Any, Callable
+
+import sqlalchemy
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import StaticPool
+
+from .setup import F, P
+
+
+logger = P.logger
+settings = P.ModelSetting
+METADATA = sqlalchemy.MetaData()
+'''
+status
+
+waiting: 대기
+leased: 노드에서 처리중
+completed: 완료
+failed: 실패
+'''
+JOBS = sqlalchemy.Table(
+    f'{P.package_name}_cluster_job', METADATA,
+    sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('job_key', sqlalchemy.String(255), unique=True, nullable=False),
+    sqlalchemy.Column('module', sqlalchemy.String(32), nullable=False, index=True),
+    sqlalchemy.Column('contentid', sqlalchemy.String(64)),
+    sqlalchemy.Column('quality', sqlalchemy.String(16)),
+    sqlalchemy.Column('payload', sqlalchemy.Text),
+    sqlalchemy.Column('status', sqlalchemy.String(16), nullable=False, index=True),
+    sqlalchemy.Column('owner', sqlalchemy.String(128)),
+    sqlalchemy.Column('attempts', sqlalchemy.Integer, default=0),
+    sqlalchemy.Column('lease_until', sqlalchemy.Float, default=0),
+    sqlalchemy.Column('created_time', sqlalchemy.Float),
+    sqlalchemy.Column('updated_time', sqlalchemy.Float),
+)
+LOCKS = sqlalchemy.Table(
+    f'{P.package_name}_cluster_lock', METADATA,
+    sqlalchemy.Column('name', sqlalchemy.String(64), primary_key=True),
+    sqlalchemy.Column('owner', sqlalchemy.String(128)),
+    sqlalchemy.Column('expires', sqlalchemy.Float),
+)
+
+
+def make_job_key(module: str, contentid: str, quality: str) -> str:
+    return f'{module}:{contentid}:{quality}'
+
+
+class ClusterNode:
+    '''여러 서버가 공유 작업 목록에서 다운로드 작업을 나눠 가짐'''
+
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.event = threading.Event()
+        self.thread = None
+        self.engine = None
+        self.url = None
+        self.leader_until = 0.0
+        # job_key
+        self.held = set()
+        # module: (capacity, handle)
+        self.subscribers = {}
+
+    @property
+    def enabled(self) -> bool:
+        try:
+            return settings.get_bool('basic_cluster_enabled')
+        except Exception:
+            return False
+
+    @property
+    def node_id(self) -> str:
+        return settings.get('basic_cluster_node_id') or socket.gethostname()
+
+    @property
+    def lease_second(self) -> int:
+        try:
+            return max(settings.get_int('basic_cluster_lease_second'), 30)
+        except Exception:
+            return 120
+
+    @property
+    def max_attempts(self) -> int:
+        try:
+            return max(settings.get_int('basic_cluster_max_attempts'), 1)
+        except Exception:
+            return 5
+
+    def get_engine(self) -> sqlalchemy.engine.Engine:
+        '''
+        공유 볼륨의 SQLite 혹은 다른 SQLAlchemy URL
+        sqlite:// 는 메모리 DB (단일 서버 시험용)
+        '''
+        url = settings.get('basic_cluster_db_url') or 'sqlite:///' + os.path.join(F.config['path_data'], 'db', f'{P.package_name}_cluster.db')
+        with self.lock:
+            if self.engine is None or self.url != url:
+                if self.engine is not None:
+                    self.engine.dispose()
+                options = {}
+                if url.startswith('sqlite'):
+                    options['connect_args'] = {'check_same_thread': False, 'timeout': 30}
+                    if url in ('sqlite://', 'sqlite:///:memory:'):
+                        options['poolclass'] = StaticPool
+                self.engine = sqlalchemy.create_engine(url, **options)
+                METADATA.create_all(self.engine)
+                self.url = url
+                self.leader_until = 0.0
+            return self.engine
+
+    def start(self) -> None:
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.run, name=f'{P.package_name}_cluster', daemon=True)
+        self.thread.start()
+
+    def wake(self) -> None:
+        self.event.set()
+
+    def run(self) -> None:
+        while True:
+            if self.enabled:
+                try:
+                    self.heartbeat()
+                    for module, (capacity, handle) in list(self.subscribers.items()):
+                        for job in self.claim(module, capacity()):
+                            try:
+                                handle(job)
+                            except Exception:
+                                logger.exception(f'Handling job failed: {job["job_key"]}')
+                                self.finish(module, job['contentid'], job['quality'], None)
+                except Exception:
+                    logger.exception('Cluster heartbeat failed')
+            self.event.wait(max(self.lease_second // 3, 5))
+            self.event.clear()
+
+    def subscribe(self, module: str, capacity: Callable[[], int], handle: Callable[[dict], Any]) -> None:
+        '''heartbeat 마다 capacity() 만큼 작업을 가져와서 handle(job)'''
+        self.subscribers[module] = (capacity, handle)
+
+    def heartbeat(self) -> None:
+        now = time.time()
+        with self.lock:
+            held = list(self.held)
+        if held:
+            with self.get_engine().begin() as conn:
+                result = conn.execute(
+                    JOBS.update()
+                    .where(JOBS.c.job_key.in_(held), JOBS.c.owner == self.node_id, JOBS.c.status == 'leased')
+                    .values(lease_until=now + self.lease_second, updated_time=now)
+                )
+            if result.rowcount < len(held):
+                logger.warning(f'Some leases are lost: renewed={result.rowcount} held={len(held)}')
+        self.elect()
+
+    def elect(self) -> bool:
+        '''탐색, 스케쥴링은 선출된 노드 하나만 실행'''
+        now = time.time()
+        expires = now + self.lease_second
+        engine = self.get_engine()
+        with engine.begin() as conn:
+            result = conn.execute(
+                LOCKS.update()
+                .where(LOCKS.c.name == 'leader', or_(LOCKS.c.owner == self.node_id, LOCKS.c.expires < now))
+                .values(owner=self.node_id, expires=expires)
+            )
+            elected = result.rowcount > 0
+        if not elected:
+            try:
+                with engine.begin() as conn:
+                    conn.execute(LOCKS.insert().values(name='leader', owner=self.node_id, expires=expires))
+                elected = True
+            except IntegrityError:
+                elected = False
+        if elected and self.leader_until <= now:
+            logger.info(f'Elected as the leader: {self.node_id}')
+        self.leader_until = expires if elected else 0.0
+        return elected
+
+    @property
+    def is_leader(self) -> bool:
+        if not self.enabled:
+            return True
+        # 만료 직전이면 다시 확인
+        if self.leader_until - self.lease_second / 3 > time.time():
+            return True
+        try:
+            return self.elect()
+        except Exception:
+            logger.exception('Leader election failed')
+            return False
+
+    def publish(self, module: str, contentid: str, quality: str, payload: dict) -> str:
+        '''
+        작업 등록 후 현재 상태를 반환
+        실패한 작업은 다시 대기 상태로 돌림
+        '''
+        now = time.time()
+        job_key = make_job_key(module, contentid, quality)
+        data = json.dumps(payload, ensure_ascii=False, default=str)
+        engine = self.get_engine()
+        with engine.begin() as conn:
+            row = conn.execute(sqlalchemy.select(JOBS.c.status).where(JOBS.c.job_key == job_key)).first()
+            if row:
+                match row.status:
+                    case 'waiting':
+                        conn.execute(JOBS.update().where(JOBS.c.job_key == job_key, JOBS.c.status == 'waiting').values(payload=data, updated_time=now))
+                    case 'failed':
+                        conn.execute(JOBS.update().where(JOBS.c.job_key == job_key).values(
+                            payload=data, status='waiting', owner=None, attempts=0, lease_until=0, updated_time=now))
+                return row.status
+        try:
+            with engine.begin() as conn:
+                conn.execute(JOBS.insert().values(
+                    job_key=job_key, module=module, contentid=contentid, quality=quality, payload=data,
+                    status='waiting', attempts=0, lease_until=0, created_time=now, updated_time=now))
+        except IntegrityError:
+            # 다른 노드가 먼저 등록
+            pass
+        self.wake()
+        return 'waiting'
+
+    def claim(self, module: str, limit: int) -> list[dict]:
+        '''대기중이거나 임대가 만료된 작업을 가져옴'''
+        if limit <= 0:
+            return []
+        now = time.time()
+        claimable = and_(
+            JOBS.c.module == module,
+            JOBS.c.attempts < self.max_attempts,
+            or_(JOBS.c.status == 'waiting', and_(JOBS.c.status == 'leased', JOBS.c.lease_until < now)),
+        )
+        engine = self.get_engine()
+        with engine.connect() as conn:
+            rows = conn.execute(sqlalchemy.select(JOBS).where(claimable).order_by(JOBS.c.id).limit(limit * 2)).all()
+        claimed = []
+        for row in rows:
+            if len(claimed) >= limit:
+                break
+            with engine.begin() as conn:
+                result = conn.execute(
+                    JOBS.update()
+                    .where(JOBS.c.id == row.id, claimable)
+                    .values(status='leased', owner=self.node_id, attempts=JOBS.c.attempts + 1,
+                            lease_until=now + self.lease_second, updated_time=now)
+                )
+            if result.rowcount != 1:
+                continue
+            if row.status == 'leased':
+                logger.warning(f'Reclaimed an expired lease: {row.job_key} from {row.owner}')
+            with self.lock:
+                self.held.add(row.job_key)
+            job = dict(row._mapping)
+            try:
+                job['payload'] = json.loads(row.payload or '{}')
+            except Exception:
+                job['payload'] = {}
+            claimed.append(job)
+        if claimed:
+            logger.debug(f'Claimed jobs: {[job["job_key"] for job in claimed]}')
+        return claimed
+
+    def finish(self, module: str, contentid: str, quality: str, completed: bool | None) -> None:
+        '''completed가 None이면 다른 노드가 가져갈 수 있게 반환'''
+        job_key = make_job_key(module, contentid, quality)
+        with self.lock:
+            if job_key not in self.held:
+                return
+            self.held.discard(job_key)
+        now = time.time()
+        match completed:
+            case True:
+                values = {'status': 'completed'}
+            case False:
+                values = {'status': 'failed'}
+            case _:
+                # 재시도 횟수를 넘으면 실패
+                status = sqlalchemy.case((JOBS.c.attempts >= self.max_attempts, 'failed'), else_='waiting')
+                values = {'status': status, 'owner': None, 'lease_until': 0}
+        try:
+            with self.get_engine().begin() as conn:
+                conn.execute(
+                    JOBS.update()
+                    .where(JOBS.c.job_key == job_key, JOBS.c.owner == self.node_id)
+                    .values(updated_time=now, **values)
+                )
+        except Exception:
+            logger.exception(f'Finishing job failed: {job_key}')
+
+    def status(self) -> dict:
+        with self.get_engine().connect() as conn:
+            rows = conn.execute(
+                sqlalchemy.select(JOBS.c.module, JOBS.c.status, sqlalchemy.func.count())
+                .group_by(JOBS.c.module, JOBS.c.status)
+            ).all()
+            leader = conn.execute(sqlalchemy.select(LOCKS).where(LOCKS.c.name == 'leader')).first()
+        jobs = {}
+        for module, status, count in rows:
+            jobs.setdefault(module, {})[status] = count
+        return {
+            'node_id': self.node_id,
+            'leader': leader.owner if leader and leader.expires > time.time() else None,
+            'held': sorted(self.held),
+            'jobs': jobs,
+        }
+
+
+CLUSTER = ClusterNode()
@@ -7,9 +7,11 @@ import pathlib
 import datetime
 import platform
 import functools
+import threading
+import contextlib
 import subprocess
 import urllib.parse
-from typing import Callable
+from typing import Callable, Iterator
 
 from io import BytesIO
 
@@ -19,7 +21,10 @@ from wv_tool import WVDownloader
 from wv_tool.lib.mpegdash.parser import MPEGDASHParser
 from wv_tool.tool import MP4DECRYPT as WVTOOL_MP4DECRYPT, MKVMERGE as WVTOOL_MKVMERGE
 from support_site import SupportWavve
-from .setup import P
+from .setup import F, P
+from .tracing import TRACES
+from .policy import POLICY
+from .priority import PRIORITY
 
 
 SYSTEM = platform.system().lower()
@@ -39,8 +44,11 @@ def downloadable(func: Callable) -> Callable:
         try:
             if not self.check_file_path():
                 return False
+            self.staged = settings.get_bool('basic_stage_pipeline')
             command = self.get_command(func.__name__)
-            return self.execute_command(command)
+            if not self.staged:
+                return self.execute_command(command)
+            return self.execute_command(command) and self.finish_stages()
         except Exception as e:
             self.logger.exception(str(e))
         finally:
@@ -50,7 +58,139 @@ def downloadable(func: Callable) -> Callable:
     return wrapper
 
 
-class REDownloader(WVDownloader):
+class StageLimiter:
+    '''다운로드 이후 단계(decrypt, mux)의 동시 실행 수 제한'''
+
+    def __init__(self, name: str, setting_key: str, default: int) -> None:
+        self.name = name
+        self.setting_key = setting_key
+        self.default = default
+        self.condition = threading.Condition()
+        self.active = 0
+
+    @property
+    def limit(self) -> int:
+        try:
+            return max(settings.get_int(self.setting_key), 1)
+        except Exception:
+            return self.default
+
+    @contextlib.contextmanager
+    def slot(self) -> Iterator[None]:
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait(10)
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+
+STAGES = {
+    'decrypt': StageLimiter('decrypt', 'basic_decrypt_max_count', 2),
+    'mux': StageLimiter('mux', 'basic_mux_max_count', 1),
+}
+
+
+class KeyCache:
+    '''contentid, KID 별 복호화 키'''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # key: (contentid, kid)
+        self.items = {}
+
+    @property
+    def ttl(self) -> datetime.timedelta:
+        try:
+            minutes = settings.get_int('basic_drm_key_ttl_minute')
+        except Exception:
+            minutes = 360
+        return datetime.timedelta(minutes=minutes)
+
+    @staticmethod
+    def normalize(kid: str) -> str:
+        return (kid or '').replace('-', '').lower()
+
+    def get(self, contentid: str, kids: set[str] = None) -> list[dict] | None:
+        '''
+        kids가 있으면 모두 있을 때만
+        kids를 모르면(HLS, MPD를 아직 받지 않음) 라이센스에서 받았던 키 전부
+        '''
+        now = datetime.datetime.now()
+        with self.lock:
+            for key in [key for key, item in self.items.items() if item['time'] + self.ttl < now]:
+                del self.items[key]
+            if not kids:
+                keys = [item for (cid, _), item in self.items.items() if cid == contentid]
+            elif all((contentid, self.normalize(kid)) in self.items for kid in kids):
+                keys = [self.items[(contentid, self.normalize(kid))] for kid in kids]
+            else:
+                return None
+        return [{'kid': item['kid'], 'key': item['key']} for item in keys] or None
+
+    def put(self, contentid: str, keys: list[dict]) -> None:
+        now = datetime.datetime.now()
+        with self.lock:
+            for key in keys or []:
+                if key.get('kid') and key.get('key'):
+                    self.items[(contentid, self.normalize(key['kid']))] = {'kid': key['kid'], 'key': key['key'], 'time': now}
+
+    def invalidate(self, contentid: str) -> None:
+        with self.lock:
+            for item in [item for item in self.items if item[0] == contentid]:
+                del self.items[item]
+
+
+KEY_CACHE = KeyCache()
+# mpegdash의 ContentProtection: cenc:default_KID, default_KID, ns2:default_KID
+KID_ATTRIBUTES = ('cenc_default_kid', 'default_key_id', 'ns2_key_id')
+
+
+class KeyCacheMixin:
+    '''MPD의 모든 KID에 캐시된 키가 있으면 라이센스 요청을 생략'''
+
+    def default_kids(self) -> set[str]:
+        '''이미 받은 MPD의 default_KID, MPD가 없으면 빈 집합'''
+        kids = set()
+        for period in getattr(getattr(self, 'mpd', None), 'periods', None) or []:
+            for adaptation_set in period.adaptation_sets or []:
+                nodes = [adaptation_set] + list(adaptation_set.representations or [])
+                for protection in (protection for node in nodes for protection in node.content_protections or []):
+                    if kid := next(filter(None, (getattr(protection, name, None) for name in KID_ATTRIBUTES)), None):
+                        kids.add(KeyCache.normalize(kid))
+        return kids
+
+    def prepare(self) -> None:
+        '''override'''
+        config = getattr(self, 'config', None) or {}
+        code = config.get('code')
+        if config.get('license_url') and (keys := KEY_CACHE.get(code, self.default_kids())):
+            self.logger.debug(f'Use cached keys: {code}')
+            self.key = keys
+            return
+        # 미리 받는 경우 trace_id는 작업의 callback_id
+        with TRACES.span(getattr(self, 'trace_id', config.get('callback_id')), 'license'):
+            super().prepare()
+        if config.get('license_url') and getattr(self, 'key', None):
+            KEY_CACHE.put(code, self.key)
+
+    def set_status(self, status: str) -> None:
+        '''override'''
+        if status == 'ERROR':
+            # 키가 잘못됐을 수도 있으니 재시도시 다시 요청
+            KEY_CACHE.invalidate((getattr(self, 'config', None) or {}).get('code'))
+        super().set_status(status)
+
+
+class CachedWVDownloader(KeyCacheMixin, WVDownloader):
+    pass
+
+
+class REDownloader(KeyCacheMixin, WVDownloader):
 
     RE_LOGGING_REGEX = re.compile('\d{2}:\d{2}:\d{2}\.\d{3}\s(\w+)\s?:\s(.+)$')
     RE_LOGGING_LEVEL = {
@@ -89,6 +229,9 @@ class REDownloader(WVDownloader):
                 return False
             pathlib.Path(self.temp_dir).mkdir(parents=True, exist_ok=True)
             output.parent.mkdir(parents=True, exist_ok=True)
+            # 캐시된 키가 MPD의 KID와 맞는지 보려고 먼저 받음
+            if self.streaming_protocol == 'dash' and not self.mpd:
+                self.get_mpd()
             self.prepare()
             self.set_status("DOWNLOADING")
             result = False
@@ -105,7 +248,8 @@ class REDownloader(WVDownloader):
                 self.clean()
             if self._WVDownloader__stop_flag:
                 self.set_status("USER_STOP")
-            elif result and self.status == "DOWNLOADING":
+            # 단계 파이프라인은 먹싱이 마지막 상태
+            elif result and self.status == ("MUXING" if getattr(self, 'staged', False) else "DOWNLOADING"):
                 self.set_status("COMPLETED")
             else:
                 self.set_status("ERROR")
@@ -114,7 +258,12 @@ class REDownloader(WVDownloader):
             self.logger.exception("다운로드 중 오류가 발생했습니다.")
         return False
 
+    @property
+    def track_dir(self) -> pathlib.Path:
+        return pathlib.Path(self.temp_dir) / f'{pathlib.Path(self.output_filepath).stem}.tracks'
+
     def get_command(self, what_for: str = 'download_m3u8') -> list:
+        staged = getattr(self, 'staged', False)
         output_filepath = pathlib.Path(self.output_filepath)
         n_m3u8dl_re = BINARIES['N_m3u8DL-RE'][0]
         ffmpeg = BINARIES['ffmpeg'][0]
@@ -124,6 +273,9 @@ class REDownloader(WVDownloader):
             if binary is None:
                 raise Exception(f"{name} 실행 파일이 없습니다.")
         command = [str(n_m3u8dl_re)]
+        # 호스트 상태와 화질에 따라
+        policy = POLICY.decide(self.mpd_url, self.config.get('quality'))
+        self.logger.debug(f'RE policy: {policy}')
         match what_for:
             case 'download_mpd':
                 # 웨이브는 특정 CDN에서 invalid XML로 응답함
@@ -135,26 +287,34 @@ class REDownloader(WVDownloader):
                 '''
                 command.extend((str(mpd_file), '--base-url', self.mpd_base_url))
                 # --key를 입력하면 --decryption-binary-path 지정이 제대로 동작하지 않아 RE와 동일 경로에 mp4decrypt가 있어야 함
-                for key in self.key:
-                    command.extend(('--key', f'{key["kid"]}:{key["key"]}'))
+                # 단계 분리시 복호화는 다운로드 후에 따로 실행
+                if not staged:
+                    for key in self.key:
+                        command.extend(('--key', f'{key["kid"]}:{key["key"]}'))
             case 'download_m3u8':
                 command.append(self.mpd_url)
-        command.append('--mux-after-done')
-        if output_filepath.suffix == '.mkv':
-            command.append('format=mkv:muxer=mkvmerge')
+        if staged:
+            # 트랙 파일만 받고 먹싱은 별도의 작업으로
+            self.track_dir.mkdir(parents=True, exist_ok=True)
+            command.extend(('--save-dir', str(self.track_dir)))
         else:
-            command.append('format=mp4')
-        command.extend(self.__get_mux_import(output_filepath))
+            command.append('--mux-after-done')
+            if output_filepath.suffix == '.mkv':
+                command.append('format=mkv:muxer=mkvmerge')
+            else:
+                command.append('format=mp4')
+            command.extend(self.__get_mux_import(output_filepath))
+            command.extend(('--save-dir', self.output_dir, '--mp4-real-time-decryption'))
         command.extend((
             '--tmp-dir', self.temp_dir,
-            '--save-dir', self.output_dir,
             '--save-name', output_filepath.stem,
             '--ffmpeg-binary-path', str(ffmpeg),
             '--decryption-binary-path', str(mp4decrypt),
             '--write-meta-json', 'False',
-            '--download-retry-count', '3',
+            '--download-retry-count', str(policy['retries']),
+            '--http-request-timeout', str(policy['timeout']),
+            '--thread-count', str(policy['threads']),
             '--log-level', 'INFO',
-            '--mp4-real-time-decryption',
             '--auto-select',
             '--concurrent-download',
             '--no-log',
@@ -167,13 +327,13 @@ class REDownloader(WVDownloader):
             command.extend(('--custom-proxy', http_proxy))
         return command
 
-    def __get_mux_import(self, file: pathlib.Path) -> list:
+    def get_subtitles(self, file: pathlib.Path) -> list[tuple[pathlib.Path, str, str]]:
         subtitle_files = [
             sub
             for sub in file.parent.iterdir()
             if sub.name.startswith(file.stem) and sub.suffix in {'.srt', '.vtt'}
         ]
-        parameters = []
+        subtitles = []
         for subtitle in subtitle_files:
             if len(subtitle.suffixes) < 2:
                 lang_code = 'und'
@@ -187,10 +347,79 @@ class REDownloader(WVDownloader):
                 else:
                     lang_code = 'und'
                     lang_name = 'Undefined'
+            subtitles.append((subtitle, lang_code, lang_name))
+        return subtitles
+
+    def __get_mux_import(self, file: pathlib.Path) -> list:
+        parameters = []
+        for subtitle, lang_code, lang_name in self.get_subtitles(file):
             subtitle_path = str(subtitle).replace(':', r'\:')
             parameters.extend(('--mux-import', f'path="{subtitle_path}":lang={lang_code}:name="{lang_name}"'))
         return parameters
 
+    def finish_stages(self) -> bool:
+        '''네트워크 작업이 끝난 트랙 파일을 복호화 후 먹싱'''
+        # 다운로드 슬롯 반환
+        self.set_status('FETCHED')
+        output_filepath = pathlib.Path(self.output_filepath)
+        try:
+            tracks = sorted(
+                track for track in self.track_dir.iterdir()
+                if track.is_file() and track.suffix.lower() in {'.mp4', '.m4a', '.m4v', '.ts', '.aac', '.mkv'}
+            )
+            if not tracks:
+                self.logger.error(f'No track files: {self.track_dir}')
+                return False
+            if self.streaming_protocol == 'dash' and getattr(self, 'key', None):
+                self.set_status('DECRYPTING')
+                with STAGES['decrypt'].slot():
+                    if self._WVDownloader__stop_flag:
+                        return False
+                    tracks = [self.decrypt_track(track) for track in tracks]
+                if not all(tracks):
+                    return False
+            self.set_status('MUXING')
+            with STAGES['mux'].slot():
+                if self._WVDownloader__stop_flag:
+                    return False
+                result = self.mux_tracks(tracks, output_filepath)
+            return result
+        finally:
+            shutil.rmtree(self.track_dir, ignore_errors=True)
+
+    def decrypt_track(self, track: pathlib.Path) -> pathlib.Path | None:
+        decrypted = track.with_name(f'{track.stem}.dec{track.suffix}')
+        command = [str(BINARIES['mp4decrypt'][0])]
+        for key in self.key:
+            command.extend(('--key', f'{key["kid"]}:{key["key"]}'))
+        command.extend((str(track), str(decrypted)))
+        if not self.execute_command(command):
+            self.logger.error(f'Decryption failed: {track}')
+            return None
+        track.unlink(missing_ok=True)
+        return decrypted
+
+    def mux_tracks(self, tracks: list[pathlib.Path], output_filepath: pathlib.Path) -> bool:
+        subtitles = self.get_subtitles(output_filepath)
+        if output_filepath.suffix == '.mkv':
+            command = [str(BINARIES['mkvmerge'][0]), '-q', '-o', str(output_filepath)]
+            command.extend(str(track) for track in tracks)
+            for subtitle, lang_code, lang_name in subtitles:
+                command.extend(('--language', f'0:{lang_code}', '--track-name', f'0:{lang_name}', str(subtitle)))
+            # mkvmerge: 1은 경고
+            return self.execute_command(command, ok_codes=(0, 1))
+        command = [str(BINARIES['ffmpeg'][0]), '-y', '-loglevel', 'error']
+        inputs = [*tracks, *(subtitle for subtitle, _, _ in subtitles)]
+        for file in inputs:
+            command.extend(('-i', str(file)))
+        for idx in range(len(inputs)):
+            command.extend(('-map', str(idx)))
+        command.extend(('-c', 'copy', '-c:s', 'mov_text'))
+        for idx, (_, lang_code, _) in enumerate(subtitles):
+            command.extend((f'-metadata:s:s:{idx}', f'language={lang_code}'))
+        command.append(str(output_filepath))
+        return self.execute_command(command)
+
     def check_file_path(self) -> bool:
         # 파일 이름에 comma 가 있으면 오류: ERROR: cannot open fragments info file
         self.output_filename = self.output_filename.replace(',', '')
@@ -206,9 +435,11 @@ class REDownloader(WVDownloader):
         else:
             return True
 
-    def execute_command(self, command: list) -> bool:
+    def execute_command(self, command: list, ok_codes: tuple = (0,)) -> bool:
         try:
             with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, text=True, encoding='utf8', errors='ignore') as process:
+                # 모듈 설정의 우선순위로
+                PRIORITY.adopt(process.pid, self.config.get('callback_id'))
                 self.parse_re_stdout(process)
                 try:
                     process.wait(timeout=3600)
@@ -216,7 +447,7 @@ class REDownloader(WVDownloader):
                     self.logger.exception(command)
                     process.kill()
                     return False
-                if process.returncode == 0:
+                if process.returncode in ok_codes:
                     return True
                 else:
                     self.logger.warning(f'Process exit code: {process.returncode}')
@@ -245,6 +476,43 @@ class REDownloader(WVDownloader):
                 self.logger.error(line)
 
 
+def prefetch_drm_keys(contentid: str, streaming: dict, proxies: dict = None, callback_id: str = None) -> bool:
+    '''대기중에 미리 라이센스를 받아 키를 캐시'''
+    if not streaming or not streaming.get('drm') or KEY_CACHE.ttl.total_seconds() <= 0:
+        return False
+    # 대기중에는 MPD를 받지 않음, 다운로드할 때 KID를 확인
+    if KEY_CACHE.get(contentid):
+        return True
+    play_info = streaming.get('play_info') or {}
+    drm_key_request_properties = play_info.get('drm_key_request_properties')
+    drm_license_uri = play_info.get('drm_license_uri')
+    if not (drm_key_request_properties and drm_license_uri):
+        return False
+    folder_tmp = os.path.join(F.config['path_data'], 'tmp')
+    downloader = REDownloader({
+        'callback_id': f'{P.package_name}_prefetch_{contentid}',
+        'logger': logger,
+        'mpd_url': play_info.get('uri') or streaming.get('playurl'),
+        'code': contentid,
+        'output_filename': f'{contentid}.mkv',
+        'license_headers': drm_key_request_properties,
+        'license_url': drm_license_uri,
+        'mpd_headers': play_info.get('mpd_headers'),
+        'clean': True,
+        'folder_tmp': folder_tmp,
+        'folder_output': folder_tmp,
+        'proxies': proxies,
+    })
+    downloader.trace_id = callback_id
+    try:
+        if isinstance(downloader.mpd_headers, dict):
+            downloader.mpd_headers['Host'] = urllib.parse.urlparse(downloader.mpd_url).netloc
+        downloader.prepare()
+    except Exception:
+        logger.exception(f'Prefetching keys failed: {contentid}')
+    return bool(KEY_CACHE.get(contentid))
+
+
 def download_webvtts(subtitles: list, video_file_path: str, wanted: list) -> None:
     if not wanted:
         return
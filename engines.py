@@ -0,0 +1,353 @@
+import os
+import json
+import time
+import random
+import threading
+import urllib.parse
+from typing import Callable
+
+from support.expand.ffmpeg import SupportFfmpeg
+from support_site import SupportWavve
+from wv_tool import WVDownloader
+
+from .setup import F, P
+from .downloader import REDownloader, CachedWVDownloader, BINARIES
+from .admission import ADMISSION
+from .metrics import TRANSFERS
+from .cdn import CDN
+from .policy import POLICY
+from .priority import PRIORITY
+
+
+logger = P.logger
+settings = P.ModelSetting
+# 프로토콜별 엔진, 앞의 것이 기본
+PROTOCOL_ENGINES = {
+    'dash': ('wv', 're'),
+    'hls': ('ffmpeg', 're'),
+}
+# {module}_drm, {module}_hls 설정값: 엔진
+MODES = {
+    'dash': {'WV': 'wv', 'RE': 're'},
+    'hls': {'WV': 'ffmpeg', 'RE': 're'},
+}
+AUTO = 'AUTO'
+# 다른 엔진으로 다시 받을 종료 상태
+FALLBACK_STATUSES = ('ERROR', 'EXCEPTION', 'HTTP_FORBIDDEN', 'TIME_OVER', 'PF_STOP', 'WRONG_URL')
+SUCCESS_STATUSES = ('COMPLETED',)
+# 종료가 아닌 wv_tool 상태
+PROGRESS_STATUSES = ('READY', 'SEGMENT_FAIL', 'DOWNLOADING', 'FETCHED', 'DECRYPTING', 'MUXING')
+# 기록할 때마다 이전 기록의 가중치를 줄임
+DECAY = 0.95
+# 이보다 적게 받아 본 단계의 기록은 쓰지 않음
+MIN_SAMPLES = 3
+# 가끔 덜 써 본 엔진을 먼저
+EXPLORE = 0.05
+SAVE_INTERVAL = 60
+
+
+class DownloadJob:
+    '''엔진과 상관 없는 다운로드 정보'''
+
+    def __init__(self, callback_id: str, module: str, streaming: dict, url: str, code: str, filename: str, save_path: str,
+                 proxies: dict, ffmpeg_listener: Callable, wvtool_callback: Callable) -> None:
+        self.callback_id = callback_id
+        self.module = module
+        self.streaming = streaming
+        self.url = url
+        self.code = code
+        self.filename = filename
+        self.save_path = save_path
+        self.proxies = proxies
+        self.ffmpeg_listener = ffmpeg_listener
+        self.wvtool_callback = wvtool_callback
+        self.engine = None
+        self.auto = False
+        self.tried = []
+        self.started = 0.0
+
+    @property
+    def protocol(self) -> str:
+        return 'dash' if self.streaming.get('drm') else 'hls'
+
+    @property
+    def play_info(self) -> dict:
+        return self.streaming.get('play_info') or {}
+
+    @property
+    def headers(self) -> dict | None:
+        return self.play_info.get('mpd_headers' if self.protocol == 'dash' else 'headers')
+
+    @property
+    def license_ready(self) -> bool:
+        if self.protocol != 'dash':
+            return True
+        return bool(self.play_info.get('drm_key_request_properties') and self.play_info.get('drm_license_uri'))
+
+    @property
+    def output_path(self) -> str:
+        return os.path.join(self.save_path, self.filename)
+
+    @property
+    def history_keys(self) -> tuple[str, ...]:
+        '''자세한 것부터: 프로토콜|화질|CDN, 프로토콜|화질, 프로토콜'''
+        host = urllib.parse.urlparse(self.url or '').hostname or ''
+        quality = self.streaming.get('quality') or ''
+        return (f'{self.protocol}|{quality}|{host}', f'{self.protocol}|{quality}', self.protocol)
+
+
+class EngineHistory:
+    '''비슷한 작업에서 엔진별 성공률과 처리량'''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # key: 작업 구분, value: {engine: [success, failure, bytes, seconds]}
+        self.records = None
+        self.saved_at = 0.0
+
+    def load(self) -> dict:
+        if self.records is None:
+            try:
+                self.records = json.loads(settings.get('basic_engine_history') or '{}')
+            except Exception:
+                logger.exception('Loading engine history failed')
+                self.records = {}
+        return self.records
+
+    def save(self, force: bool = False) -> None:
+        if not force and time.monotonic() - self.saved_at < SAVE_INTERVAL:
+            return
+        self.saved_at = time.monotonic()
+        with self.lock:
+            data = json.dumps(self.load(), separators=(',', ':'))
+        try:
+            settings.set('basic_engine_history', data)
+        except Exception:
+            logger.exception('Saving engine history failed')
+
+    @staticmethod
+    def samples(stats: list | None) -> float:
+        return stats[0] + stats[1] if stats else 0
+
+    def record(self, job: DownloadJob, success: bool, size: int, elapsed: float) -> None:
+        with self.lock:
+            records = self.load()
+            for key in job.history_keys:
+                level = records.setdefault(key, {})
+                stats = level.setdefault(job.engine, [0, 0, 0, 0])
+                stats[:] = [value * DECAY for value in stats]
+                if success:
+                    stats[0] += 1
+                    if size:
+                        stats[2] += size
+                        stats[3] += elapsed
+                else:
+                    stats[1] += 1
+        self.save()
+
+    def rank(self, job: DownloadJob, engines: list[str]) -> list[str]:
+        '''기대 처리량이 큰 순서, 기록이 없으면 기본 순서'''
+        with self.lock:
+            records = self.load()
+            for key in job.history_keys:
+                level = records.get(key) or {}
+                if any(self.samples(level.get(engine)) >= MIN_SAMPLES for engine in engines):
+                    break
+            else:
+                return list(engines)
+            if random.random() < EXPLORE:
+                return sorted(engines, key=lambda engine: self.samples(level.get(engine)))
+            throughputs = [stats[2] / stats[3] for stats in level.values() if stats[3]]
+            best = max(throughputs) if throughputs else 0
+
+            def expected(engine: str) -> float:
+                success, failure, size, seconds = level.get(engine) or (0, 0, 0, 0)
+                rate = (success + 1) / (success + failure + 2)
+                if not best:
+                    return rate
+                # 받아 본 적 없으면 가장 빠른 엔진만큼으로
+                return rate * (size / seconds if seconds else best)
+
+            return sorted(engines, key=expected, reverse=True)
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                key: {
+                    engine: {
+                        'success': round(stats[0], 1),
+                        'failure': round(stats[1], 1),
+                        'throughput': round(stats[2] / stats[3]) if stats[3] else None,
+                    }
+                    for engine, stats in level.items()
+                }
+                for key, level in self.load().items()
+            }
+
+
+class EngineFactory:
+    '''다운로드 엔진 선택과 생성, 실패하면 다음 엔진으로'''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.history = EngineHistory()
+        # key: callback_id
+        self.jobs = {}
+
+    @staticmethod
+    def is_available(engine: str) -> bool:
+        if engine == 're':
+            binary = BINARIES['N_m3u8DL-RE'][0]
+            return bool(binary and os.path.exists(binary))
+        return True
+
+    def candidates(self, job: DownloadJob) -> list[str]:
+        return [engine for engine in PROTOCOL_ENGINES[job.protocol] if engine not in job.tried and self.is_available(engine)]
+
+    def select(self, job: DownloadJob) -> str:
+        mode = settings.get(f"{job.module}_{'drm' if job.protocol == 'dash' else 'hls'}")
+        job.auto = mode == AUTO
+        if not job.auto:
+            return MODES[job.protocol].get(mode) or PROTOCOL_ENGINES[job.protocol][0]
+        ranked = self.history.rank(job, self.candidates(job))
+        return ranked[0] if ranked else PROTOCOL_ENGINES[job.protocol][0]
+
+    def build(self, job: DownloadJob, engine: str) -> object:
+        if engine == 'ffmpeg':
+            return SupportFfmpeg(
+                SupportWavve.get_prefer_url(job.url, job.headers),
+                job.filename,
+                save_path=job.save_path,
+                headers=job.headers,
+                callback_id=job.callback_id,
+                callback_function=job.ffmpeg_listener,
+            )
+        params = {
+            'callback_id': job.callback_id,
+            'logger': P.logger,
+            'mpd_url': job.url,
+            'code': job.code,
+            'output_filename': job.filename,
+            'mpd_headers': job.headers,
+            'clean': True,
+            'folder_tmp': os.path.join(F.config['path_data'], 'tmp'),
+            'folder_output': job.save_path,
+            'proxies': job.proxies,
+            'quality': job.streaming.get('quality'),
+        }
+        if job.protocol == 'dash':
+            params['license_headers'] = job.play_info.get('drm_key_request_properties')
+            params['license_url'] = job.play_info.get('drm_license_uri')
+        else:
+            params['streaming_protocol'] = 'hls'
+            params['license_url'] = None
+        downloader_cls = REDownloader if engine == 're' else CachedWVDownloader
+        return downloader_cls(params, callback_function=job.wvtool_callback)
+
+    def create(self, job: DownloadJob) -> object:
+        job.url = CDN.select(job.url, job.headers, job.proxies)
+        engine = self.select(job)
+        downloader = self.build(job, engine)
+        job.engine = engine
+        job.tried.append(engine)
+        job.started = time.monotonic()
+        with self.lock:
+            self.jobs[job.callback_id] = job
+        PRIORITY.register(job.callback_id, job.module, job.filename)
+        if job.auto:
+            logger.debug(f'Selected engine: {engine} for {job.callback_id} {job.history_keys[0]}')
+        return downloader
+
+    def stop(self, callback_id: str) -> bool:
+        '''False: 이 팩토리로 시작한 다운로드가 아님'''
+        with self.lock:
+            job = self.jobs.get(callback_id)
+        if not job:
+            return False
+        # 사용자 중지는 다른 엔진으로 넘기지 않음
+        job.auto = False
+        downloader_cls = SupportFfmpeg if job.engine == 'ffmpeg' else WVDownloader
+        downloader_cls.stop_by_callback_id(callback_id)
+        return True
+
+    def discard(self, callback_id: str) -> None:
+        with self.lock:
+            self.jobs.pop(callback_id, None)
+        PRIORITY.discard(callback_id)
+
+    def finish(self, callback_id: str, status: object, path: str = None) -> bool:
+        '''
+        다운로드 종료시 결과를 기록
+        True: 다른 엔진으로 다시 시작했으니 종료 처리를 하지 않아야 함
+        '''
+        status = str(getattr(status, 'name', status)).upper()
+        if status in PROGRESS_STATUSES:
+            return False
+        if self.conclude(callback_id, status, path):
+            return True
+        # 자식 프로세스 사용량은 다른 엔진으로 다시 받은 것까지 합침
+        PRIORITY.finish(callback_id)
+        return False
+
+    def conclude(self, callback_id: str, status: str, path: str = None) -> bool:
+        with self.lock:
+            job = self.jobs.pop(callback_id, None)
+        if not job:
+            return False
+        if status in SUCCESS_STATUSES or status in FALLBACK_STATUSES:
+            # 사용자 중지, 이미 있는 파일 등은 엔진, CDN과 상관 없음
+            success = status in SUCCESS_STATUSES
+            size = 0
+            if success:
+                try:
+                    size = os.path.getsize(path or job.output_path)
+                except OSError:
+                    pass
+            elapsed = time.monotonic() - job.started
+            self.history.record(job, success, size, elapsed)
+            CDN.record(job.url, success, size, elapsed)
+            POLICY.record(job.url, job.streaming.get('quality'), success, size, elapsed)
+        # 다운로드 슬롯을 이미 반환했으면 네트워크 작업 이후의 실패
+        if status not in FALLBACK_STATUSES or not job.auto or not ADMISSION.holds(callback_id):
+            return False
+        if not (remaining := self.history.rank(job, self.candidates(job))):
+            return False
+        return self.fall_back(job, remaining[0], status)
+
+    def fall_back(self, job: DownloadJob, engine: str, status: str) -> bool:
+        logger.warning(f'Falling back to {engine}: {job.callback_id} ({job.engine} {status})')
+        self.remove_partial(job)
+        try:
+            # 실패한 호스트가 제외됐으면 다른 호스트로
+            job.url = CDN.select(job.url, job.headers, job.proxies)
+            downloader = self.build(job, engine)
+        except Exception:
+            logger.exception(f'Could not create the downloader: {engine}')
+            return False
+        job.engine = engine
+        job.tried.append(engine)
+        job.started = time.monotonic()
+        with self.lock:
+            self.jobs[job.callback_id] = job
+        TRANSFERS.finish(job.callback_id, status)
+        TRANSFERS.start(job.callback_id, job.module, downloader, job.output_path)
+        try:
+            downloader.start()
+        except Exception:
+            logger.exception(f'Failed while downloading: {job.callback_id}')
+            self.discard(job.callback_id)
+            TRANSFERS.discard(job.callback_id)
+            return False
+        return True
+
+    @staticmethod
+    def remove_partial(job: DownloadJob) -> None:
+        '''실패한 엔진이 남긴 파일이 있으면 다음 엔진이 이미 있는 파일로 처리함'''
+        try:
+            if os.path.isfile(job.output_path) and os.path.getmtime(job.output_path) >= time.time() - (time.monotonic() - job.started):
+                os.remove(job.output_path)
+        except OSError:
+            logger.exception(f'Could not remove the partial file: {job.output_path}')
+
+
+ENGINES = EngineFactory()
@@ -0,0 +1,270 @@
+import os
+import re
+import time
+import pathlib
+import datetime
+import threading
+
+from sqlalchemy import or_
+
+from tool import ToolUtil
+from plugin.model_base import ModelBase
+
+from .setup import F, P
+from .resolver import rank
+
+
+logger = P.logger
+settings = P.ModelSetting
+VIDEO_SUFFIXES = {'.mp4', '.mkv', '.ts'}
+# 프로그램.E01.240101.1080p-ST.mp4
+FILENAME_REGEX = re.compile(r'^(?P<title>.+?)\.E(?P<episode>\d+)\.(?P<date>\d{6})\b', re.IGNORECASE)
+NORMALIZE_REGEX = re.compile(r'[\W_]+')
+QUALITY_REGEX = re.compile(r'\.(?P<quality>\d{3,4}p)\b', re.IGNORECASE)
+
+
+def normalize_title(title: str) -> str:
+    return NORMALIZE_REGEX.sub('', title or '').lower()
+
+
+def normalize_episode(episode: str | int) -> str:
+    episode = str(episode or '').strip()
+    return str(int(episode)) if episode.isdigit() else ''
+
+
+class ModelWavveLibrary(ModelBase):
+
+    P = P
+    __tablename__ = f'{P.package_name}_library'
+    __bind_key__ = P.package_name
+
+    id = F.db.Column(F.db.Integer, primary_key=True)
+    created_time = F.db.Column(F.db.DateTime)
+    path = F.db.Column(F.db.String, unique=True)
+    directory = F.db.Column(F.db.String, index=True)
+    filename = F.db.Column(F.db.String, index=True)
+    contentid = F.db.Column(F.db.String, index=True)
+    program_key = F.db.Column(F.db.String)
+    episode_number = F.db.Column(F.db.String)
+    quality = F.db.Column(F.db.String)
+    filesize = F.db.Column(F.db.Integer)
+    mtime = F.db.Column(F.db.Float)
+
+    __table_args__ = (
+        F.db.Index(f'ix_{P.package_name}_library_program', 'program_key', 'episode_number'),
+        {'mysql_collate': 'utf8_general_ci'},
+    )
+
+    def __init__(self, path: str) -> None:
+        self.created_time = datetime.datetime.now()
+        self.path = path
+        self.set_file(pathlib.Path(path))
+
+    def set_file(self, file: pathlib.Path) -> None:
+        self.directory = str(file.parent)
+        self.filename = file.name
+        try:
+            stat = file.stat()
+            self.filesize = stat.st_size
+            self.mtime = stat.st_mtime
+        except OSError:
+            pass
+        if match := FILENAME_REGEX.search(file.name):
+            self.program_key = normalize_title(match.group('title'))
+            self.episode_number = normalize_episode(match.group('episode'))
+        if match := QUALITY_REGEX.search(file.name):
+            self.quality = match.group('quality').lower()
+
+
+class ModelWavveLibraryDirectory(ModelBase):
+    '''마지막으로 확인한 폴더의 mtime'''
+
+    P = P
+    __tablename__ = f'{P.package_name}_library_directory'
+    __bind_key__ = P.package_name
+
+    id = F.db.Column(F.db.Integer, primary_key=True)
+    path = F.db.Column(F.db.String, unique=True)
+    mtime = F.db.Column(F.db.Float)
+
+    def __init__(self, path: str, mtime: float) -> None:
+        self.path = path
+        self.mtime = mtime
+
+
+class LibraryIndex:
+    '''저장 폴더에 이미 있는 파일 목록'''
+
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.thread = None
+        self.event = threading.Event()
+
+    @property
+    def roots(self) -> list[pathlib.Path]:
+        roots = []
+        for key in ('basic_save_path', 'recent_save_path', 'recent_genre_base_path', 'program_save_path'):
+            try:
+                value = settings.get(key)
+            except Exception:
+                value = None
+            if not value:
+                continue
+            path = pathlib.Path(ToolUtil.make_path(value))
+            if path.is_dir() and path not in roots:
+                roots.append(path)
+        return roots
+
+    def start(self) -> None:
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.run, name=f'{P.package_name}_library', daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.scan()
+            except Exception:
+                logger.exception('Scanning library failed')
+            try:
+                minutes = max(settings.get_int('basic_library_rescan_minute'), 1)
+            except Exception:
+                minutes = 60
+            self.event.wait(minutes * 60)
+            self.event.clear()
+
+    def load_scanned(self) -> dict:
+        with self.lock, F.app.app_context():
+            return dict(F.db.session.query(ModelWavveLibraryDirectory.path, ModelWavveLibraryDirectory.mtime).all())
+
+    def save_scanned(self, scanned: dict, current: dict) -> None:
+        '''바뀐 폴더만 기록'''
+        with self.lock, F.app.app_context():
+            removed = list(set(scanned) - set(current))
+            for start in range(0, len(removed), 500):
+                F.db.session.query(ModelWavveLibraryDirectory) \
+                    .filter(ModelWavveLibraryDirectory.path.in_(removed[start:start + 500])) \
+                    .delete(synchronize_session=False)
+            changed = [path for path, mtime in current.items() if path in scanned and scanned[path] != mtime]
+            for start in range(0, len(changed), 500):
+                for row in F.db.session.query(ModelWavveLibraryDirectory) \
+                        .filter(ModelWavveLibraryDirectory.path.in_(changed[start:start + 500])).all():
+                    row.mtime = current[row.path]
+            for path in set(current) - set(scanned):
+                F.db.session.add(ModelWavveLibraryDirectory(path, current[path]))
+            F.db.session.commit()
+
+    def scan(self) -> int:
+        '''폴더의 mtime이 바뀐 곳만 다시 확인'''
+        scanned = self.load_scanned()
+        current = {}
+        count = 0
+        for root in self.roots:
+            for directory, _, _ in os.walk(root):
+                try:
+                    mtime = os.stat(directory).st_mtime
+                except OSError:
+                    continue
+                current[directory] = mtime
+                if scanned.get(directory) == mtime:
+                    continue
+                count += self.scan_directory(pathlib.Path(directory))
+                time.sleep(0.01)
+        # 사라진 폴더
+        for directory in set(scanned) - set(current):
+            self.remove_directory(directory)
+        self.save_scanned(scanned, current)
+        if count:
+            logger.debug(f'Library indexed: {count}')
+        return count
+
+    def scan_directory(self, directory: pathlib.Path) -> int:
+        files = {
+            str(file): file for file in directory.iterdir()
+            if file.is_file() and file.suffix.lower() in VIDEO_SUFFIXES
+        }
+        count = 0
+        with self.lock, F.app.app_context():
+            rows = F.db.session.query(ModelWavveLibrary).filter_by(directory=str(directory)).all()
+            known = {row.path: row for row in rows}
+            for path, row in known.items():
+                if path not in files:
+                    F.db.session.delete(row)
+            for path, file in files.items():
+                if path in known:
+                    continue
+                F.db.session.add(ModelWavveLibrary(path))
+                count += 1
+            F.db.session.commit()
+        return count
+
+    def remove_directory(self, directory: str) -> None:
+        with self.lock, F.app.app_context():
+            F.db.session.query(ModelWavveLibrary).filter_by(directory=directory).delete()
+            F.db.session.commit()
+
+    def add(self, path: str, contentid: str = None) -> None:
+        '''다운로드 완료 후 등록'''
+        file = pathlib.Path(path)
+        if not file.is_file():
+            return
+        try:
+            with self.lock, F.app.app_context():
+                row = F.db.session.query(ModelWavveLibrary).filter_by(path=str(file)).first()
+                if not row:
+                    row = ModelWavveLibrary(str(file))
+                    F.db.session.add(row)
+                else:
+                    row.set_file(file)
+                if contentid:
+                    row.contentid = contentid
+                F.db.session.commit()
+        except Exception:
+            logger.exception(f'Adding to library failed: {path}')
+
+    @staticmethod
+    def satisfies(row_quality: str | None, quality: str | None) -> bool:
+        '''요청한 화질 이상인 파일만 받은 것으로 봄, 화질을 모르면 받은 것으로 봄'''
+        return not quality or not row_quality or rank(row_quality) <= rank(quality)
+
+    def find_contentids(self, contentids: list[str], quality: str = None) -> set[str]:
+        '''이미 quality 이상의 파일이 있는 contentid'''
+        found = set()
+        contentids = list(set(contentids))
+        with self.lock, F.app.app_context():
+            for start in range(0, len(contentids), 500):
+                rows = F.db.session.query(ModelWavveLibrary.contentid, ModelWavveLibrary.path, ModelWavveLibrary.quality) \
+                    .filter(ModelWavveLibrary.contentid.in_(contentids[start:start + 500])).all()
+                found.update(row.contentid for row in rows if self.satisfies(row.quality, quality) and os.path.exists(row.path))
+        return found
+
+    def find(self, contentid: str = None, programtitle: str = None, episodenumber: str = None, filename: str = None,
+             quality: str = None) -> str | None:
+        '''quality: 이보다 낮은 화질의 파일은 무시'''
+        conditions = []
+        if contentid:
+            conditions.append(ModelWavveLibrary.contentid == contentid)
+        if filename:
+            conditions.append(ModelWavveLibrary.filename == filename)
+            conditions.append(ModelWavveLibrary.filename == filename.replace(',', ''))
+        program_key = normalize_title(programtitle)
+        episode_number = normalize_episode(episodenumber)
+        if program_key and episode_number:
+            conditions.append((ModelWavveLibrary.program_key == program_key) & (ModelWavveLibrary.episode_number == episode_number))
+        if not conditions:
+            return None
+        with self.lock, F.app.app_context():
+            rows = F.db.session.query(ModelWavveLibrary).filter(or_(*conditions)).all()
+            missing = [row for row in rows if not os.path.exists(row.path)]
+            for row in missing:
+                F.db.session.delete(row)
+            if missing:
+                F.db.session.commit()
+            for row in rows:
+                if row not in missing and self.satisfies(row.quality, quality):
+                    return row.path
+        return None
+
+
+LIBRARY = LibraryIndex()
@@ -0,0 +1,138 @@
+import sqlite3
+import threading
+
+from .setup import F, P
+from .admission import ADMISSION
+
+
+logger = P.logger
+settings = P.ModelSetting
+# PRAGMA auto_vacuum
+INCREMENTAL = 2
+
+
+def create_indexes(cs: sqlite3.Cursor, model: type) -> None:
+    '''기존 DB에 모델의 인덱스 추가'''
+    for index in model.__table__.indexes:
+        columns = ', '.join(f'"{column.name}"' for column in index.columns)
+        cs.execute(f'CREATE INDEX IF NOT EXISTS "{index.name}" ON "{model.__tablename__}" ({columns})')
+
+
+class DatabaseMaintenance:
+    '''다운로드가 없을 때 조금씩 DB 정리'''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.thread = None
+        self.last_stats = {}
+
+    @property
+    def db_file(self) -> str:
+        return F.app.config['SQLALCHEMY_BINDS'][P.package_name].replace('sqlite:///', '').split('?')[0]
+
+    @property
+    def interval(self) -> int:
+        '''분, 0: 사용 안 함'''
+        try:
+            return max(settings.get_int('basic_db_maintenance_minute'), 0)
+        except Exception:
+            return 60
+
+    @property
+    def vacuum_pages(self) -> int:
+        try:
+            return max(settings.get_int('basic_db_vacuum_pages'), 1)
+        except Exception:
+            return 2000
+
+    def connect(self) -> sqlite3.Connection:
+        # autocommit: PRAGMA는 트랜잭션 밖에서 실행
+        return sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+
+    def get_stats(self, conn: sqlite3.Connection) -> dict:
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        freelist_count = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return {
+            'page_size': page_size,
+            'page_count': page_count,
+            'freelist_count': freelist_count,
+            'reclaimable': freelist_count * page_size,
+            'auto_vacuum': conn.execute('PRAGMA auto_vacuum').fetchone()[0],
+            'journal_mode': conn.execute('PRAGMA journal_mode').fetchone()[0],
+        }
+
+    def stats(self) -> dict:
+        with self.lock:
+            conn = self.connect()
+            try:
+                self.last_stats = self.get_stats(conn)
+            finally:
+                conn.close()
+            return self.last_stats
+
+    def start(self) -> None:
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.run, name=f'{P.package_name}_maintenance', daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        try:
+            self.prepare()
+        except Exception:
+            logger.exception('Preparing database failed')
+        while True:
+            interval = self.interval
+            self.event.wait(interval * 60 if interval else 3600)
+            self.event.clear()
+            if not interval:
+                continue
+            try:
+                self.maintain()
+            except Exception:
+                logger.exception('Database maintenance failed')
+
+    def prepare(self) -> None:
+        '''WAL 모드'''
+        with self.lock:
+            conn = self.connect()
+            try:
+                if conn.execute('PRAGMA journal_mode').fetchone()[0].lower() != 'wal':
+                    mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+                    logger.info(f'Journal mode: {mode}')
+            finally:
+                conn.close()
+
+    def maintain(self, force: bool = False) -> dict:
+        if not force and ADMISSION.count():
+            logger.debug('Skipped database maintenance: downloading')
+            return self.last_stats
+        with self.lock:
+            conn = self.connect()
+            try:
+                stats = self.get_stats(conn)
+                if stats['auto_vacuum'] != INCREMENTAL:
+                    # 한 번만 전체 VACUUM 해야 적용됨
+                    logger.info(f'Converting to auto_vacuum=INCREMENTAL: {stats["page_count"]} pages')
+                    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                    conn.execute('VACUUM')
+                elif stats['freelist_count']:
+                    # 결과를 모두 읽어야 끝까지 실행됨
+                    conn.execute(f'PRAGMA incremental_vacuum({self.vacuum_pages})').fetchall()
+                # ANALYZE는 필요한 테이블만, 행 수 제한
+                conn.execute('PRAGMA analysis_limit=400')
+                conn.execute('PRAGMA optimize')
+                conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+                self.last_stats = self.get_stats(conn)
+            finally:
+                conn.close()
+        logger.debug(
+            f'Database maintenance: freelist {stats["freelist_count"]} -> {self.last_stats["freelist_count"]} pages, '
+            f'reclaimable={self.last_stats["reclaimable"]} bytes'
+        )
+        return self.last_stats
+
+
+MAINTENANCE = DatabaseMaintenance()
@@ -0,0 +1,307 @@
+import os
+import time
+import bisect
+import functools
+import threading
+import contextlib
+from typing import Any, Callable, Iterable, Iterator
+
+from sqlalchemy import event
+
+from .setup import P
+
+
+logger = P.logger
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+# 초 단위
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PHASE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+WAIT_BUCKETS = (1, 5, 30, 60, 300, 900, 1800, 3600, 7200)
+CPU_BUCKETS = (1, 10, 30, 60, 300, 900, 1800, 3600, 7200)
+# 바이트
+IO_BUCKETS = (2 ** 20, 2 ** 24, 2 ** 27, 2 ** 29, 2 ** 30, 2 ** 31, 2 ** 32, 2 ** 33, 2 ** 34)
+# 다운로드 클래스: 엔진 이름
+ENGINES = {
+    'SupportFfmpeg': 'ffmpeg',
+    'REDownloader': 're',
+    'CachedWVDownloader': 'wv',
+    'WVDownloader': 'wv',
+}
+# 응답 시간을 잴 웨이브 API
+API_ENDPOINTS = (
+    'get_new_vods',
+    'get_more_new_vods',
+    'vod_contents_contentid',
+    'vod_program_contents_programid',
+    'movie_contents_movieid',
+    'vod_tag_groups',
+    'streaming',
+)
+
+
+def escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+
+    kind = 'unknown'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        # key: label 값
+        self.values = {}
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        lines = [f'# TYPE {self.name} {self.kind}', f'# HELP {self.name} {escape(self.help)}']
+        lines.extend(self.samples())
+        return lines
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield f'{self.name}_total{format_labels(self.labels, key)} {format_value(value)}'
+
+
+class Gauge(Metric):
+    '''collector가 있으면 수집할 때 값을 구함'''
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()) -> None:
+        super().__init__(name, help, labels)
+        self.collectors = []
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def collect(self, func: Callable[[], Iterable[tuple[dict, float]]]) -> Callable:
+        '''func: (labels, value)를 반환'''
+        self.collectors.append(func)
+        return func
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            values = dict(self.values)
+        for func in self.collectors:
+            try:
+                for labels, value in func():
+                    values[self.key(labels)] = value
+            except Exception:
+                logger.exception(f'Collecting metric failed: {self.name}')
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{format_labels(self.labels, key)} {format_value(value)}'
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * len(self.buckets), 0.0)
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            items = sorted((key, list(counts), total) for key, (counts, total) in self.values.items())
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="{}"'.format(format_value(bound))
+                yield f'{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}'
+            yield f'{self.name}_count{format_labels(self.labels, key)} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}'
+
+
+class MetricsRegistry:
+    '''prometheus_client 없이 OpenMetrics 텍스트로 내보냄'''
+
+    def __init__(self) -> None:
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+prefix = P.package_name
+ACTIVE_SLOTS = METRICS.gauge(f'{prefix}_active_downloads', 'Download slots in use per module.', ('module',))
+SLOT_LIMIT = METRICS.gauge(f'{prefix}_download_slot_limit', 'Download slot limit per module.', ('module',))
+SLOT_WAITERS = METRICS.gauge(f'{prefix}_download_slot_waiters', 'Downloads waiting for a slot per module.', ('module',))
+QUEUE_DEPTH = METRICS.gauge(f'{prefix}_queue_depth', 'Items waiting in the download queue.', ('module',))
+QUEUE_OLDEST = METRICS.gauge(f'{prefix}_queue_oldest_wait_seconds', 'Age of the oldest waiting item.', ('module',))
+QUEUE_WAIT = METRICS.histogram(f'{prefix}_queue_wait_seconds', 'Time from queueing to getting a download slot.', ('module',), WAIT_BUCKETS)
+RECENT_ROWS = METRICS.gauge(f'{prefix}_recent_rows', 'Recent VOD rows per etc_abort code.', ('etc_abort',))
+DOWNLOADS = METRICS.counter(f'{prefix}_downloads', 'Finished downloads by final status.', ('module', 'engine', 'status'))
+DOWNLOAD_BYTES = METRICS.counter(f'{prefix}_download_bytes', 'Bytes of completed downloads.', ('module', 'engine'))
+DOWNLOAD_SECONDS = METRICS.counter(f'{prefix}_download_seconds', 'Seconds spent on completed downloads.', ('module', 'engine'))
+THROUGHPUT = METRICS.gauge(f'{prefix}_download_throughput_bytes_per_second', 'Average throughput of completed downloads.', ('engine',))
+API_LATENCY = METRICS.histogram(f'{prefix}_api_request_seconds', 'Wavve API call latency.', ('endpoint', 'outcome'))
+RETRIES = METRICS.counter(f'{prefix}_retries', 'Download retries.', ('module',))
+SCHEDULER_PHASE = METRICS.histogram(f'{prefix}_scheduler_phase_seconds', 'Scheduler phase durations.', ('module', 'phase'), PHASE_BUCKETS)
+DOWNLOAD_PHASE = METRICS.histogram(f'{prefix}_download_phase_seconds', 'Per-download phase durations.', ('module', 'phase'), PHASE_BUCKETS)
+CDN_DEMOTED = METRICS.gauge(f'{prefix}_cdn_host_demoted', 'Whether a CDN host is in its cool-down period.', ('host',))
+CHILD_CPU_SECONDS = METRICS.counter(f'{prefix}_child_cpu_seconds', 'CPU time of downloader child processes.', ('module', 'binary'))
+CHILD_IO_BYTES = METRICS.counter(f'{prefix}_child_io_bytes', 'Disk I/O of downloader child processes.', ('module', 'binary', 'direction'))
+JOB_CPU = METRICS.histogram(f'{prefix}_job_cpu_seconds', 'Child process CPU time per download.', ('module',), CPU_BUCKETS)
+JOB_IO = METRICS.histogram(f'{prefix}_job_io_bytes', 'Child process disk I/O per download.', ('module', 'direction'), IO_BUCKETS)
+CDN_TTFB = METRICS.gauge(f'{prefix}_cdn_host_ttfb_seconds', 'Smoothed time to first byte of CDN probes.', ('host',))
+
+
+class TransferTracker:
+    '''callback_id 별로 시작한 다운로드를 기억했다가 끝나면 집계'''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # key: callback_id, value: (module, engine, started, path)
+        self.transfers = {}
+
+    @staticmethod
+    def engine_name(downloader: object) -> str:
+        name = type(downloader).__name__
+        return ENGINES.get(name, name.lower())
+
+    def start(self, callback_id: str, module: str, downloader: object, path: str = None) -> None:
+        '''path: 받을 파일 경로'''
+        with self.lock:
+            self.transfers[callback_id] = (module, self.engine_name(downloader), time.monotonic(), path)
+
+    def discard(self, callback_id: str) -> None:
+        with self.lock:
+            self.transfers.pop(callback_id, None)
+
+    def finish(self, callback_id: str, status: Any, path: str = None) -> None:
+        '''status: SupportFfmpeg.Status 또는 wv_tool의 상태 문자열'''
+        with self.lock:
+            transfer = self.transfers.pop(callback_id, None)
+        if not transfer:
+            return
+        module, engine, started, expected = transfer
+        path = path or expected
+        status = str(getattr(status, 'name', status)).lower()
+        DOWNLOADS.inc(module=module, engine=engine, status=status)
+        if status != 'completed':
+            return
+        try:
+            if path and os.path.isfile(path):
+                DOWNLOAD_BYTES.inc(os.path.getsize(path), module=module, engine=engine)
+                DOWNLOAD_SECONDS.inc(time.monotonic() - started, module=module, engine=engine)
+        except OSError:
+            pass
+
+    def throughput(self) -> Iterable[tuple[dict, float]]:
+        totals = {}
+        with DOWNLOAD_BYTES.lock, DOWNLOAD_SECONDS.lock:
+            for (_, engine), size in DOWNLOAD_BYTES.values.items():
+                totals.setdefault(engine, [0, 0.0])[0] += size
+            for (_, engine), seconds in DOWNLOAD_SECONDS.values.items():
+                totals.setdefault(engine, [0, 0.0])[1] += seconds
+        for engine, (size, seconds) in totals.items():
+            yield {'engine': engine}, size / seconds if seconds else 0
+
+
+TRANSFERS = TransferTracker()
+THROUGHPUT.collect(TRANSFERS.throughput)
+
+
+def instrument_api(target: type) -> None:
+    '''웨이브 API 호출 시간을 기록'''
+    for endpoint in API_ENDPOINTS:
+        original = getattr(target, endpoint, None)
+        if original is None or getattr(original, 'instrumented', False):
+            continue
+
+        def make_wrapper(endpoint: str, original: Callable) -> Callable:
+            @functools.wraps(original)
+            def measured(*args: Any, **kwargs: Any) -> Any:
+                started = time.perf_counter()
+                outcome = 'error'
+                try:
+                    result = original(*args, **kwargs)
+                    outcome = 'success' if result else 'empty'
+                    return result
+                finally:
+                    API_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, outcome=outcome)
+            measured.instrumented = True
+            return measured
+
+        setattr(target, endpoint, staticmethod(make_wrapper(endpoint, original)))
+
+
+def count_retries(attribute: Any, module: str) -> None:
+    '''retry 컬럼이 늘어날 때마다 집계'''
+    def on_set(target: Any, value: Any, oldvalue: Any, initiator: Any) -> None:
+        if isinstance(value, int) and isinstance(oldvalue, int) and value > oldvalue:
+            RETRIES.inc(value - oldvalue, module=module)
+
+    event.listen(attribute, 'set', on_set)
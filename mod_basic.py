@@ -1,6 +1,10 @@
 import os
 import re
+import json
+import time
+import sqlite3
 import pathlib
+import threading
 
 import flask
 
@@ -9,10 +13,23 @@ from plugin.logic_module_base import PluginModuleBase
 from support.expand.ffmpeg import SupportFfmpeg
 from tool import ToolUtil
 from support_site import SupportWavve
-from wv_tool import WVDownloader
 
 from .setup import F, P
-from .downloader import REDownloader, download_webvtts, download_webvtt, set_binary
+from .downloader import download_webvtts, download_webvtt, set_binary
+from .engines import ENGINES, DownloadJob
+from .admission import ADMISSION
+from .proxies import POOL
+from .priority import PRIORITY
+from .library import LIBRARY, ModelWavveLibrary, QUALITY_REGEX
+from .blob import add_columns
+from .cluster import CLUSTER
+from .maintenance import MAINTENANCE
+from .thumbnail import THUMBNAIL
+from .bench_cdn import CDN_BENCHMARK
+from .cdn import CDN
+from .policy import POLICY
+from .tracing import TRACES
+from .metrics import METRICS, CONTENT_TYPE, TRANSFERS, ACTIVE_SLOTS, SLOT_LIMIT, SLOT_WAITERS, QUEUE_WAIT, instrument_api
 
 
 name = 'basic'
@@ -24,16 +41,50 @@ class ModuleBasic(PluginModuleBase):
         super(ModuleBasic, self).__init__(P, 'setting')
         self.name = name
         self.db_default = {
-            f"{self.name}_db_version": "1",
+            f"{self.name}_db_version": "3",
             f"{self.name}_quality": "1080p",
             f"{self.name}_save_path": "{PATH_DATA}" + os.sep + "download",
             f"{self.name}_recent_code": "",
             f"{self.name}_drm": "WV",
             f"{self.name}_subtitle_langs": "all",
             f"{self.name}_hls": "WV",
-            f"{self.name}_bin_path": (pathlib.Path(F.config['path_data']) / 'bin').absolute().as_posix()
+            f"{self.name}_process_nice": "10",
+            f"{self.name}_process_ionice": "best-effort",
+            f"{self.name}_cgroup_cpu_weight": "0",
+            f"{self.name}_cgroup_io_weight": "0",
+            f"{self.name}_cgroup_path": "",
+            f"{self.name}_bin_path": (pathlib.Path(F.config['path_data']) / 'bin').absolute().as_posix(),
+            f"{self.name}_playurl_refresh_minute": "30",
+            f"{self.name}_drm_key_ttl_minute": "360",
+            f"{self.name}_stage_pipeline": "False",
+            f"{self.name}_decrypt_max_count": "2",
+            f"{self.name}_mux_max_count": "1",
+            f"{self.name}_global_max_count": "6",
+            f"{self.name}_reserved_recent": "1",
+            f"{self.name}_reserved_program": "1",
+            f"{self.name}_reserved_basic": "0",
+            f"{self.name}_library_rescan_minute": "60",
+            f"{self.name}_download_proxies": "",
+            f"{self.name}_proxy_max_count": "0",
+            f"{self.name}_cluster_enabled": "False",
+            f"{self.name}_cluster_db_url": "",
+            f"{self.name}_cluster_node_id": "",
+            f"{self.name}_cluster_lease_second": "120",
+            f"{self.name}_cluster_max_attempts": "5",
+            f"{self.name}_db_maintenance_minute": "60",
+            f"{self.name}_db_vacuum_pages": "2000",
+            f"{self.name}_thumbnail_cache_mb": "200",
+            f"{self.name}_thumbnail_width": "320",
+            f"{self.name}_engine_history": "{}",
+            f"{self.name}_cdn_hosts": "",
+            f"{self.name}_cdn_cooldown_minute": "10",
+            f"{self.name}_re_max_threads": "16",
+            f"{self.name}_quality_history": "{}",
         }
         self.last_data = None
+        ACTIVE_SLOTS.collect(lambda: self.collect_slots('active'))
+        SLOT_LIMIT.collect(lambda: self.collect_slots('limit'))
+        SLOT_WAITERS.collect(lambda: self.collect_slots('waiting'))
 
     def process_menu(self, page_name: str, req: flask.Request) -> flask.Response:
         arg = P.ModelSetting.to_dict()
@@ -41,78 +92,80 @@ class ModuleBasic(PluginModuleBase):
             arg['code'] = req.args.get('code') or P.ModelSetting.get(f'{self.name}_recent_code')
         return flask.render_template(f'{P.package_name}_{name}_{page_name}.html', arg=arg)
 
+    def process_normal(self, sub: str, req: flask.Request) -> flask.Response:
+        '''override'''
+        if sub == 'thumbnail':
+            return THUMBNAIL.response(req)
+        flask.abort(404)
+
+    def process_api(self, sub: str, req: flask.Request) -> flask.Response:
+        '''override'''
+        if sub == 'metrics':
+            return flask.Response(METRICS.render(), mimetype=CONTENT_TYPE)
+        flask.abort(404)
+
+    def collect_slots(self, key: str) -> list[tuple[dict, int]]:
+        return [({'module': module}, status[key]) for module, status in ADMISSION.status()['modules'].items()]
+
     def process_command(self, command: str, arg1: str, arg2: str, arg3: str, req: flask.Request) -> flask.Response:
         ret = {'ret':'success'}
         match command:
             case 'analyze':
                 ret = self.analyze(arg1, quality=arg2) if arg2 else self.analyze(arg1)
-            case 'download_start':
-                save_path = ToolUtil.make_path(P.ModelSetting.get(f"{self.name}_save_path"))
+            case 'db_status' | 'db_maintenance':
+                try:
+                    stats = MAINTENANCE.maintain(force=True) if command == 'db_maintenance' else MAINTENANCE.stats()
+                    ret['msg'] = f"정리 가능: {stats['freelist_count']}/{stats['page_count']} 페이지 ({stats['reclaimable'] / 1024 / 1024:.1f}MB), auto_vacuum={stats['auto_vacuum']}, journal_mode={stats['journal_mode']}"
+                    ret['data'] = stats
+                except Exception as e:
+                    P.logger.exception(str(e))
+                    ret['ret'] = 'warning'
+                    ret['msg'] = f"DB 상태를 확인하지 못 했습니다: {e}"
+            case 'cdn_benchmark':
                 try:
-                    account = SupportWavve.api.get_account()
-                except Exception:
-                    account = None
-                if account and account.download_proxy:
-                    proxies = {"http": account.download_proxy, "https": account.download_proxy}
+                    CDN_BENCHMARK.start(json.loads(arg1) if arg1 else {})
+                    ret['msg'] = "벤치마크를 시작했습니다. 결과는 로그와 data/wavve/benchmark 폴더에 남습니다."
+                except Exception as e:
+                    ret['ret'] = 'warning'
+                    ret['msg'] = f"벤치마크를 시작하지 못 했습니다: {e}"
+            case 'cdn_benchmark_result':
+                if CDN_BENCHMARK.running:
+                    ret['msg'] = "벤치마크 실행 중입니다."
+                elif CDN_BENCHMARK.last_report:
+                    ret['json'] = CDN_BENCHMARK.last_report
+                    ret['title'] = '벤치마크 결과'
                 else:
-                    proxies = None
-                if self.last_data['streaming'].get('drm'):
-                    # dash
-                    drm_key_request_properties = self.last_data['streaming']['play_info'].get('drm_key_request_properties') or ''
-                    drm_license_uri = self.last_data['streaming']['play_info'].get('drm_license_uri') or ''
-                    if not (drm_key_request_properties and drm_license_uri):
-                        P.logger.error(f"Could not download this DRM file: {self.last_data['available']['filename']}")
-                        P.logger.error(self.last_data['streaming']['play_info'])
-                        return {'ret':'failed'}
-                    parameters = {
-                        'callback_id': 'wavve_basic',
-                        'logger': P.logger,
-                        'mpd_url': self.last_data['streaming']['playurl'],
-                        'code': self.last_data['code'],
-                        'output_filename': self.last_data['available']['filename'],
-                        'license_headers': drm_key_request_properties,
-                        'license_url': drm_license_uri,
-                        'mpd_headers': self.last_data['streaming']['play_info'].get('mpd_headers'),
-                        'clean': True,
-                        'folder_tmp': os.path.join(F.config['path_data'], 'tmp'),
-                        'folder_output': save_path,
-                        'proxies': proxies,
-                    }
-                    downloader_cls = REDownloader if P.ModelSetting.get(f'{self.name}_drm') == 'RE' else WVDownloader
-                    downloader = downloader_cls(parameters)
+                    ret['ret'] = 'warning'
+                    ret['msg'] = "결과가 없습니다."
+            case 'cdn_status':
+                if status := CDN.status():
+                    ret['json'] = {'hosts': status, 're': POLICY.status()}
+                    ret['title'] = 'CDN 상태'
                 else:
-                    headers = self.last_data['streaming']['play_info'].get('headers')
-                    match P.ModelSetting.get(f'{self.name}_hls'):
-                        case 'RE':
-                            downloader = REDownloader({
-                                'callback_id': 'wavve_basic',
-                                'logger': P.logger,
-                                'mpd_url': self.last_data['streaming']['playurl'],
-                                'streaming_protocol': 'hls',
-                                'code': self.last_data['code'],
-                                'output_filename': self.last_data['available']['filename'],
-                                'license_url': None,
-                                'mpd_headers': headers,
-                                'clean': True,
-                                'folder_tmp': os.path.join(F.config['path_data'], 'tmp'),
-                                'folder_output': save_path,
-                                'proxies': proxies,
-                            })
-                        case _:
-                            downloader = SupportFfmpeg(
-                                SupportWavve.get_prefer_url(arg1, headers),
-                                arg2,
-                                save_path=save_path,
-                                callback_id=f"{P.package_name}",
-                                headers=headers,
-                            )
-                # 자막 다운로드
-                download_webvtts(
-                    self.last_data['streaming'].get('subtitles', []),
-                    f"{save_path}/{self.last_data['available']['filename']}",
-                    P.ModelSetting.get_list(f'{self.name}_subtitle_langs', delimeter=',')
+                    ret['ret'] = 'warning'
+                    ret['msg'] = "기록이 없습니다."
+            case 'download_start':
+                save_path = ToolUtil.make_path(P.ModelSetting.get(f"{self.name}_save_path"))
+                callback_id = f"{P.package_name}_{self.name}_{int(time.time() * 1000)}"
+                proxies = POOL.acquire(callback_id)
+                job = DownloadJob(
+                    callback_id, self.name, self.last_data['streaming'], self.last_data['streaming']['playurl'], self.last_data['code'],
+                    self.last_data['available']['filename'], save_path, proxies, self.ffmpeg_listener, self.wvtool_callback_function,
                 )
-                downloader.start()
+                if not job.license_ready:
+                    P.logger.error(f"Could not download this DRM file: {self.last_data['available']['filename']}")
+                    P.logger.error(self.last_data['streaming']['play_info'])
+                    POOL.release(callback_id)
+                    return {'ret':'failed'}
+                downloader = ENGINES.create(job)
+                # 자막 다운로드
+                with TRACES.span(callback_id, 'subtitle'):
+                    download_webvtts(
+                        self.last_data['streaming'].get('subtitles', []),
+                        f"{save_path}/{self.last_data['available']['filename']}",
+                        P.ModelSetting.get_list(f'{self.name}_subtitle_langs', delimeter=',')
+                    )
+                threading.Thread(target=self.start_downloader, args=(downloader, callback_id, job.output_path), daemon=True).start()
             case 'program_page':
                 data = SupportWavve.vod_program_contents_programid(arg1, page=int(arg2))
                 ret =  {'url_type': 'program', 'page':arg2, 'code':arg1, 'data' : data}
@@ -180,8 +233,94 @@ class ModuleBasic(PluginModuleBase):
             P.logger.exception(str(e))
             return self.last_data
 
+    def start_downloader(self, downloader: object, callback_id: str, output_path: str = None) -> None:
+        # 다른 모듈과 동시 다운로드 수를 나눠 씀
+        queued = time.monotonic()
+        if not ADMISSION.acquire(self.name, callback_id):
+            ENGINES.discard(callback_id)
+            return
+        QUEUE_WAIT.observe(time.monotonic() - queued, module=self.name)
+        try:
+            TRANSFERS.start(callback_id, self.name, downloader, output_path)
+            downloader.start()
+        except Exception:
+            P.logger.exception(f'Failed while downloading: {callback_id}')
+            ADMISSION.release(callback_id)
+            POOL.release(callback_id)
+            TRANSFERS.discard(callback_id)
+            ENGINES.discard(callback_id)
+
+    def ffmpeg_listener(self, **arg) -> None:
+        # 다른 엔진으로 다시 받는 중
+        if arg['type'] == 'last' and ENGINES.finish(arg['callback_id'], arg['status'], arg['data'].get('save_fullpath')):
+            return
+        if arg['type'] == 'status_change':
+            TRACES.on_status(arg['callback_id'], arg['status'])
+        if arg['type'] == 'last':
+            ADMISSION.release(arg['callback_id'])
+            TRANSFERS.finish(arg['callback_id'], arg['status'], arg['data'].get('save_fullpath'))
+            TRACES.pop(arg['callback_id'])
+            match arg['status']:
+                case SupportFfmpeg.Status.COMPLETED:
+                    POOL.release(arg['callback_id'], True, arg['data'].get('save_fullpath'))
+                case SupportFfmpeg.Status.USER_STOP:
+                    POOL.release(arg['callback_id'])
+                case _:
+                    POOL.release(arg['callback_id'], False)
+
+    def wvtool_callback_function(self, args: dict) -> None:
+        TRACES.on_status(args['data']['callback_id'], args['status'])
+        # 다른 엔진으로 다시 받는 중
+        if ENGINES.finish(args['data']['callback_id'], args['status']):
+            return
+        if args['status'] not in ('READY', 'SEGMENT_FAIL', 'DOWNLOADING', 'DECRYPTING', 'MUXING'):
+            ADMISSION.release(args['data']['callback_id'])
+            POOL.release(args['data']['callback_id'], {'COMPLETED': True, 'FETCHED': True, 'ERROR': False}.get(args['status']))
+            if args['status'] != 'FETCHED':
+                TRANSFERS.finish(args['data']['callback_id'], args['status'])
+                TRACES.pop(args['data']['callback_id'])
+
+    def migration(self) -> None:
+        '''override'''
+        try:
+            version = float(P.ModelSetting.get(f'{self.name}_db_version'))
+        except Exception:
+            version = 1
+        with F.app.app_context():
+            try:
+                db_file = F.app.config['SQLALCHEMY_BINDS'][P.package_name].replace('sqlite:///', '').split('?')[0]
+                conn = sqlite3.connect(db_file)
+                with conn:
+                    cs = conn.cursor()
+                    if version < 2:
+                        # 라이브러리 파일의 화질, 폴더 mtime은 테이블로
+                        table = ModelWavveLibrary.__tablename__
+                        add_columns(cs, table, ('quality',))
+                        for row_id, filename in cs.execute(f'SELECT id, filename FROM "{table}"').fetchall():
+                            if match := QUALITY_REGEX.search(filename or ''):
+                                cs.execute(f'UPDATE "{table}" SET quality = ? WHERE id = ?', (match.group('quality').lower(), row_id))
+                        cs.execute(f'DELETE FROM "wavve_setting" WHERE key = "basic_library_scanned"')
+                        cs.execute(f'UPDATE "wavve_setting" SET value = "2" WHERE key = "basic_db_version"')
+                    if version < 3:
+                        # 계정별이 아닌 프록시별 제한
+                        if row := cs.execute('SELECT value FROM "wavve_setting" WHERE key = "basic_account_max_count"').fetchone():
+                            if cs.execute('SELECT 1 FROM "wavve_setting" WHERE key = "basic_proxy_max_count"').fetchone():
+                                cs.execute('UPDATE "wavve_setting" SET value = ? WHERE key = "basic_proxy_max_count"', row)
+                            else:
+                                cs.execute('INSERT INTO "wavve_setting" (key, value) VALUES ("basic_proxy_max_count", ?)', row)
+                            cs.execute('DELETE FROM "wavve_setting" WHERE key = "basic_account_max_count"')
+                        cs.execute(f'UPDATE "wavve_setting" SET value = "3" WHERE key = "basic_db_version"')
+            except Exception as e:
+                P.logger.exception(str(e))
+            finally:
+                F.db.session.flush()
+
     def plugin_load(self) -> None:
         set_binary()
+        instrument_api(SupportWavve)
+        LIBRARY.start()
+        CLUSTER.start()
+        MAINTENANCE.start()
 
     def setting_save_after(self, changes: list) -> None:
         '''override'''
@@ -189,3 +328,11 @@ class ModuleBasic(PluginModuleBase):
             match change:
                 case 'base_bin_path':
                     set_binary()
+                case 'basic_download_proxies':
+                    POOL.reload()
+                case 'basic_cgroup_path':
+                    PRIORITY.reset_cgroups()
+
+    def plugin_unload(self) -> None:
+        '''override'''
+        PRIORITY.reset_cgroups()
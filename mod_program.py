@@ -2,7 +2,9 @@ import os
 import threading
 import queue
 import time
+import sqlite3
 import datetime
+from typing import Callable, Iterable
 
 import flask
 from flask_sqlalchemy.query import Query
@@ -18,10 +20,27 @@ from support_site import SupportWavve
 from wv_tool import WVDownloader
 
 from .setup import F, P
-from .downloader import REDownloader, download_webvtts
+from .downloader import download_webvtts, prefetch_drm_keys
+from .engines import ENGINES, DownloadJob
+from .resolver import RESOLVER, lower_qualities
+from .refresher import PlayUrlRefresher, is_due
+from .admission import ADMISSION
+from .proxies import POOL, get_download_proxies
+from .registry import REGISTRY
+from .library import LIBRARY
+from .cluster import CLUSTER
+from .blob import BlobField, migrate_json_columns, add_columns, iter_blob_values
+from .paging import KeysetPager
+from .maintenance import create_indexes
+from .search import ensure_fts, search_query
+from .thumbnail import THUMBNAIL
+from .tracing import TRACES
+from .metrics import TRANSFERS, QUEUE_DEPTH, QUEUE_OLDEST, QUEUE_WAIT
 
 
 name = 'program'
+# 큐에 한 번에 넣는 갯수
+BULK_SIZE = 500
 
 
 class ModuleProgram(PluginModuleBase):
@@ -29,14 +48,13 @@ class ModuleProgram(PluginModuleBase):
     recent_code = None
     download_queue = None
     download_thread = None
-    current_ffmpeg_count = 0
 
     def __init__(self, P: PluginBase) -> None:
         super(ModuleProgram, self).__init__(P, 'list')
         self.name = name
         self.db_default = {
             f"{P.package_name}_{self.name}_last_list_option": "",
-            f"{self.name}_db_version": "1",
+            f"{self.name}_db_version": "5",
             f"{self.name}_recent_code": "",
             f"{self.name}_save_path": "{PATH_DATA}" + os.sep + "download",
             f"{self.name}_make_program_folder": "False",
@@ -46,10 +64,20 @@ class ModuleProgram(PluginModuleBase):
             f"{self.name}_drm": "WV",
             f"{self.name}_subtitle_langs": "all",
             f"{self.name}_hls": "WV",
+            f"{self.name}_process_nice": "10",
+            f"{self.name}_process_ionice": "best-effort",
+            f"{self.name}_cgroup_cpu_weight": "0",
+            f"{self.name}_cgroup_io_weight": "0",
         }
         self.web_list_model = ModelWavveProgram
         default_route_socketio_module(self, attach='/queue')
         self.previous_analyze = None
+        self.bulk_lock = threading.Lock()
+        self.bulk_progress = {'running': False, 'total': 0, 'done': 0}
+        self.bulk_thread = None
+        self.refresher = PlayUrlRefresher(self.name, self.get_waiting_items, self.refresh_queue_item)
+        QUEUE_DEPTH.collect(lambda: [({'module': self.name}, len(self.get_waiting_items()))])
+        QUEUE_OLDEST.collect(self.collect_oldest_wait)
 
     def process_menu(self, page_name: str, req: flask.Request) -> flask.Response:
         arg = P.ModelSetting.to_dict()
@@ -78,6 +106,9 @@ class ModuleProgram(PluginModuleBase):
                 if not _pass and db_item:
                     ret['ret'] = 'warning'
                     ret['msg'] = '이미 DB에 있는 항목입니다.'
+                elif not _pass and (path := LIBRARY.find(contentid=arg1, quality=arg2)):
+                    ret['ret'] = 'warning'
+                    ret['msg'] = f'이미 받은 파일이 있습니다: {path}'
                 elif _pass and db_item and ModelWavveProgram.get_by_id_in_queue(db_item.id):
                     ret['ret'] = 'warning'
                     ret['msg'] = '이미 큐에 있는 항목입니다.'
@@ -85,18 +116,24 @@ class ModuleProgram(PluginModuleBase):
                     if not db_item:
                         db_item = ModelWavveProgram(arg1, arg2)
                         db_item.save()
-                    db_item.init_for_queue()
-                    self.download_queue.put(db_item)
+                    self.enqueue(db_item)
                     ret['msg'] = '다운로드를 추가 하였습니다.'
             case 'download_program_check':
-                lists = arg1[:-1].split(',')
-                for _ in lists:
-                    code, quality = _.split('|')
-                    db_item = ModelWavveProgram(code, quality)
-                    db_item.save()
-                    db_item.init_for_queue()
-                    self.download_queue.put(db_item)
-                ret['msg'] = f"{len(lists)}개를 추가 하였습니다."
+                pairs = [tuple(_.split('|', 1)) for _ in arg1[:-1].split(',') if '|' in _]
+                if len(pairs) > BULK_SIZE:
+                    if self.start_bulk(len(pairs), self.add_program_items, pairs):
+                        ret['msg'] = f"{len(pairs)}개를 추가하는 중입니다."
+                    else:
+                        ret['ret'] = 'warning'
+                        ret['msg'] = "이미 추가하는 중입니다."
+                    ret['data'] = self.bulk_status()
+                else:
+                    count = self.add_program_items(pairs)
+                    ret['msg'] = f"{count}개를 추가 하였습니다."
+                    if count < len(pairs):
+                        ret['msg'] += f" ({len(pairs) - count}개는 이미 받은 파일이 있습니다.)"
+            case 'bulk_status':
+                ret['data'] = self.bulk_status()
             case 'queue_list':
                 ret = [x.as_dict_for_queue() for x in ModelWavveProgram.queue_list]
             case 'program_list_command':
@@ -109,7 +146,11 @@ class ModuleProgram(PluginModuleBase):
                         ret['msg'] = f"{result}개를 삭제하였습니다."
                     case 'add_incomplete':
                         result = self.retry_download_failed()
-                        ret['msg'] = f"{result}개를 추가 하였습니다."
+                        if result > BULK_SIZE:
+                            ret['msg'] = f"{result}개를 추가하는 중입니다."
+                            ret['data'] = self.bulk_status()
+                        else:
+                            ret['msg'] = f"{result}개를 추가 하였습니다."
                     case 'remove_one':
                         result = ModelWavveProgram.delete_by_id(arg2)
                         if result:
@@ -121,12 +162,17 @@ class ModuleProgram(PluginModuleBase):
                 match arg1:
                     case 'cancel':
                         queue_item = ModelWavveProgram.get_by_id_in_queue(arg2)
-                        downloader = WVDownloader if queue_item.is_drm else SupportFfmpeg
-                        downloader.stop_by_callback_id(f"wavve_program_{arg2}")
+                        if not ENGINES.stop(f"wavve_program_{arg2}"):
+                            downloader = WVDownloader if queue_item.is_drm else SupportFfmpeg
+                            downloader.stop_by_callback_id(f"wavve_program_{arg2}")
                     case 'reset':
                         if self.download_queue:
                             self.download_queue.queue.clear()
                         for _ in ModelWavveProgram.queue_list:
+                            if not _.dispatched:
+                                _.cancel = True
+                            if not _.completed and ENGINES.stop(f"wavve_program_{_.id}"):
+                                continue
                             if not _.is_drm and not _.completed and _.contents_json:
                                 SupportFfmpeg.stop_by_callback_id(f"wavve_program_{_.id}")
                         ModelWavveProgram.queue_list = []
@@ -143,20 +189,99 @@ class ModuleProgram(PluginModuleBase):
             self.download_thread.daemon = True
             self.download_thread.start()
 
+        self.refresher.start()
+        CLUSTER.subscribe(self.name, self.get_cluster_capacity, self.accept_cluster_job)
+
         if P.ModelSetting.get_bool(f"{self.name}_failed_redownload"):
             self.retry_download_failed()
 
+    def enqueue(self, db_item: 'ModelWavveProgram') -> None:
+        if CLUSTER.enabled:
+            # 여유 있는 노드가 가져감
+            CLUSTER.publish(self.name, db_item.episode_code, db_item.quality, {'id': db_item.id})
+            return
+        db_item.init_for_queue()
+        self.download_queue.put(db_item)
+        self.refresher.wake()
+
+    def enqueue_all(self, db_items: list['ModelWavveProgram']) -> None:
+        if CLUSTER.enabled:
+            for db_item in db_items:
+                CLUSTER.publish(self.name, db_item.episode_code, db_item.quality, {'id': db_item.id})
+            return
+        for db_item in db_items:
+            db_item.init_for_queue()
+            self.download_queue.put(db_item)
+        self.refresher.wake()
+
+    def start_bulk(self, total: int, target: Callable, *args) -> bool:
+        '''스레드에서 target 실행, 이미 진행 중이면 False'''
+        with self.bulk_lock:
+            if self.bulk_progress['running']:
+                return False
+            self.bulk_progress = {'running': True, 'total': total, 'done': 0}
+            self.bulk_thread = threading.Thread(target=self.bulk_thread_function, args=(target, *args), daemon=True)
+            self.bulk_thread.start()
+            return True
+
+    def bulk_thread_function(self, target: Callable, *args) -> None:
+        try:
+            target(*args)
+        except Exception:
+            P.logger.exception('Queueing in bulk failed')
+        finally:
+            with self.bulk_lock:
+                self.bulk_progress['running'] = False
+
+    def bulk_status(self) -> dict:
+        with self.bulk_lock:
+            return dict(self.bulk_progress)
+
+    def run_bulk(self, total: int, chunks: Iterable[list['ModelWavveProgram']]) -> int:
+        '''큐에 나눠서 추가, 스레드에서 실행하면 진행 상황 기록'''
+        tracked = threading.current_thread() is self.bulk_thread
+        if tracked:
+            with self.bulk_lock:
+                self.bulk_progress['total'] = total
+        count = 0
+        for chunk in chunks:
+            self.enqueue_all(chunk)
+            count += len(chunk)
+            if tracked:
+                with self.bulk_lock:
+                    self.bulk_progress['done'] = count
+        P.logger.debug(f'Queued in bulk: {count}/{total}')
+        return count
+
+    def add_program_items(self, pairs: list[tuple[str, str]]) -> int:
+        existing = set()
+        for quality in {quality for _, quality in pairs}:
+            existing.update((code, quality) for code in LIBRARY.find_contentids([code for code, item in pairs if item == quality], quality))
+        pairs = [pair for pair in pairs if pair not in existing]
+        db_items = ModelWavveProgram.create_all(pairs)
+        return self.run_bulk(len(db_items), (db_items[start:start + BULK_SIZE] for start in range(0, len(db_items), BULK_SIZE)))
+
+    def get_cluster_capacity(self) -> int:
+        if not self.download_queue:
+            return 0
+        return max(ADMISSION.available(self.name) - self.download_queue.qsize(), 0)
+
+    def accept_cluster_job(self, job: dict) -> None:
+        '''공유 작업을 이 노드의 큐에 추가'''
+        db_item = ModelWavveProgram.get(job['contentid'], job['quality'])
+        if not db_item:
+            db_item = ModelWavveProgram(job['contentid'], job['quality'])
+            db_item.save()
+        db_item.init_for_queue()
+        self.download_queue.put(db_item)
+        self.refresher.wake()
+
     def download_thread_function(self) -> None:
         while True:
             try:
-                while True:
-                    if not getattr(SupportWavve, "api", None):
-                        P.logger.warning(f"Wavve API is not ready...")
-                        time.sleep(1)
-                        continue
-                    if self.current_ffmpeg_count < P.ModelSetting.get_int(f"{self.name}_ffmpeg_max_count"):
-                        break
-                    time.sleep(5)
+                while not getattr(SupportWavve, "api", None):
+                    P.logger.warning(f"Wavve API is not ready...")
+                    time.sleep(1)
 
                 db_item = self.download_queue.get()
                 if db_item.cancel:
@@ -165,56 +290,71 @@ class ModuleProgram(PluginModuleBase):
                 if not db_item:
                     self.download_queue.task_done()
                     continue
-                if not db_item.contents_json:
-                    contents_json = SupportWavve.vod_contents_contentid(db_item.episode_code)
-                    db_item.set_contents_json(contents_json)
-
-                contenttype = 'onairvod' if db_item.contents_json['type'] == 'onair' else 'vod'
-                count = 0
-                if not db_item.contents_json.get('drms'):
-                    action = 'hls'
-                    db_item.is_drm = False
-                else:
-                    action = "dash"
-                    db_item.is_drm = True
-                while True:
-                    count += 1
-                    streaming_data = SupportWavve.streaming(contenttype, db_item.episode_code, db_item.quality, action=action)
-                    if not streaming_data:
-                        time.sleep(20)
-                        if count > 3:
-                            db_item.ffmpeg_status_kor = 'URL실패'
-                            break
-                    else:
-                        db_item.filename = SupportWavve.get_filename(db_item.contents_json, streaming_data['quality'])
-                        break
-
-                if not streaming_data:
-                    P.logger.error('No streaming data')
-                    db_item.ffmpeg_status = "ERROR"
-                    db_item.ffmpeg_status_kor = "스트리밍 정보 없음"
+                callback_id = f"{P.package_name}_{self.name}_{db_item.id}"
+                if self.is_in_library(db_item):
+                    CLUSTER.finish(self.name, db_item.episode_code, db_item.quality, True)
+                    db_item.dispatched = True
+                    db_item.completed = True
+                    db_item.completed_time = datetime.datetime.now()
+                    db_item.ffmpeg_status_kor = "이미 받은 파일이 있습니다."
                     db_item.save()
                     self.socketio_callback('status', db_item.as_dict_for_queue())
                     self.download_queue.task_done()
                     continue
-
-                save_path = ToolUtil.make_path(P.ModelSetting.get(f"{self.name}_save_path"))
-                folder_tmp = os.path.join(F.config['path_data'], 'tmp')
-                callback_id = f"{P.package_name}_{self.name}_{db_item.id}"
+                # 다른 모듈과 중복 다운로드 방지
+                if self.follow_in_flight(db_item, db_item.quality):
+                    CLUSTER.finish(self.name, db_item.episode_code, db_item.quality, None)
+                    self.download_queue.task_done()
+                    continue
+                # 재생 주소를 받은 뒤에 슬롯을 잡음
+                self.wait_for_streaming(db_item)
+                if db_item.cancel or db_item.dispatched:
+                    CLUSTER.finish(self.name, db_item.episode_code, db_item.quality, None if db_item.dispatched else False)
+                    self.download_queue.task_done()
+                    continue
+                # 다운로드 슬롯 대기
+                if not ADMISSION.acquire(self.name, callback_id, cancelled=lambda: db_item.cancel):
+                    CLUSTER.finish(self.name, db_item.episode_code, db_item.quality, False)
+                    self.download_queue.task_done()
+                    continue
+                QUEUE_WAIT.observe(time.monotonic() - db_item.queued_at, module=self.name)
+                started = False
                 try:
-                    account = SupportWavve.api.get_account()
-                except Exception:
-                    account = None
-                if account and account.download_proxy:
-                    proxies = {"http": account.download_proxy, "https": account.download_proxy}
-                else:
-                    proxies = None
-                if streaming_data.get('drm'):
-                     # dash
-                    drm_key_request_properties = streaming_data['play_info'].get('drm_key_request_properties')
-                    drm_license_uri = streaming_data['play_info'].get('drm_license_uri')
-                    if not (drm_key_request_properties and drm_license_uri):
-                        P.logger.error(f"Could not download this DRM file: {db_item.filename}")
+                    # 슬롯을 기다리는 동안 만료됐으면 다시 받음
+                    self.wait_for_streaming(db_item)
+                    if db_item.cancel or db_item.dispatched:
+                        self.download_queue.task_done()
+                        continue
+                    streaming_data = None if db_item.resolve_failed else db_item.streaming_data
+                    if streaming_data and REGISTRY.claim(db_item.episode_code, streaming_data['quality'], callback_id):
+                        self.follow_in_flight(db_item, streaming_data['quality'])
+                        CLUSTER.finish(self.name, db_item.episode_code, db_item.quality, None)
+                        self.download_queue.task_done()
+                        continue
+                    db_item.dispatched = True
+
+                    if not streaming_data:
+                        P.logger.error('No streaming data')
+                        db_item.ffmpeg_status = "ERROR"
+                        db_item.ffmpeg_status_kor = "스트리밍 정보 없음"
+                        db_item.save()
+                        self.socketio_callback('status', db_item.as_dict_for_queue())
+                        self.download_queue.task_done()
+                        continue
+
+                    save_path = ToolUtil.make_path(P.ModelSetting.get(f"{self.name}_save_path"))
+                    db_item.save_path = save_path
+                    proxies = POOL.acquire(callback_id)
+                    if streaming_data.get('drm'):
+                        url = streaming_data['play_info']['uri']
+                    else:
+                        url = streaming_data['play_info'].get('hls') or streaming_data.get('playurl')
+                    job = DownloadJob(
+                        callback_id, self.name, streaming_data, url, db_item.episode_code, db_item.output_filename, save_path,
+                        proxies, self.ffmpeg_listener, self.wvtool_callback_function,
+                    )
+                    if not job.license_ready:
+                        P.logger.error(f"Could not download this DRM file: {db_item.output_filename}")
                         P.logger.error(streaming_data['play_info'])
                         db_item.ffmpeg_status = "ERROR"
                         db_item.ffmpeg_status_kor = "DRM 오류"
@@ -222,82 +362,206 @@ class ModuleProgram(PluginModuleBase):
                         self.socketio_callback('status', db_item.as_dict_for_queue())
                         self.download_queue.task_done()
                         continue
+                    downloader = ENGINES.create(job)
+                    # 자막 다운로드
+                    with TRACES.span(callback_id, 'subtitle'):
+                        download_webvtts(
+                            streaming_data.get('subtitles', []),
+                            f"{save_path}/{db_item.output_filename}",
+                            P.ModelSetting.get_list(f'{self.name}_subtitle_langs', delimeter=',')
+                        )
+                    TRANSFERS.start(callback_id, self.name, downloader, os.path.join(save_path, db_item.output_filename))
+                    downloader.start()
+                    started = True
+                    self.download_queue.task_done()
+                finally:
+                    if not started:
+                        ADMISSION.release(callback_id)
+                        POOL.release(callback_id)
+                        REGISTRY.finish(callback_id, False)
+                        CLUSTER.finish(self.name, db_item.episode_code, db_item.quality, False)
+                        TRANSFERS.discard(callback_id)
+                        ENGINES.discard(callback_id)
 
-                    params = {
-                        'callback_id': callback_id,
-                        'logger' : P.logger,
-                        'mpd_url' : streaming_data['play_info']['uri'],
-                        'code' : db_item.episode_code,
-                        'output_filename' : db_item.filename,
-                        'license_headers' : drm_key_request_properties,
-                        'license_url' : drm_license_uri,
-                        'mpd_headers': streaming_data['play_info'].get('mpd_headers'),
-                        'clean' : True,
-                        'folder_tmp': folder_tmp,
-                        'folder_output': save_path,
-                        'proxies': proxies,
-                    }
-                    downloader_cls = REDownloader if P.ModelSetting.get(f'{self.name}_drm') == 'RE' else WVDownloader
-                    downloader = downloader_cls(params, callback_function=self.wvtool_callback_function)
-                else:
-                    uri = streaming_data['play_info'].get('hls') or streaming_data.get('playurl')
-                    headers = streaming_data['play_info'].get('headers')
-                    match P.ModelSetting.get(f'{self.name}_hls'):
-                        case 'RE':
-                            downloader = REDownloader({
-                                'callback_id': callback_id,
-                                'logger': P.logger,
-                                'mpd_url':  uri,
-                                'streaming_protocol': 'hls',
-                                'code' : db_item.episode_code,
-                                'output_filename' : db_item.filename,
-                                'license_url': None,
-                                'mpd_headers': headers,
-                                'clean': True,
-                                'folder_tmp': folder_tmp,
-                                'folder_output': save_path,
-                                'proxies': proxies,
-                            }, self.wvtool_callback_function)
-                        case _:
-                            tmp = SupportWavve.get_prefer_url(uri, headers)
-                            downloader = SupportFfmpeg(
-                                tmp,
-                                db_item.filename,
-                                save_path=save_path,
-                                callback_function=self.ffmpeg_listener,
-                                callback_id=callback_id,
-                                headers=headers
-                            )
-                # 자막 다운로드
-                download_webvtts(
-                    streaming_data.get('subtitles', []),
-                    f"{save_path}/{db_item.filename}",
-                    P.ModelSetting.get_list(f'{self.name}_subtitle_langs', delimeter=',')
-                )
-                downloader.start()
+            except Exception as e:
+                P.logger.exception(str(e))
 
-                self.current_ffmpeg_count += 1
-                self.download_queue.task_done()
+    def wait_for_streaming(self, db_item: 'ModelWavveProgram') -> None:
+        '''재생 주소는 refresher에서 미리 받아 둠'''
+        while not db_item.cancel and not db_item.resolve_failed and is_due(db_item.streaming_data):
+            if self.follow_in_flight(db_item, db_item.quality):
+                break
+            self.refresher.wake()
+            time.sleep(1)
+
+    def is_in_library(self, db_item: 'ModelWavveProgram') -> bool:
+        contents_json = db_item.contents_json or {}
+        path = LIBRARY.find(
+            contentid=db_item.episode_code,
+            programtitle=contents_json.get('programtitle'),
+            episodenumber=contents_json.get('episodenumber'),
+            filename=db_item.filename,
+            quality=db_item.quality,
+        )
+        if path:
+            P.logger.debug(f'Skipped - already in library: {db_item.episode_code} {path}')
+        return bool(path)
+
+    def follow_in_flight(self, db_item: 'ModelWavveProgram', quality: str) -> bool:
+        '''다른 모듈에서 다운로드중이면 그 결과를 따름'''
+        owner = REGISTRY.holder(db_item.episode_code, quality)
+        if not owner or owner == f"{P.package_name}_{self.name}_{db_item.id}":
+            return False
+        if not REGISTRY.attach(db_item.episode_code, quality, lambda completed: self.finish_followed_item(db_item, completed)):
+            return False
+        P.logger.info(f'Already downloading by {owner}: {db_item.episode_code}')
+        db_item.dispatched = True
+        db_item.is_downloading = True
+        db_item.ffmpeg_status_kor = "다른 작업에서 다운로드중"
+        self.socketio_callback('status', db_item.as_dict_for_queue())
+        return True
 
+    def finish_followed_item(self, db_item: 'ModelWavveProgram', completed: bool) -> None:
+        db_item.is_downloading = False
+        if completed:
+            db_item.completed = True
+            db_item.completed_time = datetime.datetime.now()
+            db_item.ffmpeg_status_kor = "다른 작업에서 다운로드 완료"
+            db_item.save()
+        elif not db_item.cancel:
+            # 직접 다시 받음
+            P.logger.info(f'Followed download failed, queue again: {db_item.episode_code}')
+            if db_item in ModelWavveProgram.queue_list:
+                ModelWavveProgram.queue_list.remove(db_item)
+            self.enqueue(db_item)
+        self.socketio_callback('status', db_item.as_dict_for_queue())
+
+    def get_waiting_items(self) -> list:
+        return [item for item in ModelWavveProgram.queue_list if not (item.dispatched or item.cancel)]
+
+    def collect_oldest_wait(self) -> list[tuple[dict, float]]:
+        waiting = [item.queued_at for item in self.get_waiting_items()]
+        return [({'module': self.name}, time.monotonic() - min(waiting) if waiting else 0)]
+
+    def refresh_queue_item(self, db_item: 'ModelWavveProgram') -> None:
+        if db_item.dispatched or db_item.cancel:
+            return
+        if REGISTRY.holder(db_item.episode_code, db_item.quality):
+            # 다른 작업이 끝날 때까지 보류
+            return
+        if db_item.resolve_failed or is_due(db_item.streaming_data):
+            P.logger.debug(f'Refresh the play URL: {db_item.episode_code}')
+            try:
+                self.resolve_streaming(db_item)
+            except Exception:
+                P.logger.exception(f'Resolving streaming data failed: {db_item.episode_code}')
+                db_item.resolve_failed = True
+        if not db_item.resolve_failed and db_item.is_drm:
+            prefetch_drm_keys(db_item.episode_code, db_item.streaming_data, get_download_proxies(), f"{P.package_name}_{self.name}_{db_item.id}")
+
+    def resolve_streaming(self, db_item: 'ModelWavveProgram') -> dict | None:
+        callback_id = f"{P.package_name}_{self.name}_{db_item.id}"
+        if not db_item.contents_json:
+            with TRACES.span(callback_id, 'metadata'):
+                contents_json = SupportWavve.vod_contents_contentid(db_item.episode_code)
+            db_item.set_contents_json(contents_json)
+
+        contenttype = 'onairvod' if db_item.contents_json['type'] == 'onair' else 'vod'
+        count = 0
+        if not db_item.contents_json.get('drms'):
+            action = 'hls'
+            db_item.is_drm = False
+        else:
+            action = "dash"
+            db_item.is_drm = True
+        while True:
+            count += 1
+            # 요청한 화질이 없으면 낮은 화질 중 가장 좋은 것
+            with TRACES.span(callback_id, 'resolve'):
+                streaming_data = RESOLVER.resolve(
+                    contenttype, db_item.episode_code, lower_qualities(db_item.quality), action,
+                    programid=db_item.contents_json.get('programid'), contents=db_item.contents_json,
+                )
+            if not streaming_data:
+                if count > 3:
+                    db_item.ffmpeg_status_kor = 'URL실패'
+                    break
+                time.sleep(20)
+            else:
+                db_item.output_filename = SupportWavve.get_filename(db_item.contents_json, streaming_data['quality'])
+                break
+        db_item.streaming_data = streaming_data
+        db_item.resolve_failed = not streaming_data
+        return streaming_data
+
+    def migration(self) -> None:
+        '''override'''
+        try:
+            version = float(P.ModelSetting.get(f'{self.name}_db_version'))
+        except Exception:
+            version = 1
+        with F.app.app_context():
+            try:
+                db_file = F.app.config['SQLALCHEMY_BINDS'][P.package_name].replace('sqlite:///', '').split('?')[0]
+                conn = sqlite3.connect(db_file)
+                with conn:
+                    cs = conn.cursor()
+                    if version < 2:
+                        # JSON 컬럼 분리
+                        migrate_json_columns(cs, 'wavve_program', ('contents_json',))
+                        cs.execute(f'UPDATE "wavve_setting" SET value = "2" WHERE key = "program_db_version"')
+                    if version < 3:
+                        create_indexes(cs, ModelWavveProgram)
+                        cs.execute(f'UPDATE "wavve_setting" SET value = "3" WHERE key = "program_db_version"')
+                    if version < 4:
+                        # 검색용 컬럼
+                        add_columns(cs, 'wavve_program', ('episode_title', 'channelname', 'programgenre', 'filename'))
+                        for row_id, contents in iter_blob_values(cs, 'wavve_program', 'contents_blob_id'):
+                            cs.execute(
+                                'UPDATE "wavve_program" SET episode_title = ?, channelname = ?, programgenre = ? WHERE id = ?',
+                                (contents.get('episodetitle'), contents.get('channelname'), contents.get('genretext'), row_id)
+                            )
+                        cs.execute(f'UPDATE "wavve_setting" SET value = "4" WHERE key = "program_db_version"')
+                    if version < 5:
+                        # 다운로드 구간별 시간
+                        add_columns(cs, 'wavve_program', ('trace',))
+                        cs.execute(f'UPDATE "wavve_setting" SET value = "5" WHERE key = "program_db_version"')
+                    ensure_fts(cs, 'wavve_program')
             except Exception as e:
                 P.logger.exception(str(e))
+            finally:
+                F.db.session.flush()
 
     def db_delete(self, day: int | str) -> int:
         return ModelWavveProgram.delete_all(day=day)
 
     def retry_download_failed(self) -> int:
-        failed_list = ModelWavveProgram.get_failed()
-        for item in failed_list:
-            item.init_for_queue()
-            self.download_queue.put(item)
-        return len(failed_list)
+        total = ModelWavveProgram.count_failed()
+        if total > BULK_SIZE:
+            if not self.start_bulk(total, self.run_bulk, total, ModelWavveProgram.iter_failed(BULK_SIZE)):
+                P.logger.warning('Skipped retrying failed items - already queueing in bulk')
+                return 0
+        elif total:
+            self.run_bulk(total, ModelWavveProgram.iter_failed(BULK_SIZE))
+        return total
 
     def ffmpeg_listener(self, **arg) -> None:
+        # 다른 엔진으로 다시 받는 중
+        if arg['type'] == 'last' and ENGINES.finish(arg['callback_id'], arg['status'], arg['data'].get('save_fullpath')):
+            return
         if arg['type'] == 'last':
-            self.current_ffmpeg_count += -1
+            completed = int(arg['status']) == 7 or arg['data']['percent'] == 100
+            ADMISSION.release(arg['callback_id'])
+            POOL.release(arg['callback_id'], None if arg['status'] == SupportFfmpeg.Status.USER_STOP else completed, arg['data'].get('save_fullpath'))
+            REGISTRY.finish(arg['callback_id'], completed)
+            TRANSFERS.finish(arg['callback_id'], arg['status'], arg['data'].get('save_fullpath'))
+        elif arg['type'] == 'status_change':
+            TRACES.on_status(arg['callback_id'], arg['status'])
 
         db_item = ModelWavveProgram.get_by_id_in_queue(arg['callback_id'].split('_')[-1])
         if not db_item:
+            if arg['type'] == 'last':
+                TRACES.pop(arg['callback_id'])
             return
 
         db_item.ffmpeg_arg = arg
@@ -311,13 +575,25 @@ class ModuleProgram(PluginModuleBase):
            str(arg['status']) in ['완료']:
                 db_item.completed = True
                 db_item.completed_time = datetime.datetime.now()
+                db_item.filename = db_item.output_filename or db_item.filename
                 db_item.save()
+                if arg['type'] == 'last' and db_item.save_path:
+                    with TRACES.span(arg['callback_id'], 'finalize'):
+                        LIBRARY.add(os.path.join(db_item.save_path, db_item.filename), db_item.episode_code)
         if arg['type'] == 'last':
+            db_item.trace = TRACES.pop(arg['callback_id'])
+            db_item.save()
             db_item.is_downloading = False
+            CLUSTER.finish(self.name, db_item.episode_code, db_item.quality, int(arg['status']) == 7 or arg['data']['percent'] == 100)
 
         self.socketio_callback('status', db_item.as_dict_for_queue())
 
     def wvtool_callback_function(self, args):
+        TRACES.on_status(args['data']['callback_id'], args['status'])
+        REGISTRY.touch(args['data']['callback_id'])
+        # 다른 엔진으로 다시 받는 중
+        if ENGINES.finish(args['data']['callback_id'], args['status']):
+            return
         db_item = ModelWavveProgram.get_by_id_in_queue(args['data']['callback_id'].split('_')[-1])
 
         if not db_item:
@@ -335,20 +611,45 @@ class ModuleProgram(PluginModuleBase):
                 db_item.ffmpeg_status_kor = "사용자 중지"
             case 'COMPLETED':
                 db_item.ffmpeg_status_kor = f"{args['data']['output_filename']} 다운로드 완료"
+                db_item.filename = args['data']['output_filename']
+                if db_item.save_path:
+                    with TRACES.span(args['data']['callback_id'], 'finalize'):
+                        LIBRARY.add(os.path.join(db_item.save_path, args['data']['output_filename']), db_item.episode_code)
             case 'DOWNLOADING':
                 is_last = False
                 db_item.is_downloading = True
                 db_item.ffmpeg_status_kor = "DRM 다운로드중"
+            case 'FETCHED':
+                # 네트워크 작업이 끝나면 슬롯 반환
+                is_last = False
+                ADMISSION.release(args['data']['callback_id'])
+                POOL.release(args['data']['callback_id'], True)
+                db_item.ffmpeg_status_kor = "먹싱 대기중"
+            case 'DECRYPTING':
+                is_last = False
+                db_item.ffmpeg_status_kor = "복호화중"
+            case 'MUXING':
+                is_last = False
+                db_item.ffmpeg_status_kor = "먹싱중"
             case "ERROR":
                 db_item.completed = False
                 db_item.etc_abort = 34
                 db_item.save()
 
         if is_last:
-            self.current_ffmpeg_count += -1
+            ADMISSION.release(args['data']['callback_id'])
+            POOL.release(
+                args['data']['callback_id'],
+                {'COMPLETED': True, 'ERROR': False}.get(args['status']),
+                os.path.join(db_item.save_path or '', args['data']['output_filename']),
+            )
+            REGISTRY.finish(args['data']['callback_id'], args['status'] in ('COMPLETED', 'EXIST_OUTPUT_FILEPATH'))
+            TRANSFERS.finish(args['data']['callback_id'], args['status'])
+            CLUSTER.finish(self.name, db_item.episode_code, db_item.quality, args['status'] in ('COMPLETED', 'EXIST_OUTPUT_FILEPATH'))
             db_item.is_downloading = False
             db_item.completed = True
             db_item.completed_time = datetime.datetime.now()
+            db_item.trace = TRACES.pop(args['data']['callback_id'])
             db_item.save()
 
         self.socketio_callback('status', db_item.as_dict_for_queue())
@@ -358,21 +659,33 @@ class ModelWavveProgram(ModelBase):
 
     P = P
     __tablename__ = f'{P.package_name}_program'
-    __table_args__ = {'mysql_collate': 'utf8_general_ci'}
+    __table_args__ = (
+        F.db.Index(f'ix_{P.package_name}_program_completed', 'completed'),
+        F.db.Index(f'ix_{P.package_name}_program_episode', 'episode_code', 'quality'),
+        {'mysql_collate': 'utf8_general_ci'},
+    )
     __bind_key__ = P.package_name
 
     id = F.db.Column(F.db.Integer, primary_key=True)
     created_time = F.db.Column(F.db.DateTime)
     completed_time = F.db.Column(F.db.DateTime)
-    contents_json = F.db.Column(F.db.JSON)
+    # wavve_blob.id
+    contents_blob_id = F.db.Column(F.db.Integer)
+    contents_json = BlobField('contents_blob_id')
     episode_code = F.db.Column(F.db.String)
     program_id = F.db.Column(F.db.String)
     quality = F.db.Column(F.db.String)
     program_title = F.db.Column(F.db.String)
     episode_number = F.db.Column(F.db.String)
+    episode_title = F.db.Column(F.db.String)
+    channelname = F.db.Column(F.db.String)
+    programgenre = F.db.Column(F.db.String)
+    filename = F.db.Column(F.db.String)
     thumbnail = F.db.Column(F.db.String)
     programimage = F.db.Column(F.db.String)
     completed = F.db.Column(F.db.Boolean)
+    # [[구간, 시작(ms), 걸린 시간(ms)], ...]
+    trace = F.db.Column(F.db.String)
 
     current_queue_id = 1
     queue_list = []
@@ -390,11 +703,17 @@ class ModelWavveProgram(ModelBase):
         self.ffmpeg_status_kor = '대기중'
         self.ffmpeg_percent = 0
         self.queue_created_time = datetime.datetime.now().strftime('%m-%d %H:%M:%S')
+        self.queued_at = time.monotonic()
         self.ffmpeg_data = None
         self.cancel = False
         self.is_drm = False
         self.is_downloading = False
-        self.filename = None
+        # 이번에 받을 파일명, filename 컬럼은 받은 뒤에 기록
+        self.output_filename = None
+        self.streaming_data = None
+        self.resolve_failed = False
+        self.dispatched = False
+        self.save_path = None
         self.queue_list.append(self)
 
     @classmethod
@@ -414,18 +733,27 @@ class ModelWavveProgram(ModelBase):
         self.program_id = data['programid']
         self.program_title = data['programtitle']
         self.episode_number = data['episodenumber']
+        self.episode_title = data.get('episodetitle')
+        self.channelname = data.get('channelname')
+        self.programgenre = data.get('genretext')
         self.thumbnail = data['image']
         self.programimage = data['programimage']
         self.program_id = data['programid']
         self.is_drm = True if data['drms'] else False
         self.save()
+        THUMBNAIL.prewarm(self.thumbnail, self.programimage)
+
+    # 오버라이딩
+    @classmethod
+    def web_list(cls, req: flask.Request) -> dict:
+        return PROGRAM_PAGER.web_list(req)
 
     # 오버라이딩
     @classmethod
     def make_query(cls, req: flask.Request, order: str = 'desc', search: str = '', option1: str = 'all', option2: str = 'all') -> Query:
         with F.app.app_context():
             query = F.db.session.query(cls)
-            query = cls.make_query_search(query, search, cls.program_title)
+            query = search_query(cls, query, search, cls.program_title)
 
             if option1 == 'completed':
                 query = query.filter_by(completed=True)
@@ -446,9 +774,37 @@ class ModelWavveProgram(ModelBase):
             return count
 
     @classmethod
-    def get_failed(cls) -> list:
+    def count_failed(cls) -> int:
+        with F.app.app_context():
+            return F.db.session.query(F.db.func.count(cls.id)).filter_by(completed=False).scalar() or 0
+
+    @classmethod
+    def iter_failed(cls, size: int) -> Iterable[list['ModelWavveProgram']]:
+        '''id 순으로 size개씩'''
+        last_id = 0
+        while True:
+            with F.app.app_context():
+                chunk = F.db.session.query(cls) \
+                    .filter(cls.completed == False, cls.id > last_id) \
+                    .order_by(cls.id).limit(size).all()
+            if not chunk:
+                return
+            last_id = chunk[-1].id
+            yield chunk
+
+    @classmethod
+    def create_all(cls, pairs: list[tuple[str, str]]) -> list['ModelWavveProgram']:
+        '''한 번의 트랜잭션으로 추가'''
+        db_items = [cls(code, quality) for code, quality in pairs]
+        if not db_items:
+            return db_items
         with F.app.app_context():
-            return F.db.session.query(ModelWavveProgram).filter_by(completed=False).all()
+            F.db.session.add_all(db_items)
+            F.db.session.commit()
+            for db_item in db_items:
+                # commit 후 만료된 속성을 세션 안에서 다시 읽음
+                db_item.id
+        return db_items
 
     ### only for queue
     @classmethod
@@ -469,3 +825,10 @@ class ModelWavveProgram(ModelBase):
         ret['cancel'] = self.cancel
         ret['is_downloading'] = self.is_downloading
         return ret
+
+
+# 목록 페이지에서 쓰는 컬럼
+PROGRAM_PAGER = KeysetPager(ModelWavveProgram, (
+    'id', 'created_time', 'completed_time', 'episode_code', 'program_id', 'quality', 'program_title',
+    'episode_number', 'thumbnail', 'programimage', 'completed', 'trace',
+), images=('thumbnail', 'programimage'))
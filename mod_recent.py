@@ -3,7 +3,9 @@ import re
 import time
 import json
 import datetime
-from typing import Iterable
+import threading
+import contextlib
+from typing import Iterable, Iterator
 from pathlib import Path
 from urllib.parse import parse_qsl
 
@@ -19,15 +21,34 @@ from plugin.logic_module_base import PluginModuleBase
 from plugin.model_base import ModelBase
 from support.expand.ffmpeg import SupportFfmpeg
 from support_site import SupportWavve, SiteUtil
-from wv_tool import WVDownloader
 
 from .setup import F, P
-from .downloader import REDownloader, download_webvtts
+from .downloader import download_webvtts, prefetch_drm_keys
+from .engines import ENGINES, DownloadJob
+from .resolver import RESOLVER
+from .refresher import PlayUrlRefresher, is_due
+from .admission import ADMISSION
+from .proxies import POOL, get_download_proxies
+from .registry import REGISTRY
+from .library import LIBRARY
+from .cluster import CLUSTER
+from .blob import BlobField, ModelWavveBlob, migrate_json_columns, add_columns
+from .paging import KeysetPager
+from .maintenance import create_indexes
+from .prune import HistoryPruner
+from .search import ensure_fts, search_query
+from .thumbnail import THUMBNAIL
+from .replay import REPLAY
+from .bench_recent import RECENT_BENCHMARK
+from .tracing import TRACES
+from .metrics import TRANSFERS, QUEUE_WAIT, RECENT_ROWS, SCHEDULER_PHASE, count_retries
 
 
 name = 'recent'
 CONFIG = P.ModelSetting
 SPLITTER = re.compile(r'[|`\^]+')
+# 다운로드 시작 후 다음 항목까지 대기(초)
+DISPATCH_INTERVAL = 10
 
 
 def setting_get_json(key: str) -> dict | list:
@@ -65,7 +86,7 @@ class ModuleRecent(PluginModuleBase):
         super(ModuleRecent, self).__init__(P, 'list', scheduler_desc="웨이브 최근 방송 다운로드")
         self.name = name
         self.db_default = {
-            f"{self.name}_db_version": "1.2",
+            f"{self.name}_db_version": "1.6",
             f"{P.package_name}_{self.name}_last_list_option": "",
             f"{self.name}_interval": "30",
             f"{self.name}_auto_start": "False",
@@ -88,6 +109,7 @@ class ModuleRecent(PluginModuleBase):
             f"{self.name}_2160_wait_minute": "100",
             f"{self.name}_auto_db_clear": "False",
             f"{self.name}_auto_db_days": "7",
+            f"{self.name}_auto_db_archive": "False",
             f"{self.name}_search_tags": "[]",
             f"{self.name}_search_keywords": "",
             f"{self.name}_search_exclude_keywords": "",
@@ -97,12 +119,20 @@ class ModuleRecent(PluginModuleBase):
             f"{self.name}_drm": "WV",
             f"{self.name}_subtitle_langs": "all",
             f"{self.name}_hls": "WV",
+            f"{self.name}_process_nice": "10",
+            f"{self.name}_process_ionice": "best-effort",
+            f"{self.name}_cgroup_cpu_weight": "0",
+            f"{self.name}_cgroup_io_weight": "0",
             f"{self.name}_max_retry": "20",
         }
         self.web_list_model = ModelWavveRecent
-        self.current_download_count = 0
         self.schedule_running = False
         self.schedule_started_at = datetime.datetime(1900, 1, 1, 0, 0, 0, 0)
+        # 재생 주소를 받고 있는 vod.id, 스케쥴러와 refresher가 같은 항목을 받지 않도록
+        self.retrieving = set()
+        self.retrieving_lock = threading.Lock()
+        self.refresher = PlayUrlRefresher(self.name, lambda: ModelWavveRecent.get_episodes_by_etc_abort(0), self.refresh_recent_vod)
+        RECENT_ROWS.collect(lambda: ModelWavveRecent.count_by_etc_abort())
 
     def process_menu(self, page_name: str, req: flask.Request) -> flask.Response:
         arg = {}
@@ -133,12 +163,53 @@ class ModuleRecent(PluginModuleBase):
                     P.ModelSetting.set(mode, old_str)
                     ret['msg'] = "추가하였습니다."
             case 'reset_status_of_all':
-                for vod in ModelWavveRecent.get_list():
-                    vod.completed = False
-                    vod.user_abort = False
-                    vod.pf_abort = False
-                    vod.etc_abort = 0
-                    vod.save()
+                count = ModelWavveRecent.reset_all_status()
+                ret['msg'] = f"{count}개 항목을 초기화 했습니다."
+            case 'json':
+                vod = ModelWavveRecent.get_by_id(arg1)
+                if vod:
+                    ret['data'] = vod.as_dict()
+                    for key in ('recent_json', 'contents_json', 'streaming_json'):
+                        ret['data'][key] = getattr(vod, key)
+                else:
+                    ret['ret'] = 'warning'
+                    ret['msg'] = "항목이 없습니다."
+            case 'replay_record':
+                try:
+                    if REPLAY.recording:
+                        ret['msg'] = f"기록을 마쳤습니다: {REPLAY.stop_recording()}"
+                    else:
+                        ret['msg'] = f"API 응답을 기록합니다: {REPLAY.start_recording(arg1)}"
+                except Exception as e:
+                    ret['ret'] = 'warning'
+                    ret['msg'] = str(e)
+            case 'replay_run':
+                try:
+                    rows = int(arg2 or 1000)
+                    ret['data'] = REPLAY.run(self, ModelWavveRecent, arg1, rows)
+                    ret['msg'] = f"재생을 마쳤습니다: {ret['data']['total_ms']}ms"
+                    ret['json'] = ret['data']
+                    ret['title'] = '재생 결과'
+                except Exception as e:
+                    P.logger.exception(str(e))
+                    ret['ret'] = 'warning'
+                    ret['msg'] = f"재생하지 못 했습니다: {e}"
+            case 'recent_benchmark':
+                try:
+                    RECENT_BENCHMARK.start(self, ModelWavveRecent, RECENT_PAGER, json.loads(arg1) if arg1 else {})
+                    ret['msg'] = "벤치마크를 시작했습니다. 결과는 로그와 data/wavve/benchmark 폴더에 남습니다."
+                except Exception as e:
+                    ret['ret'] = 'warning'
+                    ret['msg'] = f"벤치마크를 시작하지 못 했습니다: {e}"
+            case 'recent_benchmark_result':
+                if RECENT_BENCHMARK.running:
+                    ret['msg'] = "벤치마크 실행 중입니다."
+                elif RECENT_BENCHMARK.last_report:
+                    ret['json'] = RECENT_BENCHMARK.last_report
+                    ret['title'] = '벤치마크 결과'
+                else:
+                    ret['ret'] = 'warning'
+                    ret['msg'] = "결과가 없습니다."
             case 'retrieve':
                 vod = ModelWavveRecent.get_by_id(arg1)
                 try:
@@ -188,7 +259,8 @@ class ModuleRecent(PluginModuleBase):
                             'recent_whitelist_first_episode_download',
                             'recent_2160_receive_1080',
                             'recent_auto_start',
-                            'recent_auto_db_clear'
+                            'recent_auto_db_clear',
+                            'recent_auto_db_archive',
                         ):
                             value = (form_data.get(key) or '').lower() in ('on', 'true', 'yes')
                             CONFIG.set(key, 'True' if value else 'False')
@@ -221,6 +293,10 @@ class ModuleRecent(PluginModuleBase):
         '''override'''
         super().setting_save_after(change_list)
 
+    def plugin_load(self) -> None:
+        '''override'''
+        self.refresher.start()
+
     def get_recent_vods(self) -> list[dict]:
         search_keywords = setting_get_list(f'{self.name}_search_keywords')
         search_exclude_keywords = setting_get_list(f'{self.name}_search_exclude_keywords')
@@ -237,6 +313,7 @@ class ModuleRecent(PluginModuleBase):
         else:
             vod = ModelWavveRecent('recent', info=recent_vod)
         vod.save()
+        THUMBNAIL.prewarm(vod.image)
         P.logger.debug(f"[{vod.content_type}] [{vod.programtitle}] [{vod.episodenumber}] [{vod.episodetitle}] [{vod.contentid}]")
         return vod
 
@@ -244,10 +321,19 @@ class ModuleRecent(PluginModuleBase):
         for vod in vods:
             self.save_recent_vod(vod)
 
+    def is_in_library(self, vod: 'ModelWavveRecent', quality: str) -> bool:
+        if path := LIBRARY.find(vod.contentid, vod.programtitle, vod.episodenumber, vod.filename, quality):
+            P.logger.debug(f'Skipped - already in library: {vod.contentid} {path}')
+            return True
+        return False
+
     def pick_out_recent_vod(self, vod: 'ModelWavveRecent', settings: dict) -> None:
         if vod.completed:
             vod.etc_abort = 32
             return
+        if self.is_in_library(vod, settings['quality']):
+            vod.etc_abort = 19
+            return
         if vod.retry >= P.ModelSetting.get_int(f"{self.name}_max_retry"):
             P.logger.warning(f'Too many retires: {vod.contentid}')
             vod.etc_abort = 9
@@ -359,7 +445,11 @@ class ModuleRecent(PluginModuleBase):
             return
         if vod.quality != settings['quality']:
             if settings['quality'] == '2160p' and vod.quality == '1080p' and settings['uhd_wait']:
-                if vod.created_time + datetime.timedelta(minutes=settings['uhd_wait_min']) > datetime.datetime.now():
+                # UHD를 제공한 적 없는 프로그램은 기다리지 않음
+                if RESOLVER.never_offered(vod.programid, '2160p'):
+                    P.logger.debug(f'Skipped UHD wait - never offered: {vod.programtitle} {vod.contentid}')
+                    vod.etc_abort = 0
+                elif vod.created_time + datetime.timedelta(minutes=settings['uhd_wait_min']) > datetime.datetime.now():
                     vod.etc_abort = 5
                     return
                 else:
@@ -401,8 +491,13 @@ class ModuleRecent(PluginModuleBase):
             finally:
                 vod.save()
 
+    def get_callback_id(self, vod: 'ModelWavveRecent') -> str:
+        return f'{P.package_name}_{self.name}_{vod.id}'
+
     def retrieve_recent_vod(self, vod: 'ModelWavveRecent', settings: dict) -> None:
-        contents_json = SupportWavve.vod_contents_contentid(vod.contentid)
+        callback_id = self.get_callback_id(vod)
+        with TRACES.span(callback_id, 'metadata'):
+            contents_json = SupportWavve.vod_contents_contentid(vod.contentid)
         if not contents_json:
             P.logger.warning(f'Skipped - no content details: {vod.contentid}')
             vod.etc_abort = 33
@@ -410,7 +505,12 @@ class ModuleRecent(PluginModuleBase):
             return
         vod.set_contents_json(contents_json)
         action = 'dash' if contents_json.get('drms') else 'hls'
-        streaming_data = SupportWavve.streaming(vod.content_type, vod.contentid, settings['quality'], action=action)
+        # UHD 대기 중에는 1080p도 같이 요청
+        qualities = [settings['quality']]
+        if settings['quality'] == '2160p' and settings['uhd_wait']:
+            qualities.append('1080p')
+        with TRACES.span(callback_id, 'resolve'):
+            streaming_data = RESOLVER.resolve(vod.content_type, vod.contentid, qualities, action, programid=vod.programid, contents=contents_json)
         if not streaming_data:
             P.logger.warning(f'Skipped - no streaming data: {vod.contentid}')
             vod.etc_abort = 33
@@ -422,53 +522,192 @@ class ModuleRecent(PluginModuleBase):
             vod.etc_abort = 18
             return
 
+    @contextlib.contextmanager
+    def claim_retrieval(self, vod: 'ModelWavveRecent') -> Iterator[bool]:
+        '''False: 다른 스레드에서 이 항목의 재생 주소를 받고 있음'''
+        with self.retrieving_lock:
+            claimed = vod.id not in self.retrieving
+            if claimed:
+                self.retrieving.add(vod.id)
+        try:
+            yield claimed
+        finally:
+            if claimed:
+                with self.retrieving_lock:
+                    self.retrieving.discard(vod.id)
+
+    def refresh_recent_vod(self, vod: 'ModelWavveRecent') -> None:
+        if vod.etc_abort != 0:
+            return
+        if is_due(vod.streaming_json):
+            with self.claim_retrieval(vod) as claimed:
+                if not claimed:
+                    # 스케쥴러에서 받고 있음
+                    return
+                P.logger.debug(f'Refresh the play URL: {vod.contentid}')
+                try:
+                    self.retrieve_recent_vod(vod, self.retrieve_settings)
+                except Exception:
+                    P.logger.exception(f"{vod.programtitle} [{vod.episodenumber}] {vod.contentid}")
+                    vod.retry += 1
+                finally:
+                    vod.save()
+        if vod.etc_abort == 0 and vod.drm:
+            prefetch_drm_keys(vod.contentid, vod.streaming_json, get_download_proxies(), self.get_callback_id(vod))
+
     @property
     def retrieve_settings(self) -> dict:
         return {
             'quality': P.ModelSetting.get(f"{self.name}_quality"),
+            'uhd_wait': P.ModelSetting.get_bool('recent_2160_receive_1080'),
         }
 
+    def follow_in_flight(self, vod: 'ModelWavveRecent', quality: str) -> bool:
+        '''다른 모듈에서 다운로드중이면 그 결과를 따름'''
+        owner = REGISTRY.holder(vod.contentid, quality)
+        if not owner or owner == self.get_callback_id(vod):
+            return False
+        vod_id = vod.id
+        if not REGISTRY.attach(vod.contentid, quality, lambda completed: self.finish_followed_vod(vod_id, completed)):
+            return False
+        P.logger.info(f'Already downloading by {owner}: {vod.contentid}')
+        vod.etc_abort = 31
+        return True
+
+    def finish_followed_vod(self, vod_id: int, completed: bool) -> None:
+        vod = ModelWavveRecent.get_by_id(vod_id)
+        if not vod:
+            return
+        if completed:
+            vod.completed = True
+            vod.end_time = datetime.datetime.now()
+            vod.etc_abort = 32
+        else:
+            vod.etc_abort = 0
+        vod.save()
+
     def retrieve_recent_vods(self, vods: Iterable['ModelWavveRecent']) -> None:
         settings = self.retrieve_settings
         for vod in vods:
-            try:
-                P.logger.debug(f'Retrieve vod: {vod.contentid}')
-                self.retrieve_recent_vod(vod, settings)
-            except Exception:
-                P.logger.exception(f"{vod.programtitle} [{vod.episodenumber}] {vod.contentid}")
-                vod.retry += 1
-            finally:
-                vod.save()
+            with self.claim_retrieval(vod) as claimed:
+                if not claimed:
+                    # refresher에서 받고 있음, 저장하면 그 결과를 덮어씀
+                    P.logger.debug(f'Skipped - refreshing: {vod.contentid}')
+                    continue
+                try:
+                    if self.is_in_library(vod, settings['quality']):
+                        vod.etc_abort = 19
+                        continue
+                    if self.follow_in_flight(vod, settings['quality']):
+                        continue
+                    P.logger.debug(f'Retrieve vod: {vod.contentid}')
+                    self.retrieve_recent_vod(vod, settings)
+                except Exception:
+                    P.logger.exception(f"{vod.programtitle} [{vod.episodenumber}] {vod.contentid}")
+                    vod.retry += 1
+                finally:
+                    vod.save()
 
     def scheduler_function(self) -> None:
         P.logger.debug(f'Schedule starts...')
+        # 여러 서버로 운영시 탐색은 선출된 노드에서만
+        if CLUSTER.is_leader:
+            self.update_recent_vods()
+            if CLUSTER.enabled:
+                with SCHEDULER_PHASE.time(module=self.name, phase='publish'):
+                    self.publish_recent_vods()
+        with SCHEDULER_PHASE.time(module=self.name, phase='dispatch'):
+            self.dispatch_recent_vods()
+
+    def update_recent_vods(self) -> None:
         if P.ModelSetting.get_bool(f"{self.name}_auto_db_clear"):
-            self.db_delete(P.ModelSetting.get_int(f"{self.name}_auto_db_days"))
-        try:
-            P.logger.debug(f'Update new vods...')
-            self.save_recent_vods(self.get_recent_vods())
-        except Exception as e:
-            P.logger.exception(str(e))
-        retry_vods = []
-        # UHD 대기, QVOD 방송중, 사용자 중지, 다운로드 도중 실패, 다운로드 오류 재시도
-        for etc_abort in (5, 8, 30, 31, 34):
-            retry_vods.extend(ModelWavveRecent.get_episodes_by_etc_abort(etc_abort))
-        P.logger.debug(f'Retry vods...')
-        self.pick_out_recent_vods(retry_vods)
-        # 데이터 갱신 실패 재시도
-        P.logger.debug(f'Retry vods failed while retrieving...')
-        for vod in ModelWavveRecent.get_episodes_by_etc_abort(33):
-            if vod.retry < P.ModelSetting.get_int(f"{self.name}_max_retry"):
-                vod.etc_abort = 0
-                vod.save()
-            else:
-                P.logger.debug(f'Retry limit exceeded: {vod.programtitle} [{vod.episodenumber}] {vod.contentid}')
+            # 백그라운드에서 나눠서 삭제
+            RECENT_PRUNER.request(
+                P.ModelSetting.get_int(f"{self.name}_auto_db_days"),
+                P.ModelSetting.get_bool(f"{self.name}_auto_db_archive"),
+            )
+        self.prune_payloads()
+        with SCHEDULER_PHASE.time(module=self.name, phase='discover'):
+            try:
+                P.logger.debug(f'Update new vods...')
+                self.save_recent_vods(self.get_recent_vods())
+            except Exception as e:
+                P.logger.exception(str(e))
+        with SCHEDULER_PHASE.time(module=self.name, phase='retry'):
+            retry_vods = []
+            # UHD 대기, QVOD 방송중, 사용자 중지, 다운로드 도중 실패, 다운로드 오류 재시도
+            for etc_abort in (5, 8, 30, 31, 34):
+                retry_vods.extend(ModelWavveRecent.get_episodes_by_etc_abort(etc_abort))
+            P.logger.debug(f'Retry vods...')
+            self.pick_out_recent_vods(retry_vods)
+            # 데이터 갱신 실패 재시도
+            P.logger.debug(f'Retry vods failed while retrieving...')
+            for vod in ModelWavveRecent.get_episodes_by_etc_abort(33):
+                if vod.retry < P.ModelSetting.get_int(f"{self.name}_max_retry"):
+                    vod.etc_abort = 0
+                    vod.save()
+                else:
+                    P.logger.debug(f'Retry limit exceeded: {vod.programtitle} [{vod.episodenumber}] {vod.contentid}')
         # JSON 새로고침
-        P.logger.debug(f'Retrieving vods...')
-        self.retrieve_recent_vods(ModelWavveRecent.get_episodes_by_etc_abort(0))
+        with SCHEDULER_PHASE.time(module=self.name, phase='retrieve'):
+            P.logger.debug(f'Retrieving vods...')
+            self.retrieve_recent_vods(ModelWavveRecent.get_episodes_by_etc_abort(0))
         # 최종 점검
-        P.logger.debug(f'Pick out vods...')
-        self.pick_out_recent_vods(ModelWavveRecent.get_episodes_by_etc_abort(0))
+        with SCHEDULER_PHASE.time(module=self.name, phase='pick_out'):
+            P.logger.debug(f'Pick out vods...')
+            self.pick_out_recent_vods(ModelWavveRecent.get_episodes_by_etc_abort(0))
+
+    def publish_recent_vods(self) -> None:
+        '''다운로드 할 항목을 공유 작업 목록에 등록'''
+        for vod in ModelWavveRecent.get_episodes_by_etc_abort(0):
+            payload = {
+                'recent_json': vod.recent_json,
+                'contents_json': vod.contents_json,
+                'streaming_json': vod.streaming_json,
+            }
+            try:
+                status = CLUSTER.publish(self.name, vod.contentid, vod.quality, payload)
+            except Exception:
+                P.logger.exception(f'Publishing job failed: {vod.contentid}')
+                continue
+            match status:
+                case 'completed':
+                    vod.completed = True
+                    vod.end_time = datetime.datetime.now()
+                    vod.etc_abort = 32
+                case 'leased':
+                    vod.etc_abort = 31
+                case 'failed':
+                    vod.retry += 1
+                case _:
+                    continue
+            vod.save()
+
+    def accept_cluster_job(self, job: dict) -> 'ModelWavveRecent':
+        '''공유 작업을 이 노드의 DB 항목으로'''
+        payload = job['payload']
+        vod = self.save_recent_vod(payload['recent_json'])
+        if payload.get('contents_json'):
+            vod.set_contents_json(payload['contents_json'])
+        if payload.get('streaming_json') and is_due(vod.streaming_json):
+            vod.set_streaming(payload['streaming_json'])
+        vod.etc_abort = 0
+        vod.save()
+        return vod
+
+    def get_dispatch_vods(self) -> list['ModelWavveRecent']:
+        if not CLUSTER.enabled:
+            return ModelWavveRecent.get_episodes_by_etc_abort(0)
+        vods = []
+        for job in CLUSTER.claim(self.name, ADMISSION.available(self.name)):
+            try:
+                vods.append(self.accept_cluster_job(job))
+            except Exception:
+                P.logger.exception(f'Accepting job failed: {job["job_key"]}')
+                CLUSTER.finish(self.name, job['contentid'], job['quality'], None)
+        return vods
+
+    def dispatch_recent_vods(self) -> None:
         try:
             if self.schedule_running:
                 P.logger.warning(f'Schedule is already running.')
@@ -476,8 +715,9 @@ class ModuleRecent(PluginModuleBase):
             self.schedule_running = True
             self.schedule_started_at = datetime.datetime.now()
             save_path = ToolUtil.make_path(P.ModelSetting.get(f"{self.name}_save_path"))
-            foler_tmp = os.path.join(F.config['path_data'], 'tmp')
-            for vod in ModelWavveRecent.get_episodes_by_etc_abort(0):
+            for vod in self.get_dispatch_vods():
+                callback_id = self.get_callback_id(vod)
+                started = False
                 try:
                     # 다운로드 준비
                     P.logger.debug(f'Prepare downloading vod: {vod.contentid}')
@@ -485,9 +725,25 @@ class ModuleRecent(PluginModuleBase):
                         P.logger.warning(f'Too many retries: {vod.contentid}')
                         continue
 
-                    if SupportWavve.is_expired(vod.playurl, vod.streaming_json.get('issue')):
-                        P.logger.warning(f'The play URL may have expired, retrieve it: {vod.contentid}')
-                        self.retrieve_recent_vod(vod, self.retrieve_settings)
+                    # 다운로드 슬롯 대기
+                    timeout = (self.schedule_started_at + datetime.timedelta(hours=1) - datetime.datetime.now()).total_seconds()
+                    queued = time.monotonic()
+                    if not ADMISSION.acquire(self.name, callback_id, timeout=max(timeout, 0)):
+                        raise Exception(f'다운로드 대기 시간 초과: {vod.contentid}')
+                    QUEUE_WAIT.observe(time.monotonic() - queued, module=self.name)
+
+                    # 대기하는 동안 갱신된 데이터
+                    vod = ModelWavveRecent.get_by_id(vod.id) or vod
+                    if vod.etc_abort != 0:
+                        continue
+                    if is_due(vod.streaming_json):
+                        P.logger.warning(f'The play URL is not refreshed yet: {vod.contentid}')
+                        self.refresher.wake()
+                        continue
+                    # 다른 모듈과 중복 다운로드 방지
+                    if REGISTRY.claim(vod.contentid, vod.quality, callback_id):
+                        self.follow_in_flight(vod, vod.quality)
+                        continue
 
                     # 장르 별 다운로드 폴더 사용
                     if vod.programgenre in P.ModelSetting.get_list(f"{self.name}_genre_path_targets", delimeter=","):
@@ -503,91 +759,44 @@ class ModuleRecent(PluginModuleBase):
                     vod.etc_abort = 31
                     # start_time 저장
                     vod.save()
-                    callback_id = f'{P.package_name}_{self.name}_{vod.id}'
-                    try:
-                        account = SupportWavve.api.get_account()
-                    except Exception:
-                        account = None
-                    if account and account.download_proxy:
-                        proxies = {"http": account.download_proxy, "https": account.download_proxy}
-                    else:
-                        proxies = None
-                    if vod.streaming_json.get('drm'):
-                        # dash
-                        drm_key_request_properties = vod.streaming_json['play_info'].get('drm_key_request_properties')
-                        drm_license_uri = vod.streaming_json['play_info'].get('drm_license_uri')
-                        if not (drm_key_request_properties and drm_license_uri):
-                            P.logger(f"Could not download this DRM file: {vod.filename}")
-                            P.logger.error(vod.streaming_json['play_info'])
-                            vod.etc_abort = 0
-                            vod.retry += 1
-                            vod.save()
-                            continue
-
-                        params = {
-                            'callback_id': callback_id,
-                            'logger' : P.logger,
-                            'mpd_url' : vod.playurl,
-                            'code' : vod.contentid,
-                            'output_filename' : vod.filename,
-                            'license_headers' : drm_key_request_properties,
-                            'license_url' : drm_license_uri,
-                            'mpd_headers': vod.streaming_json['play_info'].get('mpd_headers'),
-                            'clean' : True,
-                            'folder_tmp': foler_tmp,
-                            'folder_output': vod.save_path,
-                            'proxies': proxies,
-                        }
-                        downloader_cls = REDownloader if P.ModelSetting.get(f'{self.name}_drm') == 'RE' else WVDownloader
-                        downloader = downloader_cls(params, callback_function=self.wvtool_callback_function)
-                    else:
-                        headers = vod.streaming_json['play_info'].get('headers')
-                        match P.ModelSetting.get(f'{self.name}_hls'):
-                            case 'RE':
-                                downloader = REDownloader({
-                                    'callback_id': callback_id,
-                                    'logger': P.logger,
-                                    'mpd_url': vod.playurl,
-                                    'streaming_protocol': 'hls',
-                                    'code' : vod.contentid,
-                                    'output_filename' : vod.filename,
-                                    'license_url': None,
-                                    'mpd_headers': headers,
-                                    'clean': True,
-                                    'folder_tmp': foler_tmp,
-                                    'folder_output': vod.save_path,
-                                    'proxies': proxies,
-                                }, self.wvtool_callback_function)
-                            case _:
-                                downloader = SupportFfmpeg(
-                                    SupportWavve.get_prefer_url(vod.playurl, headers),
-                                    vod.filename,
-                                    save_path=vod.save_path,
-                                    headers=headers,
-                                    callback_id=callback_id,
-                                    callback_function=self.ffmpeg_listener,
-                                )
-                    # 자막 다운로드
-                    download_webvtts(
-                        vod.streaming_json.get('subtitles') or [],
-                        f"{vod.save_path}/{vod.filename}",
-                        P.ModelSetting.get_list(f'{self.name}_subtitle_langs', delimeter=',')
+                    proxies = POOL.acquire(callback_id)
+                    job = DownloadJob(
+                        callback_id, self.name, vod.streaming_json, vod.playurl, vod.contentid, vod.filename, vod.save_path,
+                        proxies, self.ffmpeg_listener, self.wvtool_callback_function,
                     )
+                    if not job.license_ready:
+                        P.logger.error(f"Could not download this DRM file: {vod.filename}")
+                        P.logger.error(vod.streaming_json['play_info'])
+                        vod.etc_abort = 0
+                        vod.retry += 1
+                        vod.save()
+                        continue
+                    downloader = ENGINES.create(job)
+                    # 자막 다운로드
+                    with TRACES.span(callback_id, 'subtitle'):
+                        download_webvtts(
+                            vod.streaming_json.get('subtitles') or [],
+                            f"{vod.save_path}/{vod.filename}",
+                            P.ModelSetting.get_list(f'{self.name}_subtitle_langs', delimeter=',')
+                        )
                     # 다운로드 시작
-                    while self.current_download_count > max(P.ModelSetting.get_int(f"{self.name}_ffmpeg_max_count") - 1, 0):
-                        P.logger.debug(f'The number of downloading: {self.current_download_count} / {P.ModelSetting.get_int(f"{self.name}_ffmpeg_max_count")}')
-                        time.sleep(10)
-                        if self.schedule_started_at + datetime.timedelta(hours=1) < datetime.datetime.now():
-                            raise Exception(f'다운로드 대기 시간 초과: {vod.contentid}')
                     P.logger.debug(f'Downloading starts: {vod.contentid}')
+                    TRANSFERS.start(callback_id, self.name, downloader, os.path.join(vod.save_path, vod.filename))
                     downloader.start()
-                    self.current_download_count += 1
-                    time.sleep(10)
+                    started = True
+                    time.sleep(DISPATCH_INTERVAL)
                 except Exception:
                     P.logger.exception(f'Failed while downloading: {vod.contentid}')
                     vod.retry += 1
                     vod.etc_abort = 0
                 finally:
+                    if not started:
+                        ADMISSION.release(callback_id)
+                        POOL.release(callback_id)
+                        REGISTRY.finish(callback_id, False)
+                        CLUSTER.finish(self.name, vod.contentid, vod.quality, None)
+                        TRANSFERS.discard(callback_id)
+                        ENGINES.discard(callback_id)
                     vod.save()
         except Exception as e:
             P.logger.exception(str(e))
@@ -608,8 +817,6 @@ class ModuleRecent(PluginModuleBase):
                 with conn:
                     conn.row_factory = sqlite3.Row
                     cs = conn.cursor()
-                    # DB 볼륨 정리
-                    cs.execute(f'VACUUM;')
                     if version < 1.1:
                         rows = cs.execute(f'SELECT name FROM pragma_table_info("wavve_recent")').fetchall()
                         cols = [row['name'] for row in rows]
@@ -624,6 +831,18 @@ class ModuleRecent(PluginModuleBase):
                         if save_path:
                             cs.execute(f'UPDATE wavve_setting SET value = "{save_path}" WHERE key = "recent_genre_base_path"')
                         cs.execute(f'UPDATE "wavve_setting" SET value = "1.2" WHERE key = "recent_db_version"')
+                    if version < 1.3:
+                        # JSON 컬럼 분리
+                        migrate_json_columns(cs, 'wavve_recent', ('recent_json', 'contents_json', 'streaming_json'))
+                        cs.execute(f'UPDATE "wavve_setting" SET value = "1.3" WHERE key = "recent_db_version"')
+                    if version < 1.5:
+                        create_indexes(cs, ModelWavveRecent)
+                        cs.execute(f'UPDATE "wavve_setting" SET value = "1.5" WHERE key = "recent_db_version"')
+                    if version < 1.6:
+                        # 다운로드 구간별 시간
+                        add_columns(cs, 'wavve_recent', ('trace',))
+                        cs.execute(f'UPDATE "wavve_setting" SET value = "1.6" WHERE key = "recent_db_version"')
+                    ensure_fts(cs, 'wavve_recent')
             except Exception as e:
                 P.logger.exception(str(e))
             finally:
@@ -632,6 +851,13 @@ class ModuleRecent(PluginModuleBase):
     def db_delete(self, day: str | int) -> int:
         return ModelWavveRecent.delete_all(day=day)
 
+    def prune_payloads(self) -> None:
+        try:
+            ModelWavveRecent.prune_streaming()
+            ModelWavveBlob.prune()
+        except Exception:
+            P.logger.exception('Pruning payloads failed')
+
     def ffmpeg_listener(self, **arg: dict) -> None:
         #P.logger.debug(f'ffmpeg_listener: {arg}')
         episode = None
@@ -640,6 +866,7 @@ class ModuleRecent(PluginModuleBase):
             case 'status_change':
                 match arg['status']:
                     case SupportFfmpeg.Status.DOWNLOADING:
+                        TRACES.on_status(arg['callback_id'], arg['status'])
                         if arg['callback_id'].startswith('wavve_recent'):
                             db_id = arg['callback_id'].split('_')[-1]
                             episode = ModelWavveRecent.get_by_id(db_id)
@@ -652,6 +879,9 @@ class ModuleRecent(PluginModuleBase):
                     case SupportFfmpeg.Status.READY:
                         pass
             case 'last':
+                # 다른 엔진으로 다시 받는 중
+                if ENGINES.finish(arg['callback_id'], arg['status']):
+                    return
                 if arg['callback_id'].startswith('wavve_recent'):
                     db_id = arg['callback_id'].split('_')[-1]
                     episode = ModelWavveRecent.get_by_id(db_id)
@@ -677,6 +907,8 @@ class ModuleRecent(PluginModuleBase):
                             episode.filesize_str = arg['data']['filesize_str']
                             episode.download_speed = arg['data']['download_speed']
                             episode.etc_abort = 32
+                            with TRACES.span(arg['callback_id'], 'finalize'):
+                                LIBRARY.add(os.path.join(episode.save_path, episode.filename), episode.contentid)
                             P.logger.debug('Status.COMPLETED received..')
                         case SupportFfmpeg.Status.TIME_OVER:
                             episode.etc_abort = 2
@@ -688,9 +920,23 @@ class ModuleRecent(PluginModuleBase):
                             episode.etc_abort = 3
                         case SupportFfmpeg.Status.HTTP_FORBIDDEN:
                             episode.etc_abort = 4
+                    episode.trace = TRACES.pop(arg['callback_id'])
                     episode.save()
                     P.logger.debug('LAST commit %s', arg['status'])
-                    self.current_download_count -= 1
+                else:
+                    TRACES.pop(arg['callback_id'])
+                ADMISSION.release(arg['callback_id'])
+                TRANSFERS.finish(arg['callback_id'], arg['status'])
+                match arg['status']:
+                    case SupportFfmpeg.Status.COMPLETED:
+                        POOL.release(arg['callback_id'], True, os.path.join(episode.save_path, episode.filename) if episode else None)
+                    case SupportFfmpeg.Status.USER_STOP:
+                        POOL.release(arg['callback_id'])
+                    case _:
+                        POOL.release(arg['callback_id'], False)
+                REGISTRY.finish(arg['callback_id'], arg['status'] == SupportFfmpeg.Status.COMPLETED)
+                if episode:
+                    CLUSTER.finish(self.name, episode.contentid, episode.quality, arg['status'] == SupportFfmpeg.Status.COMPLETED)
             case 'log':
                 pass
             case 'normal':
@@ -705,6 +951,9 @@ class ModuleRecent(PluginModuleBase):
             READY
             EXIST_OUTPUT_FILEPATH
             DOWNLOADING
+            FETCHED
+            DECRYPTING
+            MUXING
             USER_STOP
             COMPLETED
             SEGMENT_FAIL
@@ -715,10 +964,24 @@ class ModuleRecent(PluginModuleBase):
         if not db_item:
             return
 
+        callback_id = args['data']['callback_id']
+        TRACES.on_status(callback_id, args['status'])
+        REGISTRY.touch(callback_id)
+        # 다른 엔진으로 다시 받는 중
+        if ENGINES.finish(callback_id, args['status'], os.path.join(db_item.save_path or '', args['data']['output_filename'])):
+            return
         is_last = True
         match args['status']:
             case status if status in ["READY", "SEGMENT_FAIL"]:
-                pass
+                # 진행 중인 상태, 끝난 것으로 처리하면 슬롯과 구간 기록이 먼저 정리됨
+                is_last = False
+            case "FETCHED":
+                # 네트워크 작업이 끝나면 슬롯 반환
+                is_last = False
+                ADMISSION.release(callback_id)
+                POOL.release(callback_id, True)
+            case status if status in ["DECRYPTING", "MUXING"]:
+                is_last = False
             case 'USER_STOP':
                 db_item.user_abort = True
                 db_item.etc_abort = 30
@@ -728,7 +991,8 @@ class ModuleRecent(PluginModuleBase):
                 db_item.end_time = datetime.datetime.now()
                 db_item.download_time = (db_item.end_time - db_item.start_time).seconds
                 db_item.etc_abort = 32
-                db_item.save()
+                with TRACES.span(callback_id, 'finalize'):
+                    LIBRARY.add(os.path.join(db_item.save_path, args['data']['output_filename']), db_item.contentid)
             case "DOWNLOADING":
                 is_last = False
             case "ERROR":
@@ -737,22 +1001,44 @@ class ModuleRecent(PluginModuleBase):
                 db_item.save()
 
         if is_last:
-            self.current_download_count -= 1
+            db_item.trace = TRACES.pop(callback_id)
+            db_item.save()
+            ADMISSION.release(callback_id)
+            POOL.release(
+                callback_id,
+                {'COMPLETED': True, 'ERROR': False}.get(args['status']),
+                os.path.join(db_item.save_path or '', args['data']['output_filename']),
+            )
+            REGISTRY.finish(callback_id, args['status'] in ("EXIST_OUTPUT_FILEPATH", "COMPLETED"))
+            TRANSFERS.finish(callback_id, args['status'], os.path.join(db_item.save_path or '', args['data']['output_filename']))
+            CLUSTER.finish(self.name, db_item.contentid, db_item.quality, args['status'] in ("EXIST_OUTPUT_FILEPATH", "COMPLETED"))
 
 
 class ModelWavveRecent(ModelBase):
 
     P = P
     __tablename__ = f'{P.package_name}_recent'
-    __table_args__ = {'mysql_collate': 'utf8_general_ci'}
+    __table_args__ = (
+        F.db.Index(f'ix_{P.package_name}_recent_etc_abort', 'etc_abort', 'call'),
+        F.db.Index(f'ix_{P.package_name}_recent_completed', 'completed'),
+        F.db.Index(f'ix_{P.package_name}_recent_user_abort', 'user_abort'),
+        F.db.Index(f'ix_{P.package_name}_recent_pf_abort', 'pf_abort'),
+        F.db.Index(f'ix_{P.package_name}_recent_contentid', 'contentid'),
+        F.db.Index(f'ix_{P.package_name}_recent_created_time', 'created_time'),
+        {'mysql_collate': 'utf8_general_ci'},
+    )
     __bind_key__ = P.package_name
 
     id = F.db.Column(F.db.Integer, primary_key=True)
     created_time = F.db.Column(F.db.DateTime)
 
-    recent_json = F.db.Column(F.db.JSON)
-    contents_json = F.db.Column(F.db.JSON)
-    streaming_json = F.db.Column(F.db.JSON)
+    # wavve_blob.id
+    recent_blob_id = F.db.Column(F.db.Integer)
+    contents_blob_id = F.db.Column(F.db.Integer)
+    streaming_blob_id = F.db.Column(F.db.Integer)
+    recent_json = BlobField('recent_blob_id')
+    contents_json = BlobField('contents_blob_id')
+    streaming_json = BlobField('streaming_blob_id')
 
     contentid = F.db.Column(F.db.String)
     content_type = F.db.Column(F.db.String)  # movie, episode
@@ -801,7 +1087,7 @@ class ModelWavveRecent(ModelBase):
     16: 에피소드 제외 episodetitle
     17: 패스 - 제외 장르
     18: 패스 - 프리뷰
-    19:
+    19: 패스 - 이미 있는 파일
     20:
     21: many retry
     30: 사용자 중지
@@ -819,6 +1105,8 @@ class ModelWavveRecent(ModelBase):
     filesize = F.db.Column(F.db.Integer)
     filesize_str = F.db.Column(F.db.String)
     download_speed = F.db.Column(F.db.String)
+    # [[구간, 시작(ms), 걸린 시간(ms)], ...]
+    trace = F.db.Column(F.db.String)
 
     def __init__(self, call: str, info: dict, streaming: dict = None, contents: dict = None) -> None:
         self.created_time = datetime.datetime.now()
@@ -882,6 +1170,34 @@ class ModelWavveRecent(ModelBase):
                 .filter_by(etc_abort=etc_abort) \
                 .with_for_update().all()
 
+    @classmethod
+    def count_by_etc_abort(cls) -> list[tuple[dict, int]]:
+        with F.app.app_context():
+            rows = F.db.session.query(cls.etc_abort, F.db.func.count(cls.id)).group_by(cls.etc_abort).all()
+            return [({'etc_abort': etc_abort}, count) for etc_abort, count in rows]
+
+    @classmethod
+    def reset_all_status(cls) -> int:
+        with F.app.app_context():
+            count = F.db.session.query(cls).update({
+                'completed': False,
+                'user_abort': False,
+                'pf_abort': False,
+                'etc_abort': 0,
+            }, synchronize_session=False)
+            F.db.session.commit()
+            return count
+
+    @classmethod
+    def prune_streaming(cls) -> int:
+        '''다운로드 완료된 항목의 스트리밍 정보 삭제'''
+        with F.app.app_context():
+            count = F.db.session.query(cls) \
+                .filter(cls.completed == True, cls.streaming_blob_id != None) \
+                .update({'streaming_blob_id': None}, synchronize_session=False)
+            F.db.session.commit()
+            return count
+
     @classmethod
     def get_episodes_by_user_abort(cls, user_abort: bool) -> list:
         with F.app.app_context():
@@ -890,14 +1206,18 @@ class ModelWavveRecent(ModelBase):
                 .filter_by(user_abort=user_abort) \
                 .with_for_update().all()
 
+    # 오버라이딩
+    @classmethod
+    def web_list(cls, req: flask.Request) -> dict:
+        return RECENT_PAGER.web_list(req)
+
     # 오버라이딩
     @classmethod
     def make_query(cls, req: flask.Request, order: str = 'desc', search: str = '', option1: str = 'all', option2: str = 'all') -> Query:
         with F.app.app_context():
             query = F.db.session.query(cls)
             if search:
-                query = cls.make_query_search(query, search, cls.programtitle)
-                #query = query.filter(or_(cls.programtitle.like('%'+search+'%'), cls.channelname.like('%'+search+'%')))
+                query = search_query(cls, query, search, cls.programtitle)
 
             match option1:
                 case 'completed':
@@ -924,3 +1244,14 @@ class ModelWavveRecent(ModelBase):
                 query = query.order_by(cls.id)
 
             return query
+
+
+# 목록 페이지에서 쓰는 컬럼
+RECENT_PAGER = KeysetPager(ModelWavveRecent, (
+    'id', 'created_time', 'contentid', 'programid', 'image', 'programtitle', 'episodenumber', 'episodetitle',
+    'releasedate', 'channelname', 'programgenre', 'quality', 'vod_type', 'filename', 'drm', 'completed',
+    'user_abort', 'pf_abort', 'etc_abort', 'retry', 'duration', 'filesize_str', 'download_speed',
+    'end_time', 'download_time', 'trace',
+), images=('image',))
+RECENT_PRUNER = HistoryPruner(ModelWavveRecent)
+count_retries(ModelWavveRecent.retry, name)
@@ -0,0 +1,112 @@
+import time
+import datetime
+import threading
+
+import flask
+from sqlalchemy import desc, func
+
+from .setup import F, P
+from .thumbnail import THUMBNAIL, thumbnail_url
+
+
+logger = P.logger
+PAGE_SIZE = 30
+COUNT_TTL = 60
+
+
+class KeysetPager:
+    '''OFFSET 대신 id 범위로 목록을 나눔'''
+
+    def __init__(self, model: type, columns: tuple[str], images: tuple[str] = ()) -> None:
+        self.model = model
+        self.columns = columns
+        # {column}_thumb 으로 프록시 주소 추가
+        self.images = images
+        self.lock = threading.Lock()
+        # signature: {page: 첫 항목의 id}
+        self.anchors = {}
+        # signature: (time, count)
+        self.counts = {}
+
+    def to_dict(self, row: object, thumbnail: tuple[bool, int] = (False, 0)) -> dict:
+        '''thumbnail: (사용 여부, 너비)'''
+        item = {}
+        for column, value in zip(self.columns, row):
+            if isinstance(value, datetime.datetime):
+                value = value.strftime('%m-%d %H:%M:%S')
+            item[column] = value
+        for column in self.images:
+            item[f'{column}_thumb'] = thumbnail_url(item.get(column), *thumbnail)
+        return item
+
+    def count(self, signature: tuple, query: object, fresh: bool) -> int:
+        with self.lock:
+            cached = self.counts.get(signature)
+        if not fresh and cached and cached[0] + COUNT_TTL > time.monotonic():
+            return cached[1]
+        # 인덱스만 읽음
+        count = query.with_entities(func.count(self.model.id)).scalar() or 0
+        with self.lock:
+            self.counts[signature] = (time.monotonic(), count)
+        return count
+
+    def find_anchor(self, signature: tuple, query: object, order: str, page: int, page_size: int) -> int | None:
+        with self.lock:
+            anchor = self.anchors.get(signature, {}).get(page)
+        if anchor is not None:
+            return anchor
+        # 처음 가 보는 페이지는 id 인덱스로 위치만 찾음
+        ordering = desc(self.model.id) if order == 'desc' else self.model.id
+        return query.with_entities(self.model.id).order_by(ordering).offset((page - 1) * page_size).limit(1).scalar()
+
+    def web_list(self, req: flask.Request) -> dict:
+        model = self.model
+        try:
+            page = max(int(req.form.get('page') or 1), 1)
+        except ValueError:
+            page = 1
+        try:
+            page_size = max(int(req.form.get('page_size') or PAGE_SIZE), 1)
+        except ValueError:
+            page_size = PAGE_SIZE
+        search = (req.form.get('keyword') or '').strip()
+        option1 = req.form.get('option1') or 'all'
+        option2 = req.form.get('option2') or 'all'
+        order = req.form.get('order') or 'desc'
+        signature = (order, search, option1, option2, page_size)
+        ret = {}
+        with F.app.app_context():
+            query = model.make_query(req, order=order, search=search, option1=option1, option2=option2).order_by(None)
+            if page == 1:
+                # 새로 들어온 항목이 있으니 처음부터
+                with self.lock:
+                    self.anchors[signature] = {}
+            count = self.count(signature, query, page == 1)
+            anchor = None if page == 1 else self.find_anchor(signature, query, order, page, page_size)
+            rows = []
+            if page == 1 or anchor is not None:
+                if order == 'desc':
+                    if anchor is not None:
+                        query = query.filter(model.id <= anchor)
+                    query = query.order_by(desc(model.id))
+                else:
+                    if anchor is not None:
+                        query = query.filter(model.id >= anchor)
+                    query = query.order_by(model.id)
+                projection = [getattr(model, column) for column in self.columns]
+                # 다음 페이지의 첫 id까지
+                rows = query.with_entities(*projection).limit(page_size + 1).all()
+            with self.lock:
+                anchors = self.anchors.setdefault(signature, {})
+                if rows:
+                    anchors[page] = rows[0][0]
+                if len(rows) > page_size:
+                    anchors[page + 1] = rows[page_size][0]
+        thumbnail = (THUMBNAIL.enabled, THUMBNAIL.width) if self.images else (False, 0)
+        ret['list'] = [self.to_dict(row, thumbnail) for row in rows[:page_size]]
+        ret['paging'] = model.get_paging_info(count, page, page_size)
+        try:
+            P.ModelSetting.set(f'{model.__tablename__}_last_list_option', f'{order}|{page}|{search}|{option1}|{option2}')
+        except Exception:
+            logger.exception('Saving list option failed')
+        return ret
@@ -0,0 +1,129 @@
+import time
+import threading
+import urllib.parse
+
+from .setup import P
+from .cdn import CDN
+
+
+logger = P.logger
+settings = P.ModelSetting
+# 화질별 예상 비트레이트(Mbps), 처음 스레드 수
+QUALITIES = {
+    '2160p': (16.0, 8),
+    '1080p': (6.0, 6),
+    '720p': (3.0, 4),
+    '480p': (1.5, 3),
+    '360p': (1.0, 2),
+}
+DEFAULT_QUALITY = '1080p'
+MIN_THREADS = 1
+# 세그먼트 하나의 재생 시간
+SEGMENT_SECONDS = 6
+MIN_RETRIES = 3
+MAX_RETRIES = 10
+# N_m3u8DL-RE 기본값
+MAX_TIMEOUT = 100
+MIN_TIMEOUT = 15
+# 예상 시간의 몇 배까지 기다릴지
+TIMEOUT_FACTOR = 4
+# 오류율이 이보다 높으면 스레드를 절반으로
+BACKOFF_ERROR = 0.3
+# 오류율이 이보다 낮고 처리량이 줄지 않았으면 스레드 하나 추가
+GROWTH_ERROR = 0.1
+DECAY = 0.8
+IDLE_RESET = 3600
+
+
+class HostState:
+
+    def __init__(self, threads: float) -> None:
+        self.threads = threads
+        self.throughput = None
+        # 받을 때 쓴 스레드 하나의 처리량
+        self.per_thread = None
+        self.updated = time.monotonic()
+
+
+class TransferPolicy:
+    '''
+    호스트별 오류율, 처리량과 비트레이트로 N_m3u8DL-RE의 스레드, 재시도, 시간 제한을 정함
+    스레드는 오류가 많으면 절반으로 줄이고 빠르고 깨끗하면 하나씩 늘림
+    '''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # key: host
+        self.hosts = {}
+
+    @property
+    def max_threads(self) -> int:
+        try:
+            return max(settings.get_int('basic_re_max_threads'), MIN_THREADS)
+        except Exception:
+            return 16
+
+    @staticmethod
+    def bitrate(quality: str | None) -> float:
+        '''bytes/s'''
+        return QUALITIES.get(quality or '', QUALITIES[DEFAULT_QUALITY])[0] * 1000 * 1000 / 8
+
+    def state(self, host: str, quality: str | None) -> HostState:
+        state = self.hosts.get(host)
+        # 오래 안 쓴 호스트는 처음부터
+        if not state or time.monotonic() - state.updated > IDLE_RESET:
+            state = self.hosts[host] = HostState(QUALITIES.get(quality or '', QUALITIES[DEFAULT_QUALITY])[1])
+        return state
+
+    def decide(self, url: str, quality: str | None = None) -> dict:
+        host = urllib.parse.urlparse(url or '').hostname or ''
+        stats = CDN.status().get(host) or {}
+        error = stats.get('error') or 0.0
+        with self.lock:
+            state = self.state(host, quality)
+            threads = max(MIN_THREADS, min(int(state.threads), self.max_threads))
+            per_thread = state.per_thread
+        # 오류가 많은 호스트는 세그먼트마다 더 시도
+        retries = min(MIN_RETRIES + round(error * 10), MAX_RETRIES)
+        timeout = MAX_TIMEOUT
+        if per_thread:
+            expected = self.bitrate(quality) * SEGMENT_SECONDS / per_thread + (stats.get('ttfb') or 0)
+            timeout = int(min(max(expected * TIMEOUT_FACTOR, MIN_TIMEOUT), MAX_TIMEOUT))
+        return {'threads': threads, 'retries': retries, 'timeout': timeout}
+
+    def record(self, url: str, quality: str | None, success: bool, size: int = 0, elapsed: float = 0.0) -> None:
+        '''끝난 다운로드의 결과로 다음 스레드 수를 조정'''
+        if not (host := urllib.parse.urlparse(url or '').hostname):
+            return
+        stats = CDN.status().get(host) or {}
+        error = stats.get('error') or 0.0
+        throughput = size / elapsed if success and size and elapsed > 0 else None
+        with self.lock:
+            state = self.state(host, quality)
+            before = state.threads
+            if throughput:
+                per_thread = throughput / max(int(before), MIN_THREADS)
+                state.per_thread = per_thread if state.per_thread is None else state.per_thread * DECAY + per_thread * (1 - DECAY)
+            if not success or error > BACKOFF_ERROR:
+                state.threads = max(state.threads / 2, MIN_THREADS)
+            elif error < GROWTH_ERROR and throughput and (not state.throughput or throughput >= state.throughput * 0.9):
+                state.threads = min(state.threads + 1, self.max_threads)
+            if throughput:
+                state.throughput = throughput if state.throughput is None else state.throughput * DECAY + throughput * (1 - DECAY)
+            state.updated = time.monotonic()
+            after = state.threads
+        if int(before) != int(after):
+            logger.debug(f'RE threads for {host}: {int(before)} -> {int(after)} (error {error:.2f})')
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                host: {
+                    'threads': int(state.threads),
+                    'throughput': round(state.throughput) if state.throughput else None,
+                }
+                for host, state in sorted(self.hosts.items())
+            }
+
+
+POLICY = TransferPolicy()
@@ -0,0 +1,296 @@
+import os
+import time
+import pathlib
+import threading
+
+import psutil
+
+from .setup import P
+from .metrics import CHILD_CPU_SECONDS, CHILD_IO_BYTES, JOB_CPU, JOB_IO
+
+
+logger = P.logger
+settings = P.ModelSetting
+# 우선순위를 바꿀 자식 프로세스
+BINARIES = ('n_m3u8dl-re', 'ffmpeg', 'mp4decrypt', 'mkvmerge', 'aria2c')
+# 설정값: (psutil 상수, 레벨)
+IONICE_CLASSES = {
+    'best-effort': ('IOPRIO_CLASS_BE', 7),
+    'idle': ('IOPRIO_CLASS_IDLE', 0),
+}
+CGROUP_ROOT = pathlib.Path('/sys/fs/cgroup')
+INTERVAL = 1.0
+
+
+def binary_name(process: psutil.Process) -> str:
+    name = process.name().lower()
+    return name[:-4] if name.endswith('.exe') else name
+
+
+class ChildUsage:
+    '''자식 프로세스 하나의 마지막 측정값'''
+
+    def __init__(self, process: psutil.Process, callback_id: str, module: str, binary: str) -> None:
+        self.process = process
+        self.callback_id = callback_id
+        self.module = module
+        self.binary = binary
+        self.cpu = 0.0
+        self.read = 0
+        self.write = 0
+
+    def sample(self) -> bool:
+        '''False: 종료됨'''
+        try:
+            with self.process.oneshot():
+                times = self.process.cpu_times()
+                self.cpu = times.user + times.system
+                try:
+                    io = self.process.io_counters()
+                    self.read, self.write = io.read_bytes, io.write_bytes
+                except (AttributeError, NotImplementedError):
+                    # macOS
+                    pass
+            return self.process.is_running() and self.process.status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+
+
+class JobUsage:
+
+    def __init__(self, module: str, filename: str) -> None:
+        self.module = module
+        stem = pathlib.Path(filename).stem
+        # REDownloader는 파일 이름의 쉼표를 지움
+        self.markers = {stem, stem.replace(',', '')}
+        self.cpu = 0.0
+        self.read = 0
+        self.write = 0
+        self.processes = set()
+        self.finished = False
+
+
+class PriorityManager:
+    '''
+    다운로드 자식 프로세스의 nice, ionice, cgroup v2 가중치와 작업별 CPU, I/O 사용량
+    작업의 파일 이름이 명령줄에 있는 자식 프로세스만 다룸
+    '''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # key: callback_id
+        self.jobs = {}
+        # key: pid
+        self.children = {}
+        self.thread = None
+        # key: module, value: cgroup 경로 또는 None
+        self.cgroups = {}
+        # 모듈별 cgroup을 만드는 위임받은 cgroup
+        self.cgroup_parent = None
+        self.cgroup_lock = threading.Lock()
+        self.cgroup_failed = False
+
+    @staticmethod
+    def options(module: str) -> dict:
+        try:
+            return {
+                'nice': settings.get_int(f'{module}_process_nice'),
+                'ionice': settings.get(f'{module}_process_ionice'),
+                'cpu_weight': settings.get_int(f'{module}_cgroup_cpu_weight'),
+                'io_weight': settings.get_int(f'{module}_cgroup_io_weight'),
+            }
+        except Exception:
+            return {'nice': 0, 'ionice': '', 'cpu_weight': 0, 'io_weight': 0}
+
+    def register(self, callback_id: str, module: str, filename: str) -> None:
+        with self.lock:
+            self.jobs[callback_id] = JobUsage(module, filename)
+            if not (self.thread and self.thread.is_alive()):
+                self.thread = threading.Thread(target=self.run, name=f'{P.package_name}_priority', daemon=True)
+                self.thread.start()
+
+    def discard(self, callback_id: str) -> None:
+        with self.lock:
+            self.jobs.pop(callback_id, None)
+
+    def finish(self, callback_id: str) -> None:
+        '''남은 자식 프로세스가 끝나면 집계'''
+        with self.lock:
+            if not (job := self.jobs.get(callback_id)):
+                return
+            job.finished = True
+            if job.processes:
+                return
+            self.jobs.pop(callback_id)
+        self.report(callback_id, job)
+
+    def adopt(self, pid: int, callback_id: str | None) -> None:
+        '''바로 우선순위를 적용하고 사용량을 잼'''
+        with self.lock:
+            job = self.jobs.get(callback_id or '')
+            if not job or pid in self.children:
+                return
+        try:
+            process = psutil.Process(pid)
+            child = ChildUsage(process, callback_id, job.module, binary_name(process))
+        except psutil.Error:
+            return
+        self.apply(process, job.module)
+        with self.lock:
+            self.children[pid] = child
+            job.processes.add(pid)
+
+    def apply(self, process: psutil.Process, module: str) -> None:
+        options = self.options(module)
+        try:
+            if options['nice'] > 0:
+                if psutil.WINDOWS:
+                    process.nice(psutil.IDLE_PRIORITY_CLASS if options['nice'] >= 15 else psutil.BELOW_NORMAL_PRIORITY_CLASS)
+                else:
+                    process.nice(min(options['nice'], 19))
+            if psutil.LINUX and (ionice := IONICE_CLASSES.get(options['ionice'] or '')):
+                process.ionice(getattr(psutil, ionice[0]), ionice[1] or None)
+        except psutil.Error as e:
+            logger.debug(f'Could not set the priority: {process.pid}: {e}')
+        if (options['cpu_weight'] or options['io_weight']) and (cgroup := self.cgroup(module, options)):
+            try:
+                (cgroup / 'cgroup.procs').write_text(str(process.pid))
+            except OSError as e:
+                logger.debug(f'Could not move to the cgroup: {process.pid}: {e}')
+
+    @staticmethod
+    def usable(path: pathlib.Path) -> bool:
+        '''위임받은 cgroup: 쓸 수 있고 프로세스가 없어야 자식에게 컨트롤러를 줄 수 있음(no internal process)'''
+        try:
+            return (
+                os.access(path, os.W_OK)
+                and os.access(path / 'cgroup.subtree_control', os.W_OK)
+                and not (path / 'cgroup.procs').read_text().split()
+            )
+        except OSError:
+            return False
+
+    def delegate(self) -> pathlib.Path | None:
+        '''
+        설정한 cgroup, 없으면 자신이 있는 cgroup의 부모가 위임된 경우만(예: systemd Delegate=, DelegateSubgroup=)
+        다른 프로세스는 옮기지 않음
+        '''
+        if self.cgroup_parent is None:
+            if path := (settings.get('basic_cgroup_path') or '').strip():
+                parent = pathlib.Path(path)
+                if not parent.is_absolute():
+                    parent = CGROUP_ROOT / path
+            else:
+                own = next(line[3:].strip() for line in pathlib.Path('/proc/self/cgroup').read_text().splitlines() if line.startswith('0::'))
+                parent = (CGROUP_ROOT / own.lstrip('/')).parent
+            if not self.usable(parent):
+                raise OSError(f'Not a delegated, empty cgroup: {parent}')
+            available = (parent / 'cgroup.controllers').read_text().split()
+            enabled = (parent / 'cgroup.subtree_control').read_text().split()
+            if wanted := [controller for controller in ('cpu', 'io') if controller in available and controller not in enabled]:
+                (parent / 'cgroup.subtree_control').write_text(' '.join(f'+{controller}' for controller in wanted))
+            self.cgroup_parent = parent
+        return self.cgroup_parent
+
+    def cgroup(self, module: str, options: dict) -> pathlib.Path | None:
+        '''cgroup v2 위임이 없으면 None, nice와 ionice만 적용'''
+        if self.cgroup_failed or not psutil.LINUX or not (CGROUP_ROOT / 'cgroup.controllers').exists():
+            return None
+        try:
+            with self.cgroup_lock:
+                if module not in self.cgroups:
+                    cgroup = self.delegate() / f'{P.package_name}.{module}'
+                    cgroup.mkdir(exist_ok=True)
+                    self.cgroups[module] = cgroup
+            cgroup = self.cgroups[module]
+            if options['cpu_weight'] and (cgroup / 'cpu.weight').exists():
+                (cgroup / 'cpu.weight').write_text(str(min(max(options['cpu_weight'], 1), 10000)))
+            if options['io_weight'] and (cgroup / 'io.weight').exists():
+                (cgroup / 'io.weight').write_text(f"default {min(max(options['io_weight'], 1), 10000)}")
+            return cgroup
+        except (OSError, StopIteration) as e:
+            logger.warning(f'cgroup v2 weights are not available, using nice and ionice only: {e}')
+            self.cgroup_failed = True
+            return None
+
+    def reset_cgroups(self) -> None:
+        '''만든 cgroup을 지우고 다음 다운로드에서 다시 찾음, 자식 프로세스가 남아 있으면 그대로 둠'''
+        with self.cgroup_lock:
+            for cgroup in self.cgroups.values():
+                try:
+                    cgroup.rmdir()
+                except OSError as e:
+                    logger.debug(f'Could not remove the cgroup: {cgroup}: {e}')
+            self.cgroups = {}
+            self.cgroup_parent = None
+            self.cgroup_failed = False
+
+    def match(self, process: psutil.Process) -> str | None:
+        '''명령줄로 작업을 찾음'''
+        try:
+            if binary_name(process) not in BINARIES:
+                return None
+            cmdline = ' '.join(process.cmdline())
+        except psutil.Error:
+            return None
+        with self.lock:
+            for callback_id, job in self.jobs.items():
+                if not job.finished and any(marker and marker in cmdline for marker in job.markers):
+                    return callback_id
+        return None
+
+    def scan(self) -> None:
+        '''SupportFfmpeg, wv_tool, N_m3u8DL-RE가 실행한 프로세스'''
+        try:
+            processes = psutil.Process(os.getpid()).children(recursive=True)
+        except psutil.Error:
+            return
+        for process in processes:
+            if process.pid in self.children:
+                continue
+            if callback_id := self.match(process):
+                self.adopt(process.pid, callback_id)
+
+    def sample(self) -> None:
+        with self.lock:
+            children = list(self.children.items())
+        for pid, child in children:
+            if child.sample():
+                continue
+            CHILD_CPU_SECONDS.inc(child.cpu, module=child.module, binary=child.binary)
+            CHILD_IO_BYTES.inc(child.read, module=child.module, binary=child.binary, direction='read')
+            CHILD_IO_BYTES.inc(child.write, module=child.module, binary=child.binary, direction='write')
+            with self.lock:
+                self.children.pop(pid, None)
+                if not (job := self.jobs.get(child.callback_id)):
+                    continue
+                job.processes.discard(pid)
+                job.cpu += child.cpu
+                job.read += child.read
+                job.write += child.write
+                if not job.finished or job.processes:
+                    continue
+                self.jobs.pop(child.callback_id)
+            self.report(child.callback_id, job)
+
+    def report(self, callback_id: str, job: JobUsage) -> None:
+        JOB_CPU.observe(job.cpu, module=job.module)
+        JOB_IO.observe(job.read, module=job.module, direction='read')
+        JOB_IO.observe(job.write, module=job.module, direction='write')
+        logger.debug(f'Child process usage: {callback_id} cpu={job.cpu:.1f}s read={job.read} write={job.write}')
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.scan()
+                self.sample()
+            except Exception:
+                logger.exception('Watching child processes failed')
+            with self.lock:
+                if not self.jobs and not self.children:
+                    self.thread = None
+                    return
+            time.sleep(INTERVAL)
+
+
+PRIORITY = PriorityManager()
@@ -0,0 +1,198 @@
+import os
+import time
+import threading
+import collections
+import urllib.parse
+
+from support_site import SupportWavve
+
+from .setup import P
+
+
+logger = P.logger
+settings = P.ModelSetting
+DIRECT = 'direct'
+# 프록시 목록을 다시 읽는 간격
+REFRESH_INTERVAL = 60
+
+
+def mask_proxy(proxy: str) -> str:
+    '''계정 정보 제거'''
+    parsed = urllib.parse.urlparse(proxy)
+    if not parsed.hostname:
+        return proxy
+    port = f':{parsed.port}' if parsed.port else ''
+    return f'{parsed.scheme}://{parsed.hostname}{port}'
+
+
+class ProxyStats:
+
+    def __init__(self, proxy: str) -> None:
+        self.proxy = proxy
+        self.active = 0
+        self.success = 0
+        self.failure = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        # 최근 결과
+        self.results = collections.deque(maxlen=20)
+        self.demoted_until = 0.0
+
+    @property
+    def error_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    @property
+    def throughput(self) -> float:
+        '''bytes/sec'''
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return self.demoted_until <= time.monotonic()
+
+    def as_dict(self) -> dict:
+        return {
+            'proxy': mask_proxy(self.proxy),
+            'active': self.active,
+            'success': self.success,
+            'failure': self.failure,
+            'error_rate': round(self.error_rate, 3),
+            'throughput': round(self.throughput),
+            'healthy': self.healthy,
+        }
+
+
+class ProxyPool:
+    '''
+    다운로드마다 여유 있는 다운로드 프록시를 배정
+    프록시 목록은 설정, 없으면 로그인한 계정의 다운로드 프록시
+    '''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # proxy: ProxyStats
+        self.stats = {}
+        # key: (proxy, started)
+        self.assigned = {}
+        self.proxies = [DIRECT]
+        self.loaded = 0.0
+
+    @property
+    def per_proxy_limit(self) -> int:
+        try:
+            return max(settings.get_int('basic_proxy_max_count'), 0)
+        except Exception:
+            return 0
+
+    def get_proxies(self) -> list[str]:
+        '''잠시 캐시'''
+        if time.monotonic() - self.loaded > REFRESH_INTERVAL:
+            self.proxies = self.load_proxies()
+            self.loaded = time.monotonic()
+        return self.proxies
+
+    def reload(self) -> None:
+        self.loaded = 0.0
+
+    @staticmethod
+    def load_proxies() -> list[str]:
+        '''설정: 한 줄에 하나, direct는 프록시 없이'''
+        try:
+            lines = (settings.get('basic_download_proxies') or '').splitlines()
+        except Exception:
+            lines = []
+        proxies = list(dict.fromkeys(line.strip() for line in lines if line.strip() and not line.strip().startswith('#')))
+        if proxies:
+            return proxies
+        try:
+            account = SupportWavve.api.get_account()
+        except Exception:
+            account = None
+        return [getattr(account, 'download_proxy', None) or DIRECT]
+
+    @property
+    def capacity(self) -> int:
+        '''0: 제한 없음, 마지막으로 읽은 프록시 목록 기준'''
+        limit = self.per_proxy_limit
+        return len(self.proxies) * limit if limit else 0
+
+    def get_stats(self, proxy: str) -> ProxyStats:
+        if proxy not in self.stats:
+            self.stats[proxy] = ProxyStats(proxy)
+        return self.stats[proxy]
+
+    def choose(self) -> ProxyStats:
+        limit = self.per_proxy_limit
+        candidates = [self.get_stats(proxy) for proxy in self.get_proxies()]
+
+        def score(stats: ProxyStats) -> tuple:
+            return (
+                not stats.healthy,
+                bool(limit) and stats.active >= limit,
+                stats.active,
+                stats.error_rate,
+                -stats.throughput,
+            )
+
+        return min(candidates, key=score)
+
+    @staticmethod
+    def to_proxies(proxy: str) -> dict | None:
+        if proxy == DIRECT:
+            return None
+        return {"http": proxy, "https": proxy}
+
+    def peek(self) -> dict | None:
+        with self.lock:
+            return self.to_proxies(self.choose().proxy)
+
+    def acquire(self, key: str) -> dict | None:
+        with self.lock:
+            if key in self.assigned:
+                return self.to_proxies(self.assigned[key][0])
+            stats = self.choose()
+            stats.active += 1
+            self.assigned[key] = (stats.proxy, time.monotonic())
+            if self.per_proxy_limit and stats.active > self.per_proxy_limit:
+                logger.warning(f'All proxies are busy: {mask_proxy(stats.proxy)} ({stats.active})')
+            return self.to_proxies(stats.proxy)
+
+    def release(self, key: str, success: bool | None = None, path: str = None) -> None:
+        '''success가 None이면 결과를 기록하지 않음'''
+        with self.lock:
+            if key not in self.assigned:
+                return
+            proxy, started = self.assigned.pop(key)
+            stats = self.get_stats(proxy)
+            stats.active = max(stats.active - 1, 0)
+            if success is None:
+                return
+            stats.results.append(success)
+            if success:
+                stats.success += 1
+                try:
+                    if path and os.path.isfile(path):
+                        stats.bytes += os.path.getsize(path)
+                        stats.seconds += time.monotonic() - started
+                except OSError:
+                    pass
+            else:
+                stats.failure += 1
+                if len(stats.results) >= 3 and stats.error_rate >= 0.5:
+                    # 잠시 배정하지 않음
+                    stats.demoted_until = time.monotonic() + 600
+                    logger.warning(f'Demoted proxy: {mask_proxy(proxy)} error_rate={stats.error_rate:.2f}')
+
+    def status(self) -> list[dict]:
+        with self.lock:
+            return [self.get_stats(proxy).as_dict() for proxy in self.get_proxies()]
+
+
+POOL = ProxyPool()
+
+
+def get_download_proxies() -> dict | None:
+    return POOL.peek()
@@ -0,0 +1,81 @@
+import os
+import gzip
+import json
+import time
+import datetime
+import threading
+
+from .setup import F, P
+
+
+logger = P.logger
+CHUNK_SIZE = 500
+
+
+class HistoryPruner:
+    '''오래된 목록을 조금씩 나눠서 삭제'''
+
+    def __init__(self, model: type, columns: tuple[str] = None) -> None:
+        self.model = model
+        # 보관 파일에 남길 컬럼
+        self.columns = columns or tuple(column.name for column in model.__table__.columns)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.cutoff = None
+        self.archive = False
+
+    @property
+    def archive_path(self) -> str:
+        return os.path.join(F.config['path_data'], 'db', f'{self.model.__tablename__}_archive.jsonl.gz')
+
+    def request(self, days: int, archive: bool = False) -> None:
+        with self.lock:
+            self.cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+            self.archive = archive
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, name=f'{self.model.__tablename__}_pruner', daemon=True)
+            self.thread.start()
+
+    def run(self) -> None:
+        total = 0
+        try:
+            while True:
+                with self.lock:
+                    cutoff, archive = self.cutoff, self.archive
+                count = self.prune_chunk(cutoff, archive)
+                total += count
+                if count < CHUNK_SIZE:
+                    break
+                # 다른 쓰기 작업에 양보
+                time.sleep(0.5)
+        except Exception:
+            logger.exception(f'Pruning failed: {self.model.__tablename__}')
+        if total:
+            logger.info(f'Pruned {total} rows of {self.model.__tablename__}')
+
+    def prune_chunk(self, cutoff: datetime.datetime, archive: bool) -> int:
+        model = self.model
+        with F.app.app_context():
+            # created_time 인덱스 사용
+            query = F.db.session.query(*[getattr(model, column) for column in self.columns]) \
+                .filter(model.created_time < cutoff) \
+                .order_by(model.created_time) \
+                .limit(CHUNK_SIZE)
+            rows = query.all()
+            if not rows:
+                return 0
+            if archive:
+                self.write_archive(rows)
+            ids = [row.id for row in rows]
+            F.db.session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+            F.db.session.commit()
+        return len(rows)
+
+    def write_archive(self, rows: list) -> None:
+        '''gzip 멤버를 이어 붙임'''
+        lines = []
+        for row in rows:
+            lines.append(json.dumps(dict(zip(self.columns, row)), ensure_ascii=False, default=str))
+        with gzip.open(self.archive_path, 'at', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
@@ -0,0 +1,100 @@
+import time
+import datetime
+import threading
+from typing import Any, Callable, Iterable
+
+from support_site import SupportWavve
+
+from .setup import P
+from .admission import ADMISSION
+
+
+logger = P.logger
+settings = P.ModelSetting
+# 바로 시작할 수 있는 수보다 더 갱신해 둘 항목 수
+LOOKAHEAD = 1
+
+
+def get_play_url(streaming: dict) -> str:
+    play_info = streaming.get('play_info') or {}
+    return play_info.get('hls') or play_info.get('uri') or streaming.get('playurl') or ''
+
+
+def get_issued_time(issue: Any) -> datetime.datetime | None:
+    '''streaming_json['issue'] 값을 datetime으로 변환'''
+    if issue is None or issue == '':
+        return None
+    try:
+        if isinstance(issue, (int, float)) or str(issue).isdigit():
+            timestamp = float(issue)
+            # milliseconds
+            if timestamp > 10 ** 11:
+                timestamp /= 1000
+            return datetime.datetime.fromtimestamp(timestamp)
+        text = str(issue).strip()
+        for fmt in ('%Y-%m-%d %H:%M:%S', '%Y%m%d%H%M%S', '%Y-%m-%dT%H:%M:%S'):
+            try:
+                return datetime.datetime.strptime(text[:19], fmt)
+            except ValueError:
+                continue
+        return datetime.datetime.fromisoformat(text).replace(tzinfo=None)
+    except Exception:
+        logger.debug(f'Unknown issue format: {issue}')
+    return None
+
+
+def is_due(streaming: dict | None, refresh_minute: int = None) -> bool:
+    '''재생 주소를 다시 받아야 하는지 여부'''
+    if not streaming:
+        return True
+    if refresh_minute is None:
+        refresh_minute = settings.get_int('basic_playurl_refresh_minute')
+    issue = streaming.get('issue')
+    try:
+        if SupportWavve.is_expired(get_play_url(streaming), issue):
+            return True
+    except Exception:
+        logger.exception(f'Checking expiration failed: {issue}')
+    issued_time = get_issued_time(issue)
+    if not issued_time or refresh_minute <= 0:
+        return False
+    return issued_time + datetime.timedelta(minutes=refresh_minute) <= datetime.datetime.now()
+
+
+class PlayUrlRefresher:
+    '''대기중인 항목 중 곧 시작할 항목의 재생 주소를 만료 전에 미리 갱신'''
+
+    def __init__(self, name: str, collect: Callable[[], Iterable], refresh: Callable[[Any], None], interval: int = 60) -> None:
+        self.name = name
+        self.collect = collect
+        self.refresh = refresh
+        self.interval = interval
+        self.event = threading.Event()
+        self.thread = None
+
+    def start(self) -> None:
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.run, name=f'{P.package_name}_{self.name}_refresher', daemon=True)
+        self.thread.start()
+
+    def wake(self) -> None:
+        self.event.set()
+
+    def run(self) -> None:
+        while True:
+            self.event.wait(self.interval)
+            self.event.clear()
+            if not getattr(SupportWavve, 'api', None):
+                continue
+            try:
+                # 한참 뒤에 시작할 항목은 그때 가서 받음
+                limit = ADMISSION.available(self.name) + LOOKAHEAD
+                for item in list(self.collect())[:limit]:
+                    try:
+                        self.refresh(item)
+                    except Exception:
+                        logger.exception(f'Refreshing play URL failed: {item}')
+                    time.sleep(0.5)
+            except Exception:
+                logger.exception(f'Refresher error: {self.name}')
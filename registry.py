@@ -0,0 +1,112 @@
+import time
+import datetime
+import threading
+from typing import Callable
+
+from .setup import P
+from .admission import ADMISSION
+
+
+logger = P.logger
+# 슬롯을 반환한 뒤(복호화, 먹싱) 소식이 없으면 끝난 것으로 봄
+LEASE_TTL = 30 * 60
+
+
+class Lease:
+
+    def __init__(self, contentid: str, quality: str, owner: str) -> None:
+        self.contentid = contentid
+        self.quality = quality
+        self.owner = owner
+        self.created_time = datetime.datetime.now()
+        self.touched = time.monotonic()
+        self.followers = []
+
+    @property
+    def stale(self) -> bool:
+        '''마지막 콜백을 잃어버린 작업'''
+        return not ADMISSION.holds(self.owner) and time.monotonic() - self.touched > LEASE_TTL
+
+    def as_dict(self) -> dict:
+        return {
+            'contentid': self.contentid,
+            'quality': self.quality,
+            'owner': self.owner,
+            'created_time': self.created_time.strftime('%m-%d %H:%M:%S'),
+            'followers': len(self.followers),
+        }
+
+
+class ContentRegistry:
+    '''모듈간 중복 다운로드 방지를 위한 contentid + quality 임대 목록'''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # (contentid, quality): Lease
+        self.leases = {}
+
+    def reclaim(self, contentid: str, quality: str) -> Lease | None:
+        '''오래된 임대를 지우고 유효한 임대를 돌려줌, 잠금 안에서 호출'''
+        lease = self.leases.get((contentid, quality))
+        if lease and lease.stale:
+            logger.warning(f'Reclaimed stale lease: {contentid} {quality} {lease.owner}')
+            del self.leases[(contentid, quality)]
+            threading.Thread(target=self.notify, args=(lease, False), daemon=True).start()
+            return None
+        return lease
+
+    def holder(self, contentid: str, quality: str) -> str | None:
+        with self.lock:
+            lease = self.reclaim(contentid, quality)
+            return lease.owner if lease else None
+
+    def claim(self, contentid: str, quality: str, owner: str) -> str | None:
+        '''
+        임대에 성공하면 None
+        이미 다른 작업이 진행중이면 그 작업의 owner
+        '''
+        with self.lock:
+            lease = self.reclaim(contentid, quality)
+            if lease and lease.owner != owner:
+                return lease.owner
+            if not lease:
+                self.leases[(contentid, quality)] = Lease(contentid, quality, owner)
+            return None
+
+    def attach(self, contentid: str, quality: str, callback: Callable[[bool], None]) -> bool:
+        '''진행중인 작업이 끝나면 callback(completed)'''
+        with self.lock:
+            lease = self.reclaim(contentid, quality)
+            if not lease:
+                return False
+            lease.followers.append(callback)
+            return True
+
+    def touch(self, owner: str) -> None:
+        '''진행 중이라는 표시'''
+        with self.lock:
+            for lease in self.leases.values():
+                if lease.owner == owner:
+                    lease.touched = time.monotonic()
+
+    def finish(self, owner: str, completed: bool) -> None:
+        with self.lock:
+            keys = [key for key, lease in self.leases.items() if lease.owner == owner]
+            leases = [self.leases.pop(key) for key in keys]
+        for lease in leases:
+            self.notify(lease, completed)
+
+    @staticmethod
+    def notify(lease: Lease, completed: bool) -> None:
+        for callback in lease.followers:
+            try:
+                callback(completed)
+            except Exception:
+                logger.exception(f'Follower callback failed: {lease.contentid}')
+
+    def status(self) -> list[dict]:
+        with self.lock:
+            return [lease.as_dict() for lease in self.leases.values()]
+
+
+REGISTRY = ContentRegistry()
@@ -0,0 +1,409 @@
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import sqlite3
+import datetime
+import tempfile
+import threading
+import contextlib
+import collections
+import multiprocessing
+from typing import Any, Callable, Iterator
+from unittest import mock
+
+from sqlalchemy import create_engine, event, text
+
+from support_site import SupportWavve
+
+from .setup import F, P
+from .admission import ADMISSION
+from .blob import ModelWavveBlob
+from .search import ensure_fts
+from .metrics import TRANSFERS
+from .engines import ENGINES
+from .cluster import CLUSTER
+
+
+logger = P.logger
+# 기록할 API와 응답을 찾을 키
+API_KEYS = {
+    'get_new_vods': lambda *args, **kwargs: '',
+    'get_more_new_vods': lambda *args, **kwargs: '',
+    'vod_contents_contentid': lambda contentid, *args, **kwargs: str(contentid),
+    'streaming': lambda contenttype, contentid, quality, *args, **kwargs: f'{contentid}|{quality}|{kwargs.get("action") or ""}',
+    'is_expired': lambda url, *args, **kwargs: str(url),
+}
+# 늘린 항목의 contentid: 원래 contentid#번호
+SYNTHETIC_SEPARATOR = '#'
+# 쌓여 있는 목록의 etc_abort 분포
+SEED_STATES = ((32, 0.9), (12, 0.04), (19, 0.03), (18, 0.02), (31, 0.01))
+PHASES = ('discover', 'pick_out', 'retrieve', 'dispatch')
+# 자식 프로세스를 기다리는 시간(초)
+TIMEOUT = 30 * 60
+
+
+def seed_recent_rows(model: type, engine: Any, recents: list[dict], rows: int) -> int:
+    '''기록한 목록을 복제해서 쌓여 있는 목록을 흉내냄'''
+    if not recents or rows <= 0:
+        return 0
+    rng = random.Random(rows)
+    blob_ids = [ModelWavveBlob.put(recent) for recent in recents]
+    states = [state for state, _ in SEED_STATES]
+    weights = [weight for _, weight in SEED_STATES]
+    now = datetime.datetime.now()
+    batch = []
+    with engine.begin() as conn:
+        for index in range(rows):
+            recent = recents[index % len(recents)]
+            etc_abort = rng.choices(states, weights)[0]
+            batch.append({
+                'created_time': now - datetime.timedelta(minutes=rows - index),
+                'call': 'recent',
+                'recent_blob_id': blob_ids[index % len(recents)],
+                'contentid': f'{recent.get("contentid")}{SYNTHETIC_SEPARATOR}{index}',
+                'programid': recent.get('programid'),
+                'programtitle': recent.get('programtitle'),
+                'episodenumber': recent.get('episodenumber'),
+                'episodetitle': recent.get('episodetitle'),
+                'channelname': recent.get('channelname'),
+                'releasedate': recent.get('releasedate'),
+                'image': recent.get('image'),
+                'completed': etc_abort == 32,
+                'user_abort': False,
+                'pf_abort': False,
+                'etc_abort': etc_abort,
+                'retry': 0,
+            })
+            if len(batch) >= 1000:
+                conn.execute(model.__table__.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(model.__table__.insert(), batch)
+    return rows
+
+
+class StubDownloader:
+    '''다운로드 하지 않고 바로 완료 처리'''
+
+    started = []
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        params = args[0] if args and isinstance(args[0], dict) else kwargs
+        self.callback_id = params.get('callback_id') or kwargs.get('callback_id')
+
+    def start(self) -> None:
+        from .proxies import POOL
+        from .registry import REGISTRY
+        self.started.append(self.callback_id)
+        ADMISSION.release(self.callback_id)
+        POOL.release(self.callback_id)
+        REGISTRY.finish(self.callback_id, True)
+        TRANSFERS.discard(self.callback_id)
+        ENGINES.discard(self.callback_id)
+
+
+class PhaseMeter:
+    '''단계별 시간, 쿼리 수, API 호출 수'''
+
+    def __init__(self) -> None:
+        self.thread_id = threading.get_ident()
+        self.phase = None
+        self.stats = {phase: self.empty() for phase in PHASES}
+
+    @staticmethod
+    def empty() -> dict:
+        return {'seconds': 0.0, 'queries': 0, 'api_calls': collections.Counter(), 'api_misses': 0}
+
+    def on_query(self, *args: Any) -> None:
+        if self.phase and threading.get_ident() == self.thread_id:
+            self.stats[self.phase]['queries'] += 1
+
+    def on_api(self, method: str, hit: bool) -> None:
+        if not self.phase:
+            return
+        self.stats[self.phase]['api_calls'][method] += 1
+        if not hit:
+            self.stats[self.phase]['api_misses'] += 1
+
+    def wrap(self, target: object, name: str, phase: str) -> Any:
+        original = getattr(target, name)
+
+        def measured(*args: Any, **kwargs: Any) -> Any:
+            # 바깥 단계에 포함된 호출은 그 단계로 계산
+            if self.phase:
+                return original(*args, **kwargs)
+            self.phase = phase
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.stats[phase]['seconds'] += time.perf_counter() - started
+                self.phase = None
+
+        return mock.patch.object(target, name, measured)
+
+    def report(self) -> dict:
+        report = {}
+        for phase, stat in self.stats.items():
+            report[phase] = {
+                'ms': round(stat['seconds'] * 1000, 1),
+                'queries': stat['queries'],
+                'api_calls': sum(stat['api_calls'].values()),
+                'api_methods': dict(stat['api_calls']),
+                'api_misses': stat['api_misses'],
+            }
+        return report
+
+
+class ReplayHarness:
+    '''SupportWavve 응답을 기록하고, 기록한 응답으로 스케쥴 작업을 자식 프로세스의 임시 DB에서 재생'''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.originals = {}
+        self.recording = None
+        self.active = False
+
+    @property
+    def fixture_dir(self) -> str:
+        return os.path.join(F.config['path_data'], P.package_name, 'replay')
+
+    def get_fixture_path(self, name: str) -> str:
+        name = os.path.basename(name or 'default').removesuffix('.jsonl.gz')
+        return os.path.join(self.fixture_dir, f'{name}.jsonl.gz')
+
+    def list_fixtures(self) -> list[str]:
+        if not os.path.isdir(self.fixture_dir):
+            return []
+        return sorted(name.removesuffix('.jsonl.gz') for name in os.listdir(self.fixture_dir) if name.endswith('.jsonl.gz'))
+
+    def patch_api(self, make_wrapper: Callable[[str, Callable], Callable]) -> None:
+        for method in API_KEYS:
+            original = getattr(SupportWavve, method)
+            self.originals[method] = original
+            setattr(SupportWavve, method, staticmethod(make_wrapper(method, original)))
+
+    def restore_api(self) -> None:
+        for method, original in self.originals.items():
+            setattr(SupportWavve, method, staticmethod(original))
+        self.originals.clear()
+
+    def start_recording(self, name: str) -> str:
+        with self.lock:
+            if self.recording or self.active:
+                raise Exception('이미 기록 또는 재생 중입니다.')
+            path = self.get_fixture_path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_lock = threading.Lock()
+
+            def make_wrapper(method: str, original: Callable) -> Callable:
+                def recorded(*args: Any, **kwargs: Any) -> Any:
+                    result = original(*args, **kwargs)
+                    try:
+                        line = json.dumps({
+                            'method': method,
+                            'key': API_KEYS[method](*args, **kwargs),
+                            'result': result,
+                        }, ensure_ascii=False, default=str)
+                        with write_lock, gzip.open(path, 'at', encoding='utf-8') as f:
+                            f.write(line + '\n')
+                    except Exception:
+                        logger.exception(f'Recording failed: {method}')
+                    return result
+                return recorded
+
+            self.patch_api(make_wrapper)
+            self.recording = path
+        logger.info(f'Recording API responses: {path}')
+        return path
+
+    def stop_recording(self) -> str | None:
+        with self.lock:
+            path, self.recording = self.recording, None
+            if path:
+                self.restore_api()
+        if path:
+            logger.info(f'Recording stopped: {path}')
+        return path
+
+    def load_fixture(self, path: str) -> dict:
+        '''(method, key): 마지막 응답'''
+        responses = {}
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                responses[(item['method'], item['key'])] = item['result']
+        return responses
+
+    def make_temp_database(self, tmp_dir: str, live: Any) -> str:
+        db_file = os.path.join(tmp_dir, f'{P.package_name}.db')
+        engine = create_engine(f'sqlite:///{db_file}')
+        F.db.metadatas[P.package_name].create_all(engine)
+        # 설정은 그대로 쓰되 재생에 방해되는 기능은 끔
+        with live.connect() as source, engine.begin() as target:
+            rows = source.execute(text(f'SELECT key, value FROM "{P.package_name}_setting"')).fetchall()
+            target.execute(text(f'DELETE FROM "{P.package_name}_setting"'))
+            for key, value in rows:
+                target.execute(text(f'INSERT INTO "{P.package_name}_setting" (key, value) VALUES (:key, :value)'), {'key': key, 'value': value})
+            for key, value in (('basic_cluster_enabled', 'False'), ('basic_thumbnail_cache_mb', '0'), ('recent_auto_db_clear', 'False')):
+                target.execute(text(f'UPDATE "{P.package_name}_setting" SET value = :value WHERE key = :key'), {'key': key, 'value': value})
+        engine.dispose()
+        conn = sqlite3.connect(db_file)
+        with conn:
+            for table in (f'{P.package_name}_recent', f'{P.package_name}_program'):
+                ensure_fts(conn.cursor(), table)
+        conn.close()
+        return db_file
+
+    @staticmethod
+    def find_live_work() -> str | None:
+        '''자식 프로세스가 물려받으면 결과가 달라지는 상태'''
+        if ADMISSION.count():
+            # 자식 프로세스에서는 반환되지 않는 슬롯
+            return '다운로드 중'
+        if CLUSTER.enabled:
+            return '클러스터 사용 중'
+        return None
+
+    @contextlib.contextmanager
+    def temporary_database(self, prefix: str = 'replay') -> Iterator[str]:
+        '''지금 설정을 복사한 임시 SQLite 파일, 플러그인 DB는 그대로 둠'''
+        with self.lock:
+            if self.recording or self.active:
+                raise Exception('이미 기록 또는 재생 중입니다.')
+            if reason := self.find_live_work():
+                raise Exception(f'실행할 수 없습니다: {reason}')
+            self.active = True
+        tmp_dir = tempfile.mkdtemp(prefix=f'{P.package_name}_{prefix}_')
+        try:
+            with F.app.app_context():
+                live = F.db.engines[P.package_name]
+            yield self.make_temp_database(tmp_dir, live)
+        finally:
+            self.active = False
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def isolated(self, target: Callable[[Any], dict], prefix: str = 'replay', timeout: int = TIMEOUT) -> dict:
+        '''
+        fork한 자식 프로세스에서 임시 DB 엔진으로 target(engine)을 실행
+        자식에서 엔진, SupportWavve, 모듈 속성을 바꾸므로 실행 중인 서버에는 영향이 없음
+        '''
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise Exception('fork를 지원하는 OS에서만 실행할 수 있습니다.')
+        context = multiprocessing.get_context('fork')
+        with self.temporary_database(prefix) as db_file:
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=self.child, args=(sender, db_file, target), name=f'{P.package_name}_{prefix}', daemon=True)
+            process.start()
+            sender.close()
+            try:
+                if not receiver.poll(timeout):
+                    raise Exception(f'{timeout}초 안에 끝나지 않았습니다.')
+                ok, result = receiver.recv()
+            except EOFError:
+                raise Exception(f'자식 프로세스가 비정상 종료했습니다: {process.exitcode}')
+            finally:
+                receiver.close()
+                if process.is_alive():
+                    process.kill()
+                process.join()
+        if not ok:
+            raise Exception(result)
+        return result
+
+    @staticmethod
+    def child(sender: Any, db_file: str, target: Callable[[Any], dict]) -> None:
+        '''물려받은 DB 연결과 소켓은 쓰지 않음'''
+        try:
+            # 새 app context라서 세션도 새로 만듦
+            with F.app.app_context():
+                engines = F.db.engines
+                for live in engines.values():
+                    live.dispose(close=False)
+                engine = create_engine(f'sqlite:///{db_file}?check_same_thread=False')
+                engines[P.package_name] = engine
+                # 다른 DB의 blob id, 부모의 스레드가 잡고 있었을 수 있는 락
+                ModelWavveBlob.cache = collections.OrderedDict()
+                ModelWavveBlob.cache_lock = threading.Lock()
+                for module in P.module_list or []:
+                    module.socketio_callback = lambda *args, **kwargs: None
+                result = target(engine)
+            sender.send((True, result))
+        except Exception as e:
+            logger.exception('Isolated run failed')
+            sender.send((False, str(e)))
+        finally:
+            sender.close()
+
+    def run(self, module: object, model: type, name: str, rows: int = 1000) -> dict:
+        '''기록한 응답으로 discover -> pick-out -> retrieve -> dispatch'''
+        path = self.get_fixture_path(name)
+        if not os.path.exists(path):
+            raise Exception(f'기록이 없습니다: {path}')
+        responses = self.load_fixture(path)
+        module_ns = sys.modules[type(module).__module__]
+
+        def replay(engine: Any) -> dict:
+            meter = PhaseMeter()
+            StubDownloader.started = []
+
+            def make_wrapper(method: str, original: Callable) -> Callable:
+                def replayed(*args: Any, **kwargs: Any) -> Any:
+                    key = API_KEYS[method](*args, **kwargs)
+                    # 늘린 항목은 원래 항목의 응답
+                    found = (method, key) in responses
+                    if not found and SYNTHETIC_SEPARATOR in key:
+                        contentid, _, rest = key.partition(SYNTHETIC_SEPARATOR)
+                        key = contentid + (rest[rest.find('|'):] if '|' in rest else '')
+                        found = (method, key) in responses
+                    meter.on_api(method, found)
+                    return responses.get((method, key))
+                return replayed
+
+            event.listen(engine, 'before_cursor_execute', meter.on_query)
+            seeded = seed_recent_rows(model, engine, (responses.get(('get_new_vods', '')) or [[]])[0], rows)
+            patches = [
+                mock.patch.object(ENGINES, 'build', lambda job, engine: StubDownloader(callback_id=job.callback_id)),
+                mock.patch.object(module_ns, 'download_webvtts', lambda *args, **kwargs: None),
+                mock.patch.object(module_ns, 'DISPATCH_INTERVAL', 0),
+                meter.wrap(module, 'get_recent_vods', 'discover'),
+                meter.wrap(module, 'save_recent_vods', 'discover'),
+                meter.wrap(module, 'pick_out_recent_vods', 'pick_out'),
+                meter.wrap(module, 'retrieve_recent_vods', 'retrieve'),
+                meter.wrap(module, 'dispatch_recent_vods', 'dispatch'),
+            ]
+            self.patch_api(make_wrapper)
+            for patch in patches:
+                patch.start()
+            try:
+                started = time.perf_counter()
+                module.update_recent_vods()
+                module.dispatch_recent_vods()
+                total = time.perf_counter() - started
+            finally:
+                for patch in reversed(patches):
+                    patch.stop()
+                self.restore_api()
+            with engine.connect() as conn:
+                table_rows = conn.execute(text(f'SELECT COUNT(*) FROM "{model.__tablename__}"')).scalar()
+            return {
+                'fixture': os.path.basename(path),
+                'seeded_rows': seeded,
+                'table_rows': table_rows,
+                'total_ms': round(total * 1000, 1),
+                'downloads': len(StubDownloader.started),
+                'phases': meter.report(),
+            }
+
+        report = self.isolated(replay)
+        logger.info(f'Replay: {json.dumps(report, ensure_ascii=False)}')
+        return report
+
+
+REPLAY = ReplayHarness()
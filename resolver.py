@@ -0,0 +1,151 @@
+import json
+import time
+import threading
+import concurrent.futures
+from typing import Callable
+
+from support_site import SupportWavve
+
+from .setup import P
+
+
+logger = P.logger
+settings = P.ModelSetting
+# 높은 화질부터
+QUALITY_ORDER = ('2160p', '1080p', '720p', '480p', '360p')
+# 한 번에 요청할 화질 수
+MAX_CANDIDATES = 3
+# 이만큼의 에피소드를 확인한 프로그램은 제공한 적 없는 화질을 기다리지 않음
+MIN_SEEN = 3
+# 같은 에피소드를 다시 세지 않도록 기억할 수
+RECENT_EPISODES = 10
+MAX_PROGRAMS = 5000
+SAVE_INTERVAL = 60
+
+
+def rank(quality: str | None) -> int:
+    '''낮을수록 좋은 화질'''
+    return QUALITY_ORDER.index(quality) if quality in QUALITY_ORDER else len(QUALITY_ORDER)
+
+
+def lower_qualities(quality: str, count: int = MAX_CANDIDATES) -> list[str]:
+    '''quality부터 낮은 화질 순서로'''
+    if quality not in QUALITY_ORDER:
+        return [quality]
+    index = QUALITY_ORDER.index(quality)
+    return list(QUALITY_ORDER[index:index + count])
+
+
+class QualityResolver:
+    '''
+    원하는 화질을 먼저 요청하고, 없거나 낮은 화질로 받으면 나머지 화질을 동시에 요청해서 가장 좋은 것을 고름
+    프로그램별로 제공된 적 있는 화질을 기억
+    '''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # key: programid, value: {'offered': [quality, ...], 'seen': 확인한 에피소드 수, 'episodes': [contentid, ...], 'updated': time}
+        self.programs = None
+        self.saved_at = 0.0
+
+    def load(self) -> dict:
+        if self.programs is None:
+            try:
+                self.programs = json.loads(settings.get('basic_quality_history') or '{}')
+            except Exception:
+                logger.exception('Loading quality history failed')
+                self.programs = {}
+        return self.programs
+
+    def save(self) -> None:
+        if time.monotonic() - self.saved_at < SAVE_INTERVAL:
+            return
+        self.saved_at = time.monotonic()
+        with self.lock:
+            data = json.dumps(self.load(), separators=(',', ':'))
+        try:
+            settings.set('basic_quality_history', data)
+        except Exception:
+            logger.exception('Saving quality history failed')
+
+    def remember(self, programid: str | None, contentid: str, offered: set) -> None:
+        if not programid or not offered:
+            return
+        with self.lock:
+            programs = self.load()
+            program = programs.setdefault(programid, {'offered': [], 'seen': 0, 'episodes': [], 'updated': 0})
+            program['offered'] = sorted(set(program['offered']) | offered, key=rank)
+            if contentid not in program['episodes']:
+                program['seen'] += 1
+                program['episodes'] = (program['episodes'] + [contentid])[-RECENT_EPISODES:]
+            program['updated'] = int(time.time())
+            if len(programs) > MAX_PROGRAMS:
+                for key in sorted(programs, key=lambda key: programs[key]['updated'])[:len(programs) - MAX_PROGRAMS]:
+                    del programs[key]
+        self.save()
+
+    def offered(self, programid: str | None) -> list[str] | None:
+        '''제공된 적 있는 화질, 충분히 확인하지 않았으면 None'''
+        with self.lock:
+            program = self.load().get(programid or '')
+            if not program or program['seen'] < MIN_SEEN:
+                return None
+            return list(program['offered'])
+
+    def never_offered(self, programid: str | None, quality: str) -> bool:
+        return (offered := self.offered(programid)) is not None and quality not in offered
+
+    @staticmethod
+    def listed_qualities(contents: dict | None) -> set:
+        '''상세 정보에 화질 목록이 있으면'''
+        try:
+            return {item['id'] for item in (contents or {})['qualities']['list'] if item.get('id')}
+        except Exception:
+            return set()
+
+    def resolve(self, contenttype: str, contentid: str, qualities: list[str], action: str, programid: str = None,
+                contents: dict = None, accept: Callable[[str], bool] = None) -> dict | None:
+        '''
+        qualities: 요청할 화질
+        accept: 받아도 되는 화질인지, 없으면 모두
+        '''
+        qualities = list(dict.fromkeys(qualities))
+        wanted, rest = qualities[0], qualities[1:]
+        results = {}
+        try:
+            results[wanted] = SupportWavve.streaming(contenttype, contentid, wanted, action=action)
+        except Exception:
+            logger.exception(f'Requesting streaming data failed: {contentid} {wanted}')
+        # 요청한 화질보다 낮게 줄 수도 있음, 받아도 되는 화질이면 그보다 좋은 화질만 더 요청
+        if got := (results.get(wanted) or {}).get('quality'):
+            if not accept or accept(got):
+                rest = [quality for quality in rest if rank(quality) < rank(got)]
+            else:
+                rest = [quality for quality in rest if quality != got]
+        # 제공한 적 없는 화질은 요청하지 않음
+        if rest and (offered := self.offered(programid)):
+            rest = [quality for quality in rest if quality in offered]
+        if len(rest) == 1:
+            try:
+                results[rest[0]] = SupportWavve.streaming(contenttype, contentid, rest[0], action=action)
+            except Exception:
+                logger.exception(f'Requesting streaming data failed: {contentid} {rest[0]}')
+        elif rest:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(rest)) as executor:
+                futures = {quality: executor.submit(SupportWavve.streaming, contenttype, contentid, quality, action=action) for quality in rest}
+                for quality, future in futures.items():
+                    try:
+                        results[quality] = future.result()
+                    except Exception:
+                        logger.exception(f'Requesting streaming data failed: {contentid} {quality}')
+        answers = [data for data in results.values() if data and data.get('quality')]
+        self.remember(programid, contentid, {data['quality'] for data in answers} | self.listed_qualities(contents))
+        answers = [data for data in answers if not accept or accept(data['quality'])]
+        if not answers:
+            return None
+        best = min(answers, key=lambda data: rank(data['quality']))
+        logger.debug(f"Resolved {contentid}: {best['quality']} of {sorted({data['quality'] for data in answers}, key=rank)}")
+        return best
+
+
+RESOLVER = QualityResolver()
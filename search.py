@@ -0,0 +1,91 @@
+import re
+import sqlite3
+
+from flask_sqlalchemy.query import Query
+from sqlalchemy import column, text
+
+from .setup import P
+
+
+logger = P.logger
+# table: 검색할 컬럼
+FTS_COLUMNS = {
+    f'{P.package_name}_recent': ('programtitle', 'episodetitle', 'channelname', 'programgenre', 'filename'),
+    f'{P.package_name}_program': ('program_title', 'episode_title', 'channelname', 'programgenre', 'filename'),
+}
+# FTS5 trigram을 쓸 수 있는 table
+AVAILABLE = set()
+# trigram은 3글자 이상
+MIN_TERM_LENGTH = 3
+TERM_SPLITTER = re.compile(r'[\s,]+')
+
+
+def ensure_fts(cs: sqlite3.Cursor, table: str) -> bool:
+    '''FTS5 테이블과 동기화 트리거, 없으면 만들고 다시 색인'''
+    fts = f'{table}_fts'
+    columns = FTS_COLUMNS[table]
+    names = ', '.join(columns)
+    news = ', '.join(f'new.{name}' for name in columns)
+    olds = ', '.join(f'old.{name}' for name in columns)
+    try:
+        exists = cs.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,)).fetchone()
+        cs.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS "{fts}" USING fts5({names}, '
+            f"content='{table}', content_rowid='id', tokenize='trigram')"
+        )
+        cs.execute(
+            f'CREATE TRIGGER IF NOT EXISTS "{fts}_ai" AFTER INSERT ON "{table}" BEGIN '
+            f'INSERT INTO "{fts}"(rowid, {names}) VALUES (new.id, {news}); END'
+        )
+        cs.execute(
+            f'CREATE TRIGGER IF NOT EXISTS "{fts}_ad" AFTER DELETE ON "{table}" BEGIN '
+            f'INSERT INTO "{fts}"("{fts}", rowid, {names}) VALUES (\'delete\', old.id, {olds}); END'
+        )
+        cs.execute(
+            f'CREATE TRIGGER IF NOT EXISTS "{fts}_au" AFTER UPDATE OF {names} ON "{table}" BEGIN '
+            f'INSERT INTO "{fts}"("{fts}", rowid, {names}) VALUES (\'delete\', old.id, {olds}); '
+            f'INSERT INTO "{fts}"(rowid, {names}) VALUES (new.id, {news}); END'
+        )
+        if not exists:
+            cs.execute(f'INSERT INTO "{fts}"("{fts}") VALUES (\'rebuild\')')
+            logger.info(f'Built search index: {fts}')
+    except sqlite3.OperationalError:
+        # FTS5나 trigram을 지원하지 않는 SQLite
+        logger.exception(f'Search index is not available: {fts}')
+        AVAILABLE.discard(table)
+        return False
+    AVAILABLE.add(table)
+    return True
+
+
+def make_match(search: str) -> str | None:
+    '''
+    | : OR
+    공백, 쉼표 : AND
+    3글자 미만이 있으면 None
+    '''
+    groups = []
+    for group in search.split('|'):
+        terms = [term for term in TERM_SPLITTER.split(group) if term]
+        if not terms:
+            continue
+        if any(len(term) < MIN_TERM_LENGTH for term in terms):
+            return None
+        groups.append(' AND '.join('"{}"'.format(term.replace('"', '""')) for term in terms))
+    if not groups:
+        return None
+    return ' OR '.join(f'({group})' for group in groups)
+
+
+def search_query(model: type, query: Query, search: str, fallback_column: object) -> Query:
+    search = (search or '').strip()
+    if not search:
+        return query
+    table = model.__tablename__
+    match = make_match(search) if table in AVAILABLE else None
+    if match:
+        fts = f'{table}_fts'
+        rowids = text(f'SELECT rowid FROM "{fts}" WHERE "{fts}" MATCH :match').bindparams(match=match).columns(column('rowid'))
+        return query.filter(model.id.in_(rowids))
+    # 짧은 검색어는 LIKE
+    return model.make_query_search(query, search, fallback_column)
@@ -0,0 +1,41 @@
+import sys
+import pathlib
+import importlib
+from typing import Any, Callable
+
+import pytest
+
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+
+class Settings:
+    '''P.ModelSetting 대신 쓰는 설정값'''
+
+    def __init__(self, **values: Any) -> None:
+        self.values = {key: str(value) for key, value in values.items()}
+
+    def get(self, key: str) -> str | None:
+        return self.values.get(key)
+
+    def get_int(self, key: str) -> int:
+        return int(self.values[key])
+
+    def get_bool(self, key: str) -> bool:
+        return self.values.get(key) == 'True'
+
+    def set(self, key: str, value: Any) -> None:
+        self.values[key] = str(value)
+
+
+@pytest.fixture(scope='session')
+def load() -> Callable[[str], Any]:
+    '''플러그인 모듈, flaskfarm의 plugin 패키지가 있어야 불러올 수 있음'''
+    pytest.importorskip('plugin', reason='flaskfarm is not installed')
+    if str(ROOT.parent) not in sys.path:
+        sys.path.insert(0, str(ROOT.parent))
+
+    def load(name: str) -> Any:
+        return importlib.import_module(f'{ROOT.name}.{name}')
+
+    return load
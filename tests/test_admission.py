@@ -0,0 +1,102 @@
+import time
+import types
+import threading
+
+import pytest
+
+from conftest import Settings
+
+
+@pytest.fixture
+def admission(load, monkeypatch):
+    module = load('admission')
+    monkeypatch.setattr(module, 'POOL', types.SimpleNamespace(capacity=0))
+    return module
+
+
+def make_controller(admission, monkeypatch, **values):
+    monkeypatch.setattr(admission, 'settings', Settings(**values))
+    return admission.AdmissionController()
+
+
+def wait_for(condition, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_global_limit(admission, monkeypatch):
+    controller = make_controller(admission, monkeypatch, basic_global_max_count=2)
+    assert controller.acquire('basic', 'a', timeout=0)
+    assert controller.acquire('program', 'b', timeout=0)
+    assert not controller.acquire('recent', 'c', timeout=0)
+    # 이미 가진 슬롯
+    assert controller.acquire('basic', 'a', timeout=0)
+    controller.release('a')
+    assert controller.acquire('recent', 'c', timeout=0)
+    assert controller.count() == 2
+
+
+def test_module_limit(admission, monkeypatch):
+    controller = make_controller(admission, monkeypatch, basic_global_max_count=4, program_ffmpeg_max_count=1)
+    assert controller.acquire('program', 'a', timeout=0)
+    assert not controller.acquire('program', 'b', timeout=0)
+    assert controller.available('program') == 0
+    assert controller.available('basic') == 3
+
+
+def test_proxy_capacity_caps_the_global_limit(admission, monkeypatch):
+    monkeypatch.setattr(admission, 'POOL', types.SimpleNamespace(capacity=1))
+    controller = make_controller(admission, monkeypatch, basic_global_max_count=4)
+    assert controller.global_limit == 1
+
+
+def test_reservation_is_kept_for_other_modules(admission, monkeypatch):
+    controller = make_controller(admission, monkeypatch, basic_global_max_count=3, basic_reserved_recent=1)
+    assert controller.acquire('basic', 'a', timeout=0)
+    assert controller.acquire('basic', 'b', timeout=0)
+    # 남은 하나는 최근방송 몫
+    assert not controller.acquire('basic', 'c', timeout=0)
+    assert controller.acquire('recent', 'd', timeout=0)
+
+
+def test_weighted_pick(admission, monkeypatch):
+    controller = make_controller(admission, monkeypatch, basic_global_max_count=10)
+    controller.refresh_limits()
+    controller.holders = {'a': 'recent', 'b': 'recent'}
+    controller.waiters = [(0, 'recent', 'c'), (1, 'program', 'd'), (2, 'basic', 'e')]
+    # recent 2/3 > program 0/2 = basic 0/1, 같으면 우선순위
+    assert controller.pick() == (1, 'program', 'd')
+    controller.holders['f'] = 'program'
+    assert controller.pick() == (2, 'basic', 'e')
+
+
+def test_waiters_are_admitted_by_priority(admission, monkeypatch):
+    controller = make_controller(admission, monkeypatch, basic_global_max_count=1)
+    assert controller.acquire('basic', 'holder', timeout=0)
+    admitted = []
+
+    def wait(module: str, key: str) -> None:
+        if controller.acquire(module, key, timeout=5):
+            admitted.append(key)
+
+    threads = []
+    for index, (module, key) in enumerate((('basic', 'first'), ('recent', 'second'))):
+        threads.append(threading.Thread(target=wait, args=(module, key), daemon=True))
+        threads[-1].start()
+        wait_for(lambda: len(controller.waiters) == index + 1)
+    controller.release('holder')
+    wait_for(lambda: admitted)
+    assert admitted == ['second']
+    controller.release('second')
+    for thread in threads:
+        thread.join(5)
+    assert admitted == ['second', 'first']
+
+
+def test_cancelled_waiter(admission, monkeypatch):
+    controller = make_controller(admission, monkeypatch, basic_global_max_count=1)
+    assert controller.acquire('basic', 'a', timeout=0)
+    assert not controller.acquire('basic', 'b', cancelled=lambda: True)
+    assert controller.waiters == []
@@ -0,0 +1,106 @@
+import pytest
+
+from conftest import Settings
+
+
+sqlalchemy = pytest.importorskip('sqlalchemy')
+
+
+@pytest.fixture
+def cluster(load, monkeypatch):
+    module = load('cluster')
+    monkeypatch.setattr(module, 'settings', Settings(
+        basic_cluster_enabled=True,
+        basic_cluster_db_url='sqlite://',
+        basic_cluster_lease_second=60,
+        basic_cluster_max_attempts=2,
+    ))
+    return module
+
+
+@pytest.fixture
+def nodes(cluster):
+    '''같은 메모리 DB를 쓰는 두 노드'''
+
+    class Node(cluster.ClusterNode):
+
+        def __init__(self, node_id: str) -> None:
+            super().__init__()
+            self.id = node_id
+
+        @property
+        def node_id(self) -> str:
+            return self.id
+
+    first, second = Node('node-a'), Node('node-b')
+    second.engine, second.url = first.get_engine(), first.url
+    yield first, second
+    first.engine.dispose()
+
+
+def get_job(cluster, node, job_key: str):
+    with node.get_engine().connect() as conn:
+        return conn.execute(sqlalchemy.select(cluster.JOBS).where(cluster.JOBS.c.job_key == job_key)).first()
+
+
+def test_claim_is_exclusive(cluster, nodes):
+    first, second = nodes
+    assert first.publish('recent', 'C1', '1080p', {'contentid': 'C1'}) == 'waiting'
+    jobs = first.claim('recent', 5)
+    assert [job['job_key'] for job in jobs] == [cluster.make_job_key('recent', 'C1', '1080p')]
+    assert jobs[0]['payload'] == {'contentid': 'C1'}
+    assert second.claim('recent', 5) == []
+    assert first.publish('recent', 'C1', '1080p', {}) == 'leased'
+
+
+def test_expired_lease_is_reclaimed(cluster, nodes):
+    first, second = nodes
+    first.publish('recent', 'C1', '1080p', {})
+    first.claim('recent', 1)
+    job_key = cluster.make_job_key('recent', 'C1', '1080p')
+    with first.get_engine().begin() as conn:
+        conn.execute(cluster.JOBS.update().where(cluster.JOBS.c.job_key == job_key).values(lease_until=0))
+    jobs = second.claim('recent', 1)
+    assert [job['job_key'] for job in jobs] == [job_key]
+    # 임대를 잃은 노드의 결과는 반영하지 않음
+    first.finish('recent', 'C1', '1080p', True)
+    row = get_job(cluster, second, job_key)
+    assert (row.status, row.owner, row.attempts) == ('leased', 'node-b', 2)
+
+
+def test_heartbeat_keeps_the_lease(cluster, nodes):
+    first, second = nodes
+    first.publish('recent', 'C1', '1080p', {})
+    first.claim('recent', 1)
+    job_key = cluster.make_job_key('recent', 'C1', '1080p')
+    with first.get_engine().begin() as conn:
+        conn.execute(cluster.JOBS.update().where(cluster.JOBS.c.job_key == job_key).values(lease_until=0))
+    first.heartbeat()
+    assert second.claim('recent', 1) == []
+
+
+def test_finish_retries_until_max_attempts(cluster, nodes):
+    first, _ = nodes
+    first.publish('program', 'C1', '720p', {})
+    job_key = cluster.make_job_key('program', 'C1', '720p')
+    assert first.claim('program', 1)
+    first.finish('program', 'C1', '720p', None)
+    assert get_job(cluster, first, job_key).status == 'waiting'
+    assert first.claim('program', 1)
+    first.finish('program', 'C1', '720p', None)
+    assert get_job(cluster, first, job_key).status == 'failed'
+    assert first.claim('program', 1) == []
+    # 실패한 작업은 다시 등록하면 처음부터
+    assert first.publish('program', 'C1', '720p', {}) == 'failed'
+    row = get_job(cluster, first, job_key)
+    assert (row.status, row.attempts) == ('waiting', 0)
+
+
+def test_finish_completed(cluster, nodes):
+    first, second = nodes
+    first.publish('recent', 'C1', '1080p', {})
+    first.claim('recent', 1)
+    first.finish('recent', 'C1', '1080p', True)
+    assert get_job(cluster, first, cluster.make_job_key('recent', 'C1', '1080p')).status == 'completed'
+    assert first.held == set()
+    assert second.claim('recent', 1) == []
@@ -0,0 +1,59 @@
+import types
+import datetime
+
+import pytest
+
+from conftest import Settings
+
+
+@pytest.fixture
+def downloader(load, monkeypatch):
+    pytest.importorskip('wv_tool', reason='wv_tool is not installed')
+    module = load('downloader')
+    monkeypatch.setattr(module, 'settings', Settings(basic_drm_key_ttl_minute=10))
+    return module
+
+
+def test_kid_is_normalized(downloader):
+    cache = downloader.KeyCache()
+    cache.put('C1', [{'kid': '0123ABCD-89AB-CDEF-0123-456789ABCDEF', 'key': 'k1'}])
+    assert cache.get('C1', {'0123abcd89abcdef0123456789abcdef'}) == [{'kid': '0123ABCD-89AB-CDEF-0123-456789ABCDEF', 'key': 'k1'}]
+    assert cache.get('C1', {'0123abcd-89ab-cdef-0123-456789abcdef'})
+
+
+def test_all_kids_must_be_cached(downloader):
+    cache = downloader.KeyCache()
+    cache.put('C1', [{'kid': 'aa', 'key': 'k1'}, {'kid': 'bb', 'key': 'k2'}, {'kid': 'cc'}])
+    assert cache.get('C1', {'aa', 'dd'}) is None
+    assert len(cache.get('C1', {'AA', 'bb'})) == 2
+    # KID를 모르면 받았던 키 전부
+    assert len(cache.get('C1')) == 2
+    assert cache.get('C2') is None
+
+
+def test_expired_keys_are_dropped(downloader):
+    cache = downloader.KeyCache()
+    cache.put('C1', [{'kid': 'aa', 'key': 'k1'}, {'kid': 'bb', 'key': 'k2'}])
+    cache.items[('C1', 'aa')]['time'] -= datetime.timedelta(minutes=11)
+    assert cache.get('C1', {'aa'}) is None
+    assert ('C1', 'aa') not in cache.items
+    assert cache.get('C1') == [{'kid': 'bb', 'key': 'k2'}]
+
+
+def test_invalidate(downloader):
+    cache = downloader.KeyCache()
+    cache.put('C1', [{'kid': 'aa', 'key': 'k1'}])
+    cache.put('C2', [{'kid': 'aa', 'key': 'k2'}])
+    cache.invalidate('C1')
+    assert cache.get('C1') is None
+    assert cache.get('C2', {'aa'}) == [{'kid': 'aa', 'key': 'k2'}]
+
+
+def test_default_kids_from_the_fetched_mpd(downloader):
+    protection = types.SimpleNamespace(cenc_default_kid='AAAA-BBBB', default_key_id=None, ns2_key_id=None)
+    representation = types.SimpleNamespace(content_protections=[types.SimpleNamespace(ns2_key_id='cccc')])
+    adaptation_set = types.SimpleNamespace(content_protections=[protection], representations=[representation])
+    mixin = downloader.KeyCacheMixin()
+    assert mixin.default_kids() == set()
+    mixin.mpd = types.SimpleNamespace(periods=[types.SimpleNamespace(adaptation_sets=[adaptation_set])])
+    assert mixin.default_kids() == {'aaaabbbb', 'cccc'}
@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def registry(load, monkeypatch):
+    module = load('registry')
+    monkeypatch.setattr(module, 'ADMISSION', load('admission').AdmissionController())
+    return module
+
+
+def test_claim(registry):
+    leases = registry.ContentRegistry()
+    assert leases.claim('C1', '1080p', 'wavve_recent_1') is None
+    # 같은 작업은 다시 임대해도 됨
+    assert leases.claim('C1', '1080p', 'wavve_recent_1') is None
+    assert leases.claim('C1', '1080p', 'wavve_program_2') == 'wavve_recent_1'
+    # 화질이 다르면 다른 임대
+    assert leases.claim('C1', '720p', 'wavve_program_2') is None
+    assert leases.holder('C1', '1080p') == 'wavve_recent_1'
+
+
+def test_attach_and_finish(registry):
+    leases = registry.ContentRegistry()
+    assert not leases.attach('C1', '1080p', lambda completed: None)
+    leases.claim('C1', '1080p', 'wavve_recent_1')
+    results = []
+    assert leases.attach('C1', '1080p', results.append)
+    assert leases.attach('C1', '1080p', results.append)
+    leases.finish('wavve_recent_1', True)
+    assert results == [True, True]
+    assert leases.holder('C1', '1080p') is None
+    assert leases.claim('C1', '1080p', 'wavve_program_2') is None
+
+
+def test_follower_error_does_not_stop_others(registry):
+    leases = registry.ContentRegistry()
+    leases.claim('C1', '1080p', 'wavve_recent_1')
+    results = []
+    leases.attach('C1', '1080p', lambda completed: 1 / 0)
+    leases.attach('C1', '1080p', results.append)
+    leases.finish('wavve_recent_1', False)
+    assert results == [False]
+
+
+def test_stale_lease_is_reclaimed(registry, monkeypatch):
+    leases = registry.ContentRegistry()
+    leases.claim('C1', '1080p', 'wavve_recent_1')
+    notified = threading.Event()
+    results = []
+
+    def follow(completed: bool) -> None:
+        results.append(completed)
+        notified.set()
+
+    assert leases.attach('C1', '1080p', follow)
+    # 슬롯이 없고 소식도 없는 임대
+    monkeypatch.setattr(registry, 'LEASE_TTL', -1)
+    assert leases.claim('C1', '1080p', 'wavve_program_2') is None
+    assert notified.wait(5)
+    assert results == [False]
+    assert leases.leases[('C1', '1080p')].owner == 'wavve_program_2'
+
+
+def test_lease_with_a_slot_is_not_stale(registry, monkeypatch):
+    monkeypatch.setattr(registry, 'LEASE_TTL', -1)
+    registry.ADMISSION.holders['wavve_recent_1'] = 'recent'
+    leases = registry.ContentRegistry()
+    leases.claim('C1', '1080p', 'wavve_recent_1')
+    assert leases.claim('C1', '1080p', 'wavve_program_2') == 'wavve_recent_1'
+
+
+def test_touch_keeps_the_lease(registry, monkeypatch):
+    leases = registry.ContentRegistry()
+    leases.claim('C1', '1080p', 'wavve_recent_1')
+    monkeypatch.setattr(registry, 'LEASE_TTL', 60)
+    leases.leases[('C1', '1080p')].touched -= 120
+    leases.touch('wavve_recent_1')
+    assert leases.holder('C1', '1080p') == 'wavve_recent_1'
@@ -0,0 +1,23 @@
+import pytest
+
+
+@pytest.fixture
+def search(load):
+    return load('search')
+
+
+@pytest.mark.parametrize('keyword, match', [
+    ('런닝맨', '("런닝맨")'),
+    ('나 혼자 산다', None),
+    ('나혼자 산다고', '("나혼자" AND "산다고")'),
+    ('나혼자산다', '("나혼자산다")'),
+    ('런닝맨 SBS 1080p', '("런닝맨" AND "SBS" AND "1080p")'),
+    ('런닝맨,  SBS', '("런닝맨" AND "SBS")'),
+    ('런닝맨|나혼자산다 MBC', '("런닝맨") OR ("나혼자산다" AND "MBC")'),
+    ('런닝맨||', '("런닝맨")'),
+    ('say "hi"', '("say" AND """hi""")'),
+    ('', None),
+    (' | , ', None),
+])
+def test_make_match(search, keyword, match):
+    assert search.make_match(keyword) == match
@@ -0,0 +1,251 @@
+import io
+import os
+import time
+import queue
+import hashlib
+import threading
+import urllib.parse
+
+import flask
+import requests
+
+from .setup import F, P
+
+
+logger = P.logger
+settings = P.ModelSetting
+# 웨이브 이미지 서버만 허용
+ALLOWED_HOSTS = ('wavve.com', 'pooq.co.kr')
+MAX_AGE = 30 * 24 * 3600
+WIDTHS = (160, 320, 480, 640)
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'}
+
+
+def normalize_image_url(url: str) -> str:
+    url = (url or '').strip()
+    if url.startswith('//'):
+        return f'https:{url}'
+    if url and not url.startswith('http'):
+        return f'https://{url}'
+    return url
+
+
+def is_allowed(url: str) -> bool:
+    host = urllib.parse.urlparse(url).hostname or ''
+    return any(host == allowed or host.endswith(f'.{allowed}') for allowed in ALLOWED_HOSTS)
+
+
+def thumbnail_url(url: str, enabled: bool, width: int) -> str:
+    '''목록 페이지에서 쓸 프록시 주소, 설정값은 목록마다 한 번 읽어서 넘김'''
+    url = normalize_image_url(url)
+    if not url or not enabled or not is_allowed(url):
+        return url
+    query = urllib.parse.urlencode({'url': url, 'w': width})
+    return f'/{P.package_name}/normal/basic/thumbnail?{query}'
+
+
+class ThumbnailCache:
+    '''원본은 한 번만 받아서 줄인 뒤 디스크에 보관, 용량을 넘으면 오래 안 쓴 것부터 삭제'''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # 같은 이미지를 동시에 받지 않도록
+        self.key_locks = {}
+        self.total_size = None
+        self.queue = queue.Queue(maxsize=1000)
+        self.thread = None
+
+    @property
+    def cache_dir(self) -> str:
+        return os.path.join(F.config['path_data'], 'cache', P.package_name, 'thumbnail')
+
+    @property
+    def max_size(self) -> int:
+        '''bytes, 0: 사용 안 함'''
+        try:
+            return max(settings.get_int('basic_thumbnail_cache_mb'), 0) * 1024 * 1024
+        except Exception:
+            return 200 * 1024 * 1024
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    @property
+    def width(self) -> int:
+        try:
+            return self.fit_width(settings.get_int('basic_thumbnail_width'))
+        except Exception:
+            return 320
+
+    @staticmethod
+    def fit_width(width: int) -> int:
+        '''캐시가 늘어나지 않게 정해진 크기만'''
+        for candidate in WIDTHS:
+            if width <= candidate:
+                return candidate
+        return WIDTHS[-1]
+
+    @staticmethod
+    def get_format(req: flask.Request = None) -> str:
+        if req is None or 'image/webp' in (req.headers.get('Accept') or ''):
+            return 'webp'
+        return 'jpeg'
+
+    def get_path(self, url: str, width: int, fmt: str) -> str:
+        digest = hashlib.sha1(f'{url}|{width}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f'{digest}.{"webp" if fmt == "webp" else "jpg"}')
+
+    def get(self, url: str, width: int, fmt: str) -> str | None:
+        path = self.get_path(url, width, fmt)
+        if os.path.exists(path):
+            self.touch(path)
+            return path
+        with self.lock:
+            key_lock = self.key_locks.setdefault(path, threading.Lock())
+        try:
+            with key_lock:
+                if os.path.exists(path):
+                    return path
+                data = self.fetch(url)
+                if data is None:
+                    return None
+                self.write(path, self.resize(data, width, fmt))
+                return path
+        finally:
+            with self.lock:
+                self.key_locks.pop(path, None)
+
+    def fetch(self, url: str) -> bytes | None:
+        try:
+            response = requests.get(url, headers=HEADERS, timeout=10)
+            response.raise_for_status()
+            return response.content
+        except Exception as e:
+            logger.debug(f'Could not fetch image: {url} {e}')
+            return None
+
+    def resize(self, data: bytes, width: int, fmt: str) -> bytes:
+        from PIL import Image
+        with Image.open(io.BytesIO(data)) as image:
+            image = image.convert('RGB')
+            if image.width > width:
+                height = max(round(image.height * width / image.width), 1)
+                image = image.resize((width, height), Image.LANCZOS)
+            buffer = io.BytesIO()
+            if fmt == 'webp':
+                image.save(buffer, 'WEBP', quality=80, method=4)
+            else:
+                image.save(buffer, 'JPEG', quality=80, optimize=True, progressive=True)
+            return buffer.getvalue()
+
+    def write(self, path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            if self.total_size is not None:
+                self.total_size += len(data)
+        self.evict()
+
+    def touch(self, path: str) -> None:
+        '''mtime을 마지막 사용 시각으로'''
+        try:
+            if os.path.getmtime(path) + 3600 < time.time():
+                os.utime(path)
+        except OSError:
+            pass
+
+    def scan(self) -> list[tuple[float, int, str]]:
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self) -> None:
+        max_size = self.max_size
+        with self.lock:
+            if self.total_size is None:
+                self.total_size = sum(size for _, size, _ in self.scan())
+            if self.total_size <= max_size:
+                return
+            files = sorted(self.scan())
+            total = sum(size for _, size, _ in files)
+            # 한 번 정리할 때 90%까지
+            target = max_size * 0.9
+            count = 0
+            for _, size, path in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    count += 1
+                except OSError:
+                    pass
+            self.total_size = total
+        logger.debug(f'Evicted thumbnails: {count}')
+
+    def response(self, req: flask.Request) -> flask.Response:
+        url = normalize_image_url(req.args.get('url'))
+        if not url or not is_allowed(url):
+            flask.abort(404)
+        if not self.enabled:
+            return flask.redirect(url)
+        try:
+            width = self.fit_width(int(req.args.get('w') or self.width))
+        except ValueError:
+            width = self.width
+        fmt = self.get_format(req)
+        try:
+            path = self.get(url, width, fmt)
+        except Exception:
+            logger.exception(f'Thumbnail failed: {url}')
+            path = None
+        if not path:
+            return flask.redirect(url)
+        res = flask.send_file(path, mimetype=f'image/{fmt}', max_age=MAX_AGE, conditional=True)
+        res.headers['Cache-Control'] = f'public, max-age={MAX_AGE}, immutable'
+        res.vary.add('Accept')
+        return res
+
+    def prewarm(self, *urls: str) -> None:
+        '''목록에 들어온 이미지를 미리 받아 둠'''
+        if not self.enabled:
+            return
+        for url in urls:
+            url = normalize_image_url(url)
+            if not url or not is_allowed(url):
+                continue
+            try:
+                self.queue.put_nowait(url)
+            except queue.Full:
+                return
+        if not self.thread or not self.thread.is_alive():
+            with self.lock:
+                if not self.thread or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self.run, name=f'{P.package_name}_thumbnail', daemon=True)
+                    self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            try:
+                url = self.queue.get(timeout=60)
+            except queue.Empty:
+                return
+            try:
+                # 대부분의 브라우저가 WebP 지원
+                self.get(url, self.width, 'webp')
+            except Exception:
+                logger.exception(f'Prewarming thumbnail failed: {url}')
+
+
+THUMBNAIL = ThumbnailCache()
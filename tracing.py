@@ -0,0 +1,108 @@
+import json
+import time
+import threading
+import contextlib
+import collections
+from typing import Any, Iterator
+
+from .setup import P
+from .metrics import DOWNLOAD_PHASE
+
+
+logger = P.logger
+PHASES = ('metadata', 'resolve', 'license', 'subtitle', 'download', 'decrypt', 'mux', 'finalize')
+# 다운로드 도구의 상태: 시작되는 구간
+STATUS_PHASES = {
+    'DOWNLOADING': 'download',
+    'DECRYPTING': 'decrypt',
+    'MUXING': 'mux',
+}
+# 진행 중인 구간을 끝내는 상태
+STATUS_CLOSES = ('FETCHED',)
+# 다운로드를 시작하지 않은 항목도 쌓이므로 오래된 것부터 버림
+MAX_TRACES = 2000
+
+
+class Trace:
+
+    def __init__(self) -> None:
+        # key: phase, value: (started, ended)
+        self.spans = {}
+        self.current = None
+
+    def record(self, phase: str, started: float, ended: float) -> None:
+        # 재생 주소 갱신 등으로 다시 실행되면 마지막 것만
+        self.spans[phase] = (started, ended)
+
+    def enter(self, phase: str, now: float) -> None:
+        self.close(now)
+        self.current = (phase, now)
+
+    def close(self, now: float) -> None:
+        if self.current:
+            phase, started = self.current
+            self.record(phase, started, now)
+            self.current = None
+
+    def dump(self) -> str | None:
+        '''[[구간, 시작(ms), 걸린 시간(ms)], ...]'''
+        if not self.spans:
+            return None
+        origin = min(started for started, _ in self.spans.values())
+        spans = sorted(self.spans.items(), key=lambda item: item[1][0])
+        return json.dumps(
+            [[phase, round((started - origin) * 1000), round((ended - started) * 1000)] for phase, (started, ended) in spans],
+            separators=(',', ':'),
+        )
+
+
+class TraceRecorder:
+    '''callback_id 별 구간 시간'''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.traces = collections.OrderedDict()
+
+    def get(self, callback_id: str) -> Trace:
+        trace = self.traces.get(callback_id)
+        if trace is None:
+            trace = self.traces[callback_id] = Trace()
+            while len(self.traces) > MAX_TRACES:
+                self.traces.popitem(last=False)
+        else:
+            self.traces.move_to_end(callback_id)
+        return trace
+
+    @contextlib.contextmanager
+    def span(self, callback_id: str | None, phase: str) -> Iterator[None]:
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            if callback_id:
+                with self.lock:
+                    self.get(callback_id).record(phase, started, time.monotonic())
+
+    def on_status(self, callback_id: str, status: Any) -> None:
+        '''다운로드 도구의 상태 변화로 구간 전환'''
+        status = str(getattr(status, 'name', status)).upper()
+        with self.lock:
+            if phase := STATUS_PHASES.get(status):
+                self.get(callback_id).enter(phase, time.monotonic())
+            elif status in STATUS_CLOSES and callback_id in self.traces:
+                self.traces[callback_id].close(time.monotonic())
+
+    def pop(self, callback_id: str) -> str | None:
+        '''다운로드가 끝나면 DB에 저장할 문자열로'''
+        with self.lock:
+            trace = self.traces.pop(callback_id, None)
+        if not trace:
+            return None
+        trace.close(time.monotonic())
+        module = callback_id.split('_')[-2] if callback_id.count('_') >= 2 else ''
+        for phase, (started, ended) in trace.spans.items():
+            DOWNLOAD_PHASE.observe(ended - started, module=module, phase=phase)
+        return trace.dump()
+
+
+TRACES = TraceRecorder()